@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import subprocess
+import functools
+import torch
+from main import build_parser
+from models import charagram, lstm, charcnn
+from utils.constant import DEVICE
+
+print = functools.partial(print, flush=True)
+
+# sizes of train.sh
+MODEL_CONFIGS = {
+    "charagram": {"module": charagram, "embed_size": 300, "hidden_size": 300},
+    "charcnn": {"module": charcnn, "embed_size": 1024, "hidden_size": 4800},
+    "lstm": {"module": lstm, "embed_size": 64, "hidden_size": 1024},
+    "avg_lstm": {"module": lstm, "embed_size": 64, "hidden_size": 1024},
+}
+
+
+def bench_args(model, data_dir, work_dir, similarity_measure="cosine", extra=()):
+    '''
+    args of main.py for a model on a synthetic data directory (benchmark/synthetic.py), maps are written to work_dir
+    '''
+    config = MODEL_CONFIGS[model]
+    alia_file = os.path.join(data_dir, "alias")
+    argv = ["--model", model, "--similarity_measure", similarity_measure, "--objective", "hinge",
+            "--embed_size", str(config["embed_size"]), "--hidden_size", str(config["hidden_size"]),
+            "--pooling_method", "sum", "--trainer", "adam", "--learning_rate", "1e-3",
+            "--train_file", os.path.join(data_dir, "train"), "--dev_file", os.path.join(data_dir, "dev"),
+            "--kb_file", os.path.join(data_dir, "kb"), "--test_file", os.path.join(data_dir, "test"),
+            "--alia_file", alia_file if os.path.getsize(alia_file) > 0 else "HOLDER",
+            "--map_file", os.path.join(work_dir, model), "--model_path", os.path.join(work_dir, model)] + list(extra)
+    return build_parser().parse_args(argv)
+
+
+def build_model(args, src_vocab_size, trg_vocab_size, similarity_measure):
+    # a model with random weights, as the train branch of each model's main
+    if args.model == "charagram":
+        model = charagram.Charagram(src_vocab_size, trg_vocab_size, args.embed_size, similarity_measure, args.use_mid)
+    elif args.model in ["lstm", "avg_lstm"]:
+        model = lstm.LSTMEncoder(src_vocab_size, trg_vocab_size, args.embed_size, args.hidden_size, similarity_measure,
+                                 args.use_mid, "avg" in args.model)
+    else:
+        model = charcnn.CharCNN(src_vocab_size, trg_vocab_size, args.embed_size, args.hidden_size, similarity_measure,
+                                args.use_mid, pooling_method=args.pooling_method)
+    model.set_similarity_matrix()
+    return model
+
+
+class Timer:
+    '''
+    accumulated seconds of named stages
+    '''
+    def __init__(self):
+        self.seconds = {}
+
+    def stage(self, name):
+        return TimerStage(self, name)
+
+
+class TimerStage:
+    def __init__(self, timer: Timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # cuda kernels are asynchronous, a stage ends when its kernels are done
+        if DEVICE.type == "cuda":
+            torch.cuda.synchronize()
+        self.timer.seconds[self.name] = self.timer.seconds.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def peak_rss_mb():
+    # peak resident memory of this process, ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def peak_gpu_mb():
+    return torch.cuda.max_memory_allocated() / 2 ** 20 if DEVICE.type == "cuda" else None
+
+
+def environment():
+    return {"python": platform.python_version(), "torch": torch.__version__, "threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(), "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def run_isolated(module, config: dict):
+    '''
+    run one benchmark config in a new process (python -m module --config json), so that peak RSS is of this config only
+    the last line of its stdout is the JSON result, {"error": last line of stderr} if it fails
+    (e.g. bl or lcosine with charcnn, whose output size is not the size of its similarity matrices)
+    '''
+    process = subprocess.run([sys.executable, "-m", module, "--config", json.dumps(config)], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if process.returncode != 0:
+        error = process.stderr.decode("utf-8").strip().split("\n")[-1]
+        print("[WARNING] failed: {}".format(error))
+        return {"error": error}
+    return json.loads(process.stdout.decode("utf-8").strip().split("\n")[-1])
+
+
+def compare(results: list, baseline: list, key_fields, higher_better, tolerance=0.2, gated=None):
+    '''
+    :param higher_better: metric -> True if a higher value is better (throughput), False for times and memory
+    :param gated: metrics that count as regressions, None for all of them, the others are only reported
+    :return: number of gated metrics that are worse than the baseline by more than tolerance
+    '''
+    baseline = {tuple(x[k] for k in key_fields): x for x in baseline}
+    regressions = 0
+    for result in results:
+        key = tuple(result[k] for k in key_fields)
+        if "error" in result or key not in baseline:
+            print("[INFO] {}: no baseline or failed".format(key))
+            continue
+        for metric, better in higher_better.items():
+            old, new = baseline[key].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            worse = ratio < 1 - tolerance if better else ratio > 1 + tolerance
+            if worse and gated is not None and metric not in gated:
+                print("[WARNING] {} {}: {:.4g} -> {:.4g} ({:+.1%}), not gated".format(key, metric, old, new, ratio - 1))
+                continue
+            regressions += int(worse)
+            print("[{}] {} {}: {:.4g} -> {:.4g} ({:+.1%})".format("REGRESSION" if worse else "INFO", key, metric, old, new, ratio - 1))
+    return regressions
+
+
+def write_json(fname, results: list):
+    with open(fname, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+    print("[INFO] write {} results to {}".format(len(results), fname))
+
+
+def read_json(fname) -> list:
+    with open(fname, "r", encoding="utf-8") as f:
+        return json.load(f)["results"]
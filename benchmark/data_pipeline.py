@@ -0,0 +1,173 @@
+import os
+import io
+import gc
+import json
+import time
+import random
+import argparse
+import functools
+import tempfile
+import shutil
+import tracemalloc
+import contextlib
+from collections import Counter
+import torch
+from benchmark.common import MODEL_CONFIGS, bench_args, run_isolated, compare, write_json, read_json
+from benchmark.synthetic import generate, SCRIPTS
+from models.base_train import init_train
+from data_loader.data_loader import PackedSide
+from utils.ngram import get_ngram
+from utils.constant import RANDOM_SEED
+
+print = functools.partial(print, flush=True)
+
+# the data loader of each model, avg_lstm shares the loader of lstm
+LOADERS = ["charagram", "charcnn", "lstm"]
+# get_ngram and get_alias do not depend on the loader, they are measured once under this name
+SHARED = "base"
+KEY_FIELDS = ("loader", "op")
+# metric -> whether higher is better, used to compare with a baseline
+METRICS = {"us_per_call": False, "alloc_bytes_per_call": False, "peak_kb": False}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_pipeline_baseline.json")
+
+
+def measure(fn, calls, repeat):
+    '''
+    time fn (which makes calls calls) repeat times and trace its python allocations in one more run,
+    memory of torch tensors is allocated outside of python and is not traced
+    :return: best microseconds per call, bytes still allocated per call after a run (the result), peak KB of a run
+    '''
+    # as timeit, the best of the repeats without garbage collection
+    best = float("inf")
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+            del result
+    finally:
+        gc.enable()
+    gc.collect()
+    tracemalloc.start()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    result = fn()
+    end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"calls": calls, "us_per_call": round(best / calls * 1e6, 3),
+            "alloc_bytes_per_call": round((end_bytes - start_bytes) / calls, 1),
+            "peak_kb": round((peak_bytes - start_bytes) / 1024.0, 1)}
+
+
+def quiet(fn):
+    # load_all_data prints the number of lines of each file it reads
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn()
+    return run
+
+
+def bench_config(config: dict) -> list:
+    '''
+    per call cost of the data pipeline steps of one loader on fixed size synthetic data:
+    load_all_data (per line), n_gram_filter and pack (per entry), transform_one_batch and create_batch (per batch),
+    or get_ngram (per string) and get_alias (per KB line) for the shared steps
+    '''
+    torch.set_num_threads(1)
+    data_dir = generate(config["data_dir"], config["kb_size"], config["alias_num"], config["scripts"].split(","),
+                        train_size=config["train_size"])
+    work_dir = tempfile.mkdtemp()
+    model = config["loader"] if config["loader"] != SHARED else LOADERS[0]
+    args = bench_args(model, data_dir, work_dir, extra=["--trg_encoding_num", str(config["trg_encoding_num"]),
+                                                        "--batch_size", str(config["batch_size"]),
+                                                        "--n_gram_threshold", str(config["n_gram_threshold"])])
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_loader, _, _ = init_train(args, MODEL_CONFIGS[model]["module"].DataLoader)
+    repeat = config["repeat"]
+    ops = {}
+    if config["loader"] == SHARED:
+        with open(args.kb_file, "r", encoding="utf-8") as f:
+            kb_tks = [line.strip().split(" ||| ") for _, line in zip(range(config["kb_lines"]), f)]
+        titles = [tks[args.kb_str_idx] for tks in kb_tks]
+        ops["get_ngram"] = measure(lambda: [get_ngram(x) for x in titles], len(titles), repeat)
+        ops["get_alias"] = measure(lambda: [data_loader.get_alias(tks, args.kb_str_idx, args.kb_id_idx, args.trg_encoding_num)
+                                            for tks in kb_tks], len(kb_tks), repeat)
+    else:
+        train_file = data_loader.train_file
+        # a new frequency map at each call, so the maps of the loader are not changed
+        load = quiet(lambda: list(data_loader.load_all_data(train_file.trg_file_name, train_file.trg_str_idx, train_file.trg_id_idx,
+                                                            data_loader.x2i_trg, Counter(), args.trg_encoding_num,
+                                                            train_file.trg_type_idx)))
+        ops["load_all_data"] = measure(load, len(data_loader.train_trg), repeat)
+        ops["n_gram_filter"] = measure(lambda: data_loader.n_gram_filter(data_loader.train_trg, data_loader.trg_freq_map),
+                                       len(data_loader.train_trg), repeat)
+        # all first versions, then all second versions, ... as in the batches of create_batch
+        words = [x[0][0][v] for v in range(args.trg_encoding_num) for x in data_loader.train_trg]
+        batch_starts = range(0, len(words), args.batch_size)
+        ops["transform_one_batch"] = measure(lambda: [data_loader.transform_one_batch(words[st:st + args.batch_size]) for st in batch_starts],
+                                             len(batch_starts), repeat)
+        # packed once per training run, at the first epoch
+        ops["pack"] = measure(lambda: PackedSide(data_loader.train_trg, args.trg_encoding_num, data_loader.pad_idx),
+                              len(data_loader.train_trg), repeat)
+        packed = [data_loader.packed_side(x, n) for x, n in [("train_src", 1), ("train_trg", args.trg_encoding_num),
+                                                             ("train_mid", args.mid_encoding_num)]]
+        # the same shuffle at each run, the padded lengths of the batches depend on it
+        create = lambda: random.seed(RANDOM_SEED) or data_loader.create_batch("train", *packed)
+        ops["create_batch"] = measure(create, len(range(0, len(data_loader.train_src), args.batch_size)), repeat)
+    shutil.rmtree(work_dir)
+    return [dict({"loader": config["loader"], "op": op}, **result) for op, result in ops.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loaders", help="comma separated, from " + ",".join([SHARED] + LOADERS), default=",".join([SHARED] + LOADERS))
+    parser.add_argument("--train_size", help="number of synthetic training links, the input of the loader steps", type=int, default=5000)
+    parser.add_argument("--kb_size", type=int, default=20000)
+    parser.add_argument("--kb_lines", help="number of KB lines of get_ngram and get_alias", type=int, default=5000)
+    parser.add_argument("--alias_num", type=int, default=2)
+    parser.add_argument("--scripts", help="comma separated, from " + ",".join(SCRIPTS), default="latin,cyrillic,devanagari")
+    parser.add_argument("--trg_encoding_num", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--n_gram_threshold", type=int, default=2)
+    parser.add_argument("--repeat", help="the best of this number of runs is reported", type=int, default=10)
+    parser.add_argument("--data_dir", help="synthetic data is generated once under this directory", default="bench_data")
+    parser.add_argument("--output", default="bench_data_pipeline.json")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare with, empty for none", default=BASELINE)
+    parser.add_argument("--tolerance", help="a metric worse than the baseline by more than this fraction is a regression", type=float, default=0.2)
+    # µs timings of one run vary by more than the tolerance, by default only the allocations (deterministic) are a regression
+    parser.add_argument("--gate_metrics", help="comma separated metrics that fail the comparison, from " + ",".join(METRICS),
+                        default="alloc_bytes_per_call,peak_kb")
+    # internal, one loader in this process
+    parser.add_argument("--config", default="")
+    args = parser.parse_args()
+    if args.config:
+        print(json.dumps(bench_config(json.loads(args.config))))
+        return
+    data_dir = os.path.join(os.path.abspath(args.data_dir), "train{}_kb{}_alias{}_{}".format(args.train_size, args.kb_size, args.alias_num,
+                                                                                           args.scripts.replace(",", "-")))
+    results = []
+    for loader in args.loaders.split(","):
+        config = {"loader": loader, "train_size": args.train_size, "kb_size": args.kb_size, "kb_lines": args.kb_lines,
+                  "alias_num": args.alias_num, "scripts": args.scripts, "trg_encoding_num": args.trg_encoding_num,
+                  "batch_size": args.batch_size, "n_gram_threshold": args.n_gram_threshold, "repeat": args.repeat, "data_dir": data_dir}
+        print("[INFO] benchmark loader={}".format(loader))
+        result = run_isolated("benchmark.data_pipeline", config)
+        if "error" in result:
+            results.append({"loader": loader, "op": "", "error": result["error"]})
+            continue
+        for row in result:
+            print("[INFO] {} {}: {:.2f}us/call, {:.0f} bytes/call allocated, peak {:.1f}KB".format(
+                row["loader"], row["op"], row["us_per_call"], row["alloc_bytes_per_call"], row["peak_kb"]))
+        results += result
+    write_json(args.output, results)
+    if args.baseline and os.path.exists(args.baseline):
+        regressions = compare(results, read_json(args.baseline), KEY_FIELDS, METRICS, args.tolerance, args.gate_metrics.split(","))
+        print("[INFO] {} regressions against {}".format(regressions, args.baseline))
+        if regressions != 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import json
+import argparse
+import functools
+import shutil
+import tempfile
+import torch
+import numpy as np
+from benchmark.common import MODEL_CONFIGS, bench_args, build_model, Timer, peak_rss_mb, run_isolated, compare, write_json, read_json
+from benchmark.synthetic import generate, SCRIPTS
+from models.base_train import init_train
+from models.base_test import get_encodings, get_topk, exact_match, record_topk, close_file_list
+from utils.func import FileInfo
+from utils.similarity_calculator import Similarity
+from utils.constant import DEVICE
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+KEY_FIELDS = ("model", "similarity_measure", "kb_size", "alias_num", "scripts", "trg_encoding_num")
+# metric -> whether higher is better, used to compare with a baseline
+METRICS = {"kb_entities_per_s": True, "queries_per_s": True, "encode_kb_s": False, "encode_queries_s": False,
+           "score_s": False, "exact_match_s": False, "rank_s": False, "write_s": False,
+           "p50_ms": False, "p99_ms": False, "peak_rss_mb": False}
+
+
+def rank_timed(timer: Timer, test_encodings, test_plain, kb_encodings, kb_entity_string, similarity_calculator: Similarity,
+               trg_encoding_num, pieces, topk):
+    # the steps of rank_kb, each one timed
+    with timer.stage("score_s"):
+        scores = similarity_calculator(test_encodings, kb_encodings, is_src_trg=True, split=True, pieces=pieces,
+                                       negative_sample=None, encoding_num=trg_encoding_num)
+    with timer.stage("exact_match_s"):
+        scores = exact_match(scores, test_plain, kb_entity_string)
+    with timer.stage("rank_s"):
+        return get_topk(scores, topk)
+
+
+def bench_config(config: dict) -> dict:
+    '''
+    time one (model, similarity, KB) config: encode the KB and the test mentions, then score, exact match, rank
+    and write the results of all mentions in chunks (throughput) and of single mentions (latency)
+    '''
+    torch.set_num_threads(config["threads"])
+    data_dir = generate(config["data_dir"], config["kb_size"], config["alias_num"], config["scripts"].split(","),
+                        test_size=config["test_size"])
+    work_dir = tempfile.mkdtemp()
+    args = bench_args(config["model"], data_dir, work_dir, config["similarity_measure"],
+                      ["--trg_encoding_num", str(config["trg_encoding_num"]), "--batch_size", str(config["batch_size"])])
+    timer = Timer()
+    # the vocab maps are built from the training links, as in training
+    train_data_loader, _, similarity_calculator = init_train(args, MODEL_CONFIGS[args.model]["module"].DataLoader)
+    model = build_model(args, train_data_loader.src_vocab_size, train_data_loader.trg_vocab_size, similarity_calculator)
+    model.eval()
+    model.to(device)
+    with timer.stage("load_s"):
+        test_file = FileInfo()
+        test_file.set_src(args.test_file, args.test_str_idx, args.test_id_idx)
+        test_file.set_trg(args.kb_file, args.kb_str_idx, args.kb_id_idx, args.kb_type_idx)
+        data_loader = MODEL_CONFIGS[args.model]["module"].DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=test_file)
+    topk = config["topk"]
+    with torch.no_grad():
+        with timer.stage("encode_kb_s"):
+            kb_encodings, kb_ids, kb_entity_string = get_encodings(model, data_loader, False, "", is_src=False, is_mid=False,
+                                                                   encoding_num=args.trg_encoding_num)
+        with timer.stage("encode_queries_s"):
+            test_encodings, gold_kb_ids, test_plain = get_encodings(model, data_loader, False, "", is_src=True, is_mid=False, encoding_num=1)
+        # throughput: all mentions in chunks, as calc_result
+        result_files = [open(os.path.join(work_dir, "result.id"), "w", encoding="utf-8"),
+                        open(os.path.join(work_dir, "result.str"), "w", encoding="utf-8")]
+        chunk_size = config["query_chunk_size"]
+        for st in range(0, len(test_plain), chunk_size):
+            top_idx, top_scores = rank_timed(timer, test_encodings[st:st + chunk_size], test_plain[st:st + chunk_size], kb_encodings,
+                                             kb_entity_string, similarity_calculator, args.trg_encoding_num, config["pieces"], topk)
+            with timer.stage("write_s"):
+                record_topk(top_idx, top_scores, test_plain[st:st + chunk_size], gold_kb_ids[st:st + chunk_size], kb_ids, kb_entity_string,
+                            result_files, False, None, [])
+        close_file_list(result_files)
+        # latency: one mention at a time, from its encoding to its ranked list
+        latency = []
+        test_data = data_loader.get_test_data(is_src=True, is_mid=False)
+        for i in range(min(config["latency_queries"], len(test_plain))):
+            cur_timer = Timer()
+            with cur_timer.stage("query"):
+                batch = data_loader.create_sequence_batches([test_data[i][0][0][0]], is_src=True, is_mid=False)[0]
+                encoding = model.calc_encode(batch, is_src=True).cpu().numpy()
+                rank_timed(Timer(), encoding, test_plain[i:i + 1], kb_encodings, kb_entity_string, similarity_calculator,
+                           args.trg_encoding_num, 1, topk)
+            latency.append(cur_timer.seconds["query"] * 1000)
+    shutil.rmtree(work_dir)
+    seconds = timer.seconds
+    query_seconds = sum(seconds[x] for x in ["score_s", "exact_match_s", "rank_s", "write_s"]) + seconds["encode_queries_s"]
+    result = {k: config[k] for k in KEY_FIELDS}
+    result.update({"threads": config["threads"], "queries": len(test_plain), "hidden_size": int(kb_encodings.shape[1])})
+    result.update({k: round(v, 4) for k, v in seconds.items()})
+    result.update({"kb_entities_per_s": round(len(kb_ids) / seconds["encode_kb_s"], 1),
+                   "queries_per_s": round(len(test_plain) / query_seconds, 1),
+                   "p50_ms": round(float(np.percentile(latency, 50)), 3) if latency else None,
+                   "p99_ms": round(float(np.percentile(latency, 99)), 3) if latency else None,
+                   "peak_rss_mb": round(peak_rss_mb(), 1)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", help="comma separated, from " + ",".join(MODEL_CONFIGS), default="charagram,charcnn,lstm")
+    parser.add_argument("--similarity_measures", help="comma separated, from cosine,bl,lcosine", default="cosine,bl,lcosine")
+    parser.add_argument("--kb_sizes", help="comma separated number of entities", default="10000,100000")
+    parser.add_argument("--alias_nums", help="comma separated number of aliases of each entity", default="2")
+    parser.add_argument("--scripts", help="comma separated, from " + ",".join(SCRIPTS) + ", every entity uses one of them",
+                        default="latin,cyrillic,devanagari")
+    parser.add_argument("--trg_encoding_num", type=int, default=1)
+    parser.add_argument("--test_size", type=int, default=1000)
+    parser.add_argument("--query_chunk_size", type=int, default=1000)
+    parser.add_argument("--latency_queries", help="number of single mention queries for the latency percentiles", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--pieces", help="number of KB pieces the similarity is computed in", type=int, default=100)
+    parser.add_argument("--topk", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--data_dir", help="synthetic data is generated once under this directory", default="bench_data")
+    parser.add_argument("--output", default="bench_retrieval.json")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare with", default="")
+    parser.add_argument("--tolerance", help="a metric worse than the baseline by more than this fraction is a regression", type=float, default=0.2)
+    # internal, one config in this process
+    parser.add_argument("--config", default="")
+    args = parser.parse_args()
+    if args.config:
+        print(json.dumps(bench_config(json.loads(args.config))))
+        return
+    results = []
+    for kb_size in [int(x) for x in args.kb_sizes.split(",")]:
+        for alias_num in [int(x) for x in args.alias_nums.split(",")]:
+            data_dir = os.path.join(os.path.abspath(args.data_dir), "kb{}_alias{}_{}".format(kb_size, alias_num, args.scripts.replace(",", "-")))
+            for model in args.models.split(","):
+                for similarity_measure in args.similarity_measures.split(","):
+                    config = {"model": model, "similarity_measure": similarity_measure, "kb_size": kb_size, "alias_num": alias_num,
+                              "scripts": args.scripts, "trg_encoding_num": args.trg_encoding_num, "test_size": args.test_size,
+                              "query_chunk_size": args.query_chunk_size, "latency_queries": args.latency_queries,
+                              "batch_size": args.batch_size, "pieces": args.pieces, "topk": args.topk, "threads": args.threads,
+                              "data_dir": data_dir}
+                    print("[INFO] benchmark {}".format(" ".join("{}={}".format(k, config[k]) for k in KEY_FIELDS)))
+                    result = run_isolated("benchmark.retrieval", config)
+                    if "error" in result:
+                        results.append(dict({k: config[k] for k in KEY_FIELDS}, **result))
+                        continue
+                    print("[INFO] {:.1f} KB entities/s, {:.1f} queries/s, p50 {}ms, p99 {}ms, peak RSS {:.1f}MB".format(
+                        result["kb_entities_per_s"], result["queries_per_s"], result["p50_ms"], result["p99_ms"], result["peak_rss_mb"]))
+                    results.append(result)
+    write_json(args.output, results)
+    if args.baseline:
+        regressions = compare(results, read_json(args.baseline), KEY_FIELDS, METRICS, args.tolerance)
+        print("[INFO] {} regressions against {}".format(regressions, args.baseline))
+        if regressions != 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
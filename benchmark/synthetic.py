@@ -0,0 +1,104 @@
+import os
+import argparse
+import functools
+import numpy as np
+
+print = functools.partial(print, flush=True)
+
+# characters of the titles of each script, han is a slice of the CJK block
+SCRIPTS = {
+    "latin": "abcdefghijklmnopqrstuvwxyz",
+    "cyrillic": "абвгдежзийклмнопрстуфхцчшщэюя",
+    "greek": "αβγδεζηθικλμνξοπρστυφχψω",
+    "devanagari": "कखगघचछजझटठडढणतथदधनपफबभमयरलवशसहािीुूेैोौं",
+    "han": "".join(chr(x) for x in range(0x4e00, 0x4e00 + 300)),
+}
+TYPES = ["PER", "LOC", "ORG"]
+# the data files of a generated directory are complete once this file exists
+DONE_FILE = "done"
+
+
+def random_name(rng: np.random.RandomState, alphabet, max_words=3):
+    words = []
+    for _ in range(rng.randint(1, max_words + 1)):
+        word = "".join(alphabet[i] for i in rng.randint(0, len(alphabet), rng.randint(3, 11)))
+        words.append(word.capitalize())
+    return " ".join(words)
+
+
+def noisy(rng: np.random.RandomState, s, alphabet, rate=0.15):
+    # a mention of an entity: some characters of the title are replaced or dropped
+    chars = []
+    for c in s:
+        p = rng.uniform()
+        if p < rate / 2 and c != " ":
+            chars.append(alphabet[rng.randint(len(alphabet))])
+        elif p < rate and c != " ":
+            continue
+        else:
+            chars.append(c)
+    return "".join(chars).strip() or s
+
+
+def write_links(fname, rng, rows, titles, scripts, types):
+    # link files have the format of ee-me_train: id ||| KB title ||| mention ||| type
+    with open(fname, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write("{} ||| {} ||| {} ||| {}\n".format(1000 + row, titles[row], noisy(rng, titles[row], SCRIPTS[scripts[row]]), types[row]))
+
+
+def generate(data_dir, kb_size, alias_num=2, scripts=("latin",), train_size=10000, test_size=1000, seed=0):
+    '''
+    write a synthetic KB (kb, id ||| title ||| type), its alias file (alias), training / dev links (train, dev)
+    and test mentions (test) into data_dir, an existing complete directory is reused
+    :return: data_dir
+    '''
+    if os.path.exists(os.path.join(data_dir, DONE_FILE)):
+        return data_dir
+    if kb_size < 4:
+        raise ValueError("the KB needs at least 4 entities for training, dev and test links, got {}".format(kb_size))
+    # the test and dev links are drawn first and the training links get the rest,
+    # when the KB is too small for all of them the test and dev links take at most half of it
+    if kb_size < train_size + 2 * test_size and test_size > kb_size // 4:
+        print("[INFO] {} entities for {} training links: {} test and dev links instead of {}".format(kb_size, train_size, kb_size // 4, test_size))
+        test_size = kb_size // 4
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    scripts = list(scripts)
+    # only the titles of linked entities are kept in memory, the KB is written as it is generated
+    linked = np.sort(rng.choice(kb_size, min(kb_size, train_size + 2 * test_size), replace=False))
+    linked_set = set(linked.tolist())
+    titles, entity_scripts, entity_types = {}, {}, {}
+    with open(os.path.join(data_dir, "kb"), "w", encoding="utf-8") as f_kb, \
+            open(os.path.join(data_dir, "alias"), "w", encoding="utf-8") as f_alias:
+        for row in range(kb_size):
+            script = scripts[row % len(scripts)]
+            title = random_name(rng, SCRIPTS[script])
+            entity_type = TYPES[rng.randint(len(TYPES))]
+            f_kb.write("{} ||| {} ||| {}\n".format(1000 + row, title, entity_type))
+            if alias_num > 0:
+                aliases = [noisy(rng, title, SCRIPTS[script]) for _ in range(alias_num)]
+                f_alias.write("Q{} ||| {} ||| {} ||| {}\n".format(1000 + row, 1000 + row, title, " || ".join(aliases)))
+            if row in linked_set:
+                titles[row], entity_scripts[row], entity_types[row] = title, script, entity_type
+    rng.shuffle(linked)
+    test_rows, dev_rows, train_rows = linked[:test_size], linked[test_size:2 * test_size], linked[2 * test_size:]
+    write_links(os.path.join(data_dir, "train"), rng, train_rows, titles, entity_scripts, entity_types)
+    write_links(os.path.join(data_dir, "dev"), rng, dev_rows, titles, entity_scripts, entity_types)
+    write_links(os.path.join(data_dir, "test"), rng, test_rows, titles, entity_scripts, entity_types)
+    open(os.path.join(data_dir, DONE_FILE), "w").close()
+    print("[INFO] generate {}: {} entities, {} aliases each, scripts {}".format(data_dir, kb_size, alias_num, ",".join(scripts)))
+    return data_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--kb_size", type=int, default=10000)
+    parser.add_argument("--alias_num", help="aliases of each entity, 0 for none", type=int, default=2)
+    parser.add_argument("--scripts", help="comma separated, from " + ",".join(SCRIPTS), default="latin")
+    parser.add_argument("--train_size", type=int, default=10000)
+    parser.add_argument("--test_size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.data_dir, args.kb_size, args.alias_num, args.scripts.split(","), args.train_size, args.test_size, args.seed)
@@ -0,0 +1,137 @@
+import os
+import json
+import shutil
+import argparse
+import functools
+import tempfile
+import torch
+from benchmark.common import MODEL_CONFIGS, bench_args, build_model, Timer, peak_rss_mb, peak_gpu_mb, run_isolated, compare, write_json, read_json
+from benchmark.synthetic import generate, SCRIPTS
+from models.base_encoder import create_optimizer
+from models.base_train import init_train, reset_bias, calc_batch_loss
+from utils.constant import DEVICE, RANDOM_SEED
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+KEY_FIELDS = ("model", "objective", "batch_size", "threads", "trg_encoding_num", "precision")
+# metric -> whether higher is better, used to compare with a baseline
+METRICS = {"examples_per_s": True, "train_examples_per_s": True, "create_batches_s": False, "forward_s": False,
+           "backward_s": False, "step_s": False, "peak_rss_mb": False, "peak_gpu_mb": False}
+
+
+def bench_config(config: dict) -> dict:
+    '''
+    train one model for a fixed number of steps as run() does, timing batch creation, forward (calc_batch_loss, the similarity
+    of the batch and the loss), backward and optimizer step (gradient clipping included) separately, after warmup steps that are not timed
+    '''
+    torch.manual_seed(RANDOM_SEED)
+    torch.set_num_threads(config["threads"])
+    data_dir = generate(config["data_dir"], config["kb_size"], scripts=config["scripts"].split(","), train_size=config["train_size"])
+    work_dir = tempfile.mkdtemp()
+    args = bench_args(config["model"], data_dir, work_dir, extra=["--objective", config["objective"], "--batch_size", str(config["batch_size"]),
+                                                                 "--trg_encoding_num", str(config["trg_encoding_num"]),
+                                                                 "--train_precision", config["precision"]])
+    data_loader, criterion, similarity_measure = init_train(args, MODEL_CONFIGS[args.model]["module"].DataLoader)
+    model = build_model(args, data_loader.src_vocab_size, data_loader.trg_vocab_size, similarity_measure)
+    model.to(device)
+    model.train()
+    optimizer, _ = create_optimizer(args.trainer, args.learning_rate, model)
+    timer = Timer()
+    # run() creates the batches of every epoch, this cost is timed once and spread over the steps of an epoch
+    with timer.stage("create_batches_s"):
+        batches = data_loader.create_batches("train")[::-1]
+    batches_per_epoch = len(batches)
+    examples, loss_sum = 0, 0.0
+    for step in range(config["warmup_steps"] + config["steps"]):
+        # timing starts after the warmup steps
+        cur_timer = timer if step >= config["warmup_steps"] else Timer()
+        if len(batches) == 0:
+            batches = data_loader.create_batches("train")[::-1]
+        batch = batches.pop()
+        optimizer.zero_grad()
+        with cur_timer.stage("forward_s"):
+            loss = calc_batch_loss(model, criterion, batch, args.mid_proportion, args.trg_encoding_num, args.mid_encoding_num,
+                                   autocast=args.train_precision == "bf16")
+        with cur_timer.stage("backward_s"):
+            loss.backward()
+        with cur_timer.stage("step_s"):
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=5)
+            optimizer.step()
+            if model.name == "bilstm":
+                reset_bias(model.src_lstm)
+                reset_bias(model.trg_lstm)
+        if step >= config["warmup_steps"]:
+            examples += len(batch.gold_kb_ids)
+            loss_sum += loss.item()
+    shutil.rmtree(work_dir)
+    seconds = timer.seconds
+    train_seconds = sum(seconds[x] for x in ["forward_s", "backward_s", "step_s"])
+    result = {k: config[k] for k in KEY_FIELDS}
+    batching_seconds = seconds["create_batches_s"] * config["steps"] / batches_per_epoch
+    result.update({"steps": config["steps"], "batches_per_epoch": batches_per_epoch, "examples": examples,
+                   "mean_loss": round(loss_sum / config["steps"], 6)})
+    result.update({k: round(v, 4) for k, v in seconds.items()})
+    result.update({# examples/s of the whole step, and of the model only (without batch creation)
+                   "examples_per_s": round(examples / (train_seconds + batching_seconds), 1),
+                   "train_examples_per_s": round(examples / train_seconds, 1),
+                   "peak_rss_mb": round(peak_rss_mb(), 1),
+                   "peak_gpu_mb": round(peak_gpu_mb(), 1) if peak_gpu_mb() is not None else None})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", help="comma separated, from " + ",".join(MODEL_CONFIGS), default="charagram,charcnn,lstm,avg_lstm")
+    parser.add_argument("--objective", choices=("hinge", "mle"), default="hinge")
+    parser.add_argument("--batch_sizes", help="comma separated", default="64,256")
+    parser.add_argument("--threads", help="comma separated torch thread counts", default=str(torch.get_num_threads()))
+    parser.add_argument("--steps", help="number of timed training steps", type=int, default=50)
+    parser.add_argument("--warmup_steps", type=int, default=5)
+    parser.add_argument("--trg_encoding_num", type=int, default=1)
+    parser.add_argument("--precisions", help="comma separated --train_precision, fp32,bf16 to measure the gain of bf16", default="fp32")
+    parser.add_argument("--train_size", help="number of synthetic training links", type=int, default=20000)
+    parser.add_argument("--kb_size", help="entities the synthetic links are drawn from", type=int, default=100000)
+    parser.add_argument("--scripts", help="comma separated, from " + ",".join(SCRIPTS), default="latin,cyrillic,devanagari")
+    parser.add_argument("--data_dir", help="synthetic data is generated once under this directory", default="bench_data")
+    parser.add_argument("--output", default="bench_training.json")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare with", default="")
+    parser.add_argument("--tolerance", help="a metric worse than the baseline by more than this fraction is a regression", type=float, default=0.2)
+    # internal, one config in this process
+    parser.add_argument("--config", default="")
+    args = parser.parse_args()
+    if args.config:
+        print(json.dumps(bench_config(json.loads(args.config))))
+        return
+    data_dir = os.path.join(os.path.abspath(args.data_dir), "train{}_kb{}_{}".format(args.train_size, args.kb_size, args.scripts.replace(",", "-")))
+    results = []
+    for model in args.models.split(","):
+        for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+            for threads, precision in [(int(x), y) for x in args.threads.split(",") for y in args.precisions.split(",")]:
+                config = {"model": model, "objective": args.objective, "batch_size": batch_size, "threads": threads,
+                          "trg_encoding_num": args.trg_encoding_num, "precision": precision, "steps": args.steps,
+                          "warmup_steps": args.warmup_steps, "train_size": args.train_size, "kb_size": args.kb_size,
+                          "scripts": args.scripts, "data_dir": data_dir}
+                print("[INFO] benchmark {}".format(" ".join("{}={}".format(k, config[k]) for k in KEY_FIELDS)))
+                result = run_isolated("benchmark.training", config)
+                if "error" in result:
+                    results.append(dict({k: config[k] for k in KEY_FIELDS}, **result))
+                    continue
+                print("[INFO] {:.1f} examples/s ({:.1f} without batching), forward+loss/backward/step {:.2f}/{:.2f}/{:.2f}s, "
+                      "peak RSS {:.1f}MB".format(result["examples_per_s"], result["train_examples_per_s"], result["forward_s"],
+                                                 result["backward_s"], result["step_s"], result["peak_rss_mb"]))
+                results.append(result)
+    write_json(args.output, results)
+    if args.baseline:
+        baseline = read_json(args.baseline)
+        # baselines written before --precisions trained in float32
+        for result in baseline:
+            result.setdefault("precision", "fp32")
+        regressions = compare(results, baseline, KEY_FIELDS, METRICS, args.tolerance)
+        print("[INFO] {} regressions against {}".format(regressions, args.baseline))
+        if regressions != 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
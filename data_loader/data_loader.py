@@ -2,12 +2,16 @@ import sys
 import os
 import functools
 import random
+import itertools
+import torch
 import numpy as np
-import pickle
 from typing import List
 from collections import defaultdict, Counter
-from utils.constant import DEVICE
+from utils.constant import DEVICE, RANDOM_SEED
 from utils.func import FileInfo
+from utils.string_store import AliasStore, hash_string
+from utils.vocab import CompactMap, CompactCount, compact_map_exists, convert_pickle_map, KEY_SUFFIX, COUNT_SUFFIX
+from utils.trace import span, traced
 
 print = functools.partial(print, flush=True)
 device = DEVICE
@@ -43,6 +47,51 @@ class BaseBatch:
     def to(self,  *args, **kwargs):
         pass
 
+def pack_sequences(seqs, pad_idx):
+    '''
+    id lists as one flat int64 array, sequence i is ids[offsets[i]:offsets[i + 1]]
+    the last id is a pad_idx that gather_padded reads for the padded positions
+    '''
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)), out=offsets[1:])
+    ids = np.empty(offsets[-1] + 1, dtype=np.int64)
+    ids[:-1] = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int64, count=offsets[-1])
+    ids[-1] = pad_idx
+    return ids, offsets
+
+
+def gather_padded(ids, offsets, seq_idx):
+    '''
+    :param seq_idx: indices of the sequences of a batch
+    :return: [len(seq_idx), max length] LongTensor of the sequences padded with the last id, LongTensor of their lengths
+    '''
+    starts = offsets[seq_idx]
+    lens = offsets[seq_idx + 1] - starts
+    pos = np.arange(lens.max() if len(lens) != 0 else 0)
+    flat_idx = np.where(pos[None, :] < lens[:, None], starts[:, None] + pos[None, :], len(ids) - 1)
+    return torch.from_numpy(ids[flat_idx]), torch.from_numpy(lens)
+
+
+class PackedSide:
+    '''
+    the data of one side (e.g. the KB entities of the train file) packed once (pack_sequences) and reused at every epoch
+    version v of entry i is sequence i * encoding_num + v, batches are gathered from a permutation of the entries
+    '''
+    def __init__(self, side_data, encoding_num, pad_idx):
+        self.encoding_num = encoding_num
+        self.ids, self.offsets = pack_sequences([seq for entry in side_data for seq in entry[0][0][:encoding_num]], pad_idx)
+        assert len(self.offsets) == len(side_data) * encoding_num + 1
+        self.kb_ids = np.array([entry[1] for entry in side_data], dtype=object)
+
+    def __len__(self):
+        return len(self.kb_ids)
+
+    def gather(self, data_idx):
+        # all first versions of the batch, then all second versions, ...
+        seq_idx = (data_idx[None, :] * self.encoding_num + np.arange(self.encoding_num)[:, None]).reshape(-1)
+        return gather_padded(self.ids, self.offsets, seq_idx)
+
+
 class BaseDataLoader:
     def __init__(self, is_train, args,
                  train_file: FileInfo, dev_file: FileInfo, test_file: FileInfo):
@@ -59,13 +108,19 @@ class BaseDataLoader:
         self.trg_encoding_num = args.trg_encoding_num
         self.mid_encoding_num = args.mid_encoding_num
         self.load_alia_map(args.alia_file)
+        # with a KB index (models/kb_index.py) the aliases of an entity are chosen by its id,
+        # so an entity encoded alone in an update gets the same aliases as in a full build
+        self.alias_seed = RANDOM_SEED if args.kb_index_dir else None
         self.n_gram_threshold = args.n_gram_threshold
         self.max_position = 0
+        # name of the data (e.g. "train_src") -> (data, PackedSide of the data)
+        self.packed = {}
         if is_train:
             self.init_train()
         else:
             self.init_test()
 
+    @traced("n_gram_filter")
     def n_gram_filter(self, data, freq_map):
         filter_data = []
         for cur_data in data:
@@ -97,17 +152,18 @@ class BaseDataLoader:
         self.x2i_trg[self.pad_str]
         self.src_freq_map = Counter()
         self.trg_freq_map = Counter()
-        self.train_src = list(self.load_data(self.train_file.src_file_name, self.train_file.src_str_idx,
-                                             self.train_file.src_id_idx, is_src=True, encoding_num=1, type_idx=None))
-        self.train_trg = list(self.load_data(self.train_file.trg_file_name, self.train_file.trg_str_idx,
-                                             self.train_file.trg_id_idx, is_src=False,
-                                             encoding_num=self.trg_encoding_num,
-                                             type_idx=self.train_file.trg_type_idx))
+        with span("load_data"):
+            self.train_src = list(self.load_data(self.train_file.src_file_name, self.train_file.src_str_idx,
+                                                 self.train_file.src_id_idx, is_src=True, encoding_num=1, type_idx=None))
+            self.train_trg = list(self.load_data(self.train_file.trg_file_name, self.train_file.trg_str_idx,
+                                                 self.train_file.trg_id_idx, is_src=False,
+                                                 encoding_num=self.trg_encoding_num,
+                                                 type_idx=self.train_file.trg_type_idx))
         # save map
-        self.save_map(self.x2i_src, self.map_file + "_src.pkl")
-        self.save_map(self.x2i_trg, self.map_file + "_trg.pkl")
-        self.save_map(self.src_freq_map, self.map_file + "_src_freq.pkl")
-        self.save_map(self.trg_freq_map, self.map_file + "_trg_freq.pkl")
+        self.save_map(self.x2i_src, self.map_file + "_src")
+        self.save_map(self.x2i_trg, self.map_file + "_trg")
+        self.save_freq_map(self.src_freq_map, self.map_file + "_src_freq")
+        self.save_freq_map(self.trg_freq_map, self.map_file + "_trg_freq")
 
         if self.use_mid:
             self.x2i_mid = defaultdict(lambda: len(self.x2i_mid))
@@ -117,8 +173,8 @@ class BaseDataLoader:
                 self.load_data(self.train_file.mid_file_name, self.train_file.mid_str_idx, self.train_file.mid_id_idx,
                                is_src=False, is_mid=True, encoding_num=self.mid_encoding_num,
                                type_idx=self.train_file.mid_type_idx))
-            self.save_map(self.x2i_mid, self.map_file + "_mid.pkl")
-            self.save_map(self.mid_freq_map, self.map_file + "_mid_freq.pkl")
+            self.save_map(self.x2i_mid, self.map_file + "_mid")
+            self.save_freq_map(self.mid_freq_map, self.map_file + "_mid_freq")
             self.mid_vocab_size = len(self.x2i_mid)
             self.x2i_mid = defaultdict(lambda: self.x2i_mid[self.pad_str], self.x2i_mid)
             self.mid_freq_map = defaultdict(lambda: float('-inf'), self.mid_freq_map)
@@ -134,11 +190,12 @@ class BaseDataLoader:
         self.trg_freq_map = defaultdict(lambda: float('-inf'), self.trg_freq_map)
 
         if self.dev_file:
-            self.dev_src = list(self.load_data(self.dev_file.src_file_name, self.dev_file.src_str_idx,
-                                               self.dev_file.src_id_idx, is_src=True, encoding_num=1, type_idx=None))
-            self.dev_trg = list(self.load_data(self.dev_file.trg_file_name, self.dev_file.trg_str_idx,
-                                               self.dev_file.trg_id_idx, is_src=False,
-                                               encoding_num=self.trg_encoding_num, type_idx=self.dev_file.trg_type_idx))
+            with span("load_data"):
+                self.dev_src = list(self.load_data(self.dev_file.src_file_name, self.dev_file.src_str_idx,
+                                                   self.dev_file.src_id_idx, is_src=True, encoding_num=1, type_idx=None))
+                self.dev_trg = list(self.load_data(self.dev_file.trg_file_name, self.dev_file.trg_str_idx,
+                                                   self.dev_file.trg_id_idx, is_src=False,
+                                                   encoding_num=self.trg_encoding_num, type_idx=self.dev_file.trg_type_idx))
             n = min(len(self.dev_src), 2000)
             self.dev_src, self.dev_trg = self.dev_src[:n], self.dev_trg[:n]
             if self.use_mid:
@@ -167,39 +224,41 @@ class BaseDataLoader:
 
 
     def init_test(self):
-        self.x2i_src = self.load_map(self.map_file + "_src.pkl")
-        self.x2i_trg = self.load_map(self.map_file + "_trg.pkl")
-        self.src_freq_map = self.load_map(self.map_file + "_src_freq.pkl", float('-inf')) if os.path.exists(
-            self.map_file + "_src_freq.pkl") \
+        self.x2i_src = self.load_map(self.map_file + "_src")
+        self.x2i_trg = self.load_map(self.map_file + "_trg")
+        self.src_freq_map = self.load_freq_map(self.map_file + "_src_freq") if compact_map_exists(
+            self.map_file + "_src_freq") \
             else defaultdict(int)
-        self.trg_freq_map = self.load_map(self.map_file + "_trg_freq.pkl", float('-inf')) if os.path.exists(
-            self.map_file + "_trg_freq.pkl") \
+        self.trg_freq_map = self.load_freq_map(self.map_file + "_trg_freq") if compact_map_exists(
+            self.map_file + "_trg_freq") \
             else defaultdict(int)
         if self.use_mid:
-            self.x2i_mid = self.load_map(self.map_file + "_mid.pkl")
-            self.mid_freq_map = self.load_map(self.map_file + "_mid_freq.pkl", float('-inf'))
+            self.x2i_mid = self.load_map(self.map_file + "_mid")
+            self.mid_freq_map = self.load_freq_map(self.map_file + "_mid_freq")
         else:
             self.x2i_mid = None
-        self.i2c_src = {v: k for k, v in self.x2i_src.items()}
-        self.i2c_trg = {v: k for k, v in self.x2i_trg.items()}
-        if self.test_file.src_file_name is not None:
-            self.test_src = list(self.load_data(self.test_file.src_file_name,
-                                                self.test_file.src_str_idx, self.test_file.src_id_idx,
-                                                is_src=True, encoding_num=1, type_idx=None))
-        if self.test_file.trg_file_name is not None:
-            self.test_trg = list(self.load_data(self.test_file.trg_file_name,
-                                                self.test_file.trg_str_idx, self.test_file.trg_id_idx,
-                                                is_src=False, encoding_num=self.trg_encoding_num,
-                                                type_idx=self.test_file.trg_type_idx))
-        if self.test_file.mid_file_name is not None:
-            self.test_mid = list(self.load_data(self.test_file.mid_file_name,
-                                                self.test_file.mid_str_idx, self.test_file.mid_id_idx, is_src=False,
-                                                is_mid=True,
-                                                encoding_num=self.mid_encoding_num,
-                                                type_idx=self.test_file.mid_type_idx))
+        # idx -> string is decoded from the compact map on demand
+        self.i2c_src = self.x2i_src.decode
+        self.i2c_trg = self.x2i_trg.decode
+        with span("load_data"):
+            if self.test_file.src_file_name is not None and not self.test_file.src_stream:
+                self.test_src = list(self.load_data(self.test_file.src_file_name,
+                                                    self.test_file.src_str_idx, self.test_file.src_id_idx,
+                                                    is_src=True, encoding_num=1, type_idx=None))
+            if self.test_file.trg_file_name is not None:
+                self.test_trg = list(self.load_data(self.test_file.trg_file_name,
+                                                    self.test_file.trg_str_idx, self.test_file.trg_id_idx,
+                                                    is_src=False, encoding_num=self.trg_encoding_num,
+                                                    type_idx=self.test_file.trg_type_idx))
+            if self.test_file.mid_file_name is not None:
+                self.test_mid = list(self.load_data(self.test_file.mid_file_name,
+                                                    self.test_file.mid_str_idx, self.test_file.mid_id_idx, is_src=False,
+                                                    is_mid=True,
+                                                    encoding_num=self.mid_encoding_num,
+                                                    type_idx=self.test_file.mid_type_idx))
 
         if self.n_gram_threshold != 0:
-            if self.test_file.src_file_name is not None:
+            if self.test_file.src_file_name is not None and not self.test_file.src_stream:
                 self.test_src = self.n_gram_filter(self.test_src, self.src_freq_map)
             if self.test_file.trg_file_name is not None:
                 self.test_trg = self.n_gram_filter(self.test_trg, self.trg_freq_map)
@@ -208,17 +267,10 @@ class BaseDataLoader:
 
     def load_alia_map(self, fname):
         if fname != "HOLDER":
-            self.title_alia_map = defaultdict(list)
-            self.id_alia_map = defaultdict(list)
-            with open(fname, "r", encoding="utf-8") as f:
-                for line in f:
-                    tks = line.strip().split(" ||| ")
-                    if len(tks) != 4:
-                        continue
-                    aka = tks[3].split(" || ")
-                    self.title_alia_map[tks[2]] = aka
-                    if tks[1] != "NAN":
-                        self.id_alia_map[tks[1]] = aka
+            # aliases are read lazily from an mmap-ed store built next to the alias file
+            alias_store = AliasStore.open(fname)
+            self.title_alia_map = alias_store.title_map
+            self.id_alia_map = alias_store.id_map
             print(f"[INFO] there are {len(self.title_alia_map)} / {len(self.id_alia_map)} items in aka")
         else:
             print("[WARNING] no alia file found!")
@@ -233,7 +285,8 @@ class BaseDataLoader:
             alias = [title for x in range(encoding_num - len(alias))] + alias
         # randomly select encoding num - 1 alias
         else:
-            selected_idx = np.random.choice(len(alias), encoding_num - 1, replace=False)
+            rng = np.random if self.alias_seed is None else np.random.RandomState((hash_string(id) + self.alias_seed) % (1 << 32))
+            selected_idx = rng.choice(len(alias), encoding_num - 1, replace=False)
             alias = [alias[x] for x in selected_idx]
             alias = [title] + alias
 
@@ -256,92 +309,134 @@ class BaseDataLoader:
             freq_map = self.mid_freq_map
         return self.load_all_data(file_name, str_idx, id_idx, x2i_map, freq_map, encoding_num, type_idx)
 
-    def transform_one_batch(self, *args, **kwargs) -> list:
+    def transform_padded(self, data_tensor, data_lens) -> list:
+        # the batch info of the model from the padded ids and the lengths of gather_padded
         raise NotImplementedError
 
+    def transform_one_batch(self, data) -> list:
+        ids, offsets = pack_sequences(data, self.pad_idx)
+        return self.transform_padded(*gather_padded(ids, offsets, np.arange(len(data))))
+
     def new_batch(self) -> BaseBatch:
         raise NotImplementedError
 
-    def extract_idx(self, encoding_num, idx_list):
-        all_idx = []
-        for i in range(encoding_num):
-            all_idx += [idx_list[idx][i] for idx in range(len(idx_list))]
-        assert len(all_idx) == len(idx_list) * encoding_num
-
-        return all_idx
-
     # data from one side
-    def prepare_batch(self, side_data, data_idx, encoding_num):
-        # this is a list of words
-        words = [side_data[idx][0][0] for idx in data_idx]
-        # expand words to list
-        all_words = self.extract_idx(encoding_num, words)
-        word_idx_tensor, *other_info = self.transform_one_batch(all_words)
-        merge_tensor = word_idx_tensor
-
-        kb_ids = [side_data[idx][1] for idx in data_idx]
-        batch_info = [merge_tensor, *other_info]
-
+    def prepare_batch(self, side: PackedSide, data_idx):
+        batch_info = self.transform_padded(*side.gather(data_idx))
+        kb_ids = side.kb_ids[data_idx].tolist()
         return batch_info, kb_ids
 
-    def create_batch(self, dataset, data_src=None, data_trg=None, data_mid=None) -> List[BaseBatch]:
+    def packed_side(self, name, encoding_num):
+        # e.g. packed_side("train_src", 1), packed at the first epoch and again only if the data is replaced
+        data = getattr(self, name)
+        if data is None:
+            return None
+        cached = self.packed.get(name)
+        if cached is None or cached[0] is not data:
+            with span("batching"):
+                cached = self.packed[name] = (data, PackedSide(data, encoding_num, self.pad_idx))
+        return cached[1]
+
+    @traced("batching")
+    def create_batch(self, dataset, data_src: PackedSide=None, data_trg: PackedSide=None, data_mid: PackedSide=None) -> List[BaseBatch]:
         batches = []
         non_none = [x for x in [data_src, data_trg, data_mid] if x is not None][0]
         data_idx = [i for i in range(len(non_none))]
         if dataset == "train":
             random.shuffle(data_idx)
+        data_idx = np.array(data_idx, dtype=np.int64)
         for i in range(0, len(data_idx), self.batch_size):
             batch = self.new_batch()
-            cur_size = min(self.batch_size, len(data_idx) - i)
-            cur_data_idx = data_idx[i:i + cur_size]
+            cur_data_idx = data_idx[i:i + self.batch_size]
             if data_src is not None:
-                batch_info, src_gold_kb_ids = self.prepare_batch(data_src, cur_data_idx, encoding_num=1)
+                batch_info, src_gold_kb_ids = self.prepare_batch(data_src, cur_data_idx)
                 batch.set_src(*batch_info, src_gold_kb_ids)
             if data_trg is not None:
-                batch_info, trg_kb_ids = self.prepare_batch(data_trg, cur_data_idx, encoding_num=self.trg_encoding_num)
+                batch_info, trg_kb_ids = self.prepare_batch(data_trg, cur_data_idx)
                 batch.set_trg(*batch_info, trg_kb_ids)
             if data_mid is not None:
-                batch_info, mid_kb_ids = self.prepare_batch(data_mid, cur_data_idx, encoding_num=self.mid_encoding_num)
+                batch_info, mid_kb_ids = self.prepare_batch(data_mid, cur_data_idx)
                 batch.set_mid(*batch_info, mid_kb_ids)
             # move to device
-            batch.to(device)
+            with span("device_transfer"):
+                batch.to(device)
             batches.append(batch)
 
         return batches
 
+    # batches of single version idx lists, e.g. strings that are not in the encoding cache
+    @traced("batching")
+    def create_sequence_batches(self, seqs, is_src, is_mid) -> List[BaseBatch]:
+        batches = []
+        ids, offsets = pack_sequences(seqs, self.pad_idx)
+        seq_idx = np.arange(len(seqs))
+        for i in range(0, len(seqs), self.batch_size):
+            batch = self.new_batch()
+            batch_info = self.transform_padded(*gather_padded(ids, offsets, seq_idx[i:i + self.batch_size]))
+            if is_mid:
+                batch.set_mid(*batch_info, None)
+            elif is_src:
+                batch.set_src(*batch_info, None)
+            else:
+                batch.set_trg(*batch_info, None)
+            with span("device_transfer"):
+                batch.to(device)
+            batches.append(batch)
+        return batches
+
+    def get_test_data_file(self, is_src, is_mid):
+        if is_mid:
+            return self.test_file.mid_file_name
+        return self.test_file.src_file_name if is_src else self.test_file.trg_file_name
+
+    def get_test_data(self, is_src, is_mid):
+        if is_mid:
+            return self.test_mid
+        return self.test_src if is_src else self.test_trg
+
     # pad both source and target words
     def create_batches(self, dataset: str, is_src=None, is_mid=None) -> List[BaseBatch]:
         # self.train_mid could be None!
         # training time
-        if dataset == "train":
-            batches = self.create_batch(dataset, self.train_src, self.train_trg, data_mid=self.train_mid)
-        elif dataset == "dev":
-            batches = self.create_batch(dataset, self.dev_src, self.dev_trg, data_mid=self.dev_mid)
+        # the data is packed once, only the batches of the shuffled indices are gathered at each epoch
+        if dataset in ["train", "dev"]:
+            batches = self.create_batch(dataset, self.packed_side(dataset + "_src", 1),
+                                        self.packed_side(dataset + "_trg", self.trg_encoding_num),
+                                        data_mid=self.packed_side(dataset + "_mid", self.mid_encoding_num))
         # test time, load data separately
         else:
             assert is_src is not None and is_mid is not None
             if is_mid:
                 batches = self.create_batch(dataset, data_src=None, data_trg=None,
-                                            data_mid=self.test_mid)
+                                            data_mid=self.packed_side("test_mid", self.mid_encoding_num))
             else:
                 if is_src:
-                    batches = self.create_batch(dataset, self.test_src, None, None)
+                    batches = self.create_batch(dataset, self.packed_side("test_src", 1), None, None)
                 else:
-                    batches = self.create_batch(dataset, None, self.test_trg, None)
+                    batches = self.create_batch(dataset, None, self.packed_side("test_trg", self.trg_encoding_num), None)
 
         return batches
 
+    # maps are saved in the compact format of utils/vocab.py, map_file is the prefix of the .npy files
     def save_map(self, map, map_file):
-        # save map
-        with open(map_file, "wb") as f:
-            pickle.dump(dict(map), f)
-            print("[INFO] save x to idx map to :{}, len: {:d}".format(map_file, len(map)))
+        CompactMap.from_dict(map).save(map_file)
+        print("[INFO] save x to idx map to :{}, len: {:d}".format(map_file, len(map)))
+
+    def save_freq_map(self, map, map_file):
+        CompactCount.from_dict(map).save(map_file)
+        print("[INFO] save frequency map to :{}, len: {:d}".format(map_file, len(map)))
 
     def load_map(self, map_file, default_return=None):
-        with open(map_file, "rb") as f:
-            m = pickle.load(f)
-            if default_return is None:
-                default_return = m[self.pad_str]
-            m = defaultdict(lambda: default_return, m)
-            print("[INFO] load x to idx map from {}, len: {:d}".format(map_file, len(m)))
-            return m
\ No newline at end of file
+        if not os.path.exists(map_file + KEY_SUFFIX):
+            convert_pickle_map(map_file)
+        m = CompactMap.load(map_file)
+        m.default = m[self.pad_str] if default_return is None else default_return
+        print("[INFO] load x to idx map from {}, len: {:d}".format(map_file, len(m)))
+        return m
+
+    def load_freq_map(self, map_file, default_return=float('-inf')):
+        if not os.path.exists(map_file + COUNT_SUFFIX):
+            convert_pickle_map(map_file)
+        m = CompactCount.load(map_file, default_return)
+        print("[INFO] load frequency map from {}, len: {:d}".format(map_file, len(m)))
+        return m
\ No newline at end of file
@@ -1,5 +1,7 @@
-from models import charagram, lstm, charcnn
+from models.bundle import MODEL_MODULES, apply_bundle_args
+from utils.trace import init_trace
 import argparse
+import importlib
 import pprint
 
 def str2bool(s):
@@ -8,7 +10,8 @@ def str2bool(s):
     else:
         return True
 
-def argps():
+def build_parser():
+    # all the options of main.py, also used to build the args of the benchmarks (benchmark/)
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", help='model to use for encoding strings',
                         choices=('charagram', 'charcnn', 'lstm', 'avg_lstm'),
@@ -64,12 +67,17 @@ def argps():
     parser.add_argument("--lr_decay", type=str2bool, default=False)
     parser.add_argument("--lr_scaler", type=float)
     parser.add_argument("--max_epoch", type=int, default=200)
+    parser.add_argument("--train_precision", help="bf16: forward under bf16 autocast, float32 weights, gradients and loss",
+                        choices=("fp32", "bf16"), default="fp32")
 
     # test
     parser.add_argument("--test_epoch", type=str, default="best")
     parser.add_argument("--test_file", default="")
     parser.add_argument("--test_str_idx", help="HRL or LRL string", type=int, default=2)
     parser.add_argument("--test_id_idx", help="EN wiki id", type=int, default=0)
+    parser.add_argument("--test_type_idx", help="the column index of mention type (e.g. from NER) in the test file, "
+                                                "if not -1, mentions only search KB entities of the same type (--kb_type_idx)",
+                        type=int, default=-1)
     parser.add_argument("--encoded_test_file", default="")
     parser.add_argument("--load_encoded_test", type=str2bool, default=False)
     parser.add_argument("--record_recall", type=str2bool, default=True)
@@ -79,6 +87,77 @@ def argps():
     parser.add_argument("--encoded_kb_file", default="")
     parser.add_argument("--load_encoded_kb", type=str2bool, default=False)
     parser.add_argument("--no_pivot_result", default="")
+    parser.add_argument("--query_chunk_size", help="if not 0, read the test file in chunks of this size and overlap encoding, scoring and writing",
+                        type=int, default=0)
+    parser.add_argument("--result_cache_size", help="max number of mentions whose ranked results are cached, 0 to disable",
+                        type=int, default=10000)
+    parser.add_argument("--encoding_cache_dir", help="directory of the on-disk encoding cache, empty for memory only", default="")
+    parser.add_argument("--encoding_cache_size", help="max number of encodings in the in-memory cache", type=int, default=100000)
+
+    # cascade for test (lstm, charcnn): a charagram model shortlists KB entities, the main model reranks them
+    parser.add_argument("--shortlist_size", help="number of KB entities shortlisted for each query, 0 to rank the whole KB with the main model",
+                        type=int, default=0)
+    parser.add_argument("--shortlist_model_path", help="model_path of the charagram shortlist model", default="")
+    parser.add_argument("--shortlist_epoch", type=str, default="best")
+    parser.add_argument("--shortlist_map_file", help="map_file of the charagram shortlist model", default="")
+
+    # character n-gram prefilter for test: only KB entities sharing rare n-grams with the query are scored
+    parser.add_argument("--prefilter_size", help="max number of candidates of each query from the n-gram index, 0 to score the whole KB",
+                        type=int, default=0)
+    parser.add_argument("--prefilter_max_df", help="n-grams in more than this fraction of the KB are not used to find candidates",
+                        type=float, default=0.1)
+
+    # popularity tiers for test: queries are ranked against the most linked entities first
+    parser.add_argument("--prior_file", help="comma separated link files (e.g. ee-me_train) or count files (id ||| count) of the entity prior",
+                        default="")
+    parser.add_argument("--tier_sizes", help="comma separated sizes of the KB tiers by prior, the last tier takes the rest, empty for no tier",
+                        default="")
+    parser.add_argument("--tier_threshold", help="queries whose best score is below this go on to the next tier", type=float, default=0.8)
+
+    # fast path for test: mentions matching one KB title or alias are answered without encoding
+    parser.add_argument("--fast_path", type=str2bool, default=False)
+    parser.add_argument("--fast_path_min_prefix", help="mentions at least this long also match the one entity they are a prefix of, 0 to disable",
+                        type=int, default=0)
+
+    # updatable KB index for test: a KB update only encodes the added or changed entities
+    parser.add_argument("--kb_index_dir", help="directory of the KB index, built from --kb_file if empty, empty to encode --kb_file as a whole",
+                        default="")
+    parser.add_argument("--kb_diff_file", help="KB update applied to the index (python -m models.kb_index), "
+                                               "+ KB line to add or replace an entity, - id to remove one", default="")
+    parser.add_argument("--kb_compact", help="merge the segments of the KB index in the background while testing",
+                        type=str2bool, default=False)
+    parser.add_argument("--kb_index_check", help="KB file the index should be a full build of, the index is compared with it "
+                                                 "before testing and the test stops if they differ", default="")
+
+    # inference bundle for test (python -m models.bundle): its model, vocab and KB index replace --model, --map_file and --kb_index_dir
+    parser.add_argument("--bundle_dir", help="directory of an inference bundle, empty to load --model_path and --map_file", default="")
+    parser.add_argument("--encoder_graph", help="encode with the TorchScript graphs of the bundle instead of the model classes",
+                        type=str2bool, default=False)
+
+    # reduced precision for test: queries, pivot strings and the KB are encoded in bf16 or int8
+    parser.add_argument("--inference_precision", help="bf16 autocast or dynamic int8 quantization of the encoder (CPU only)",
+                        choices=("fp32", "bf16", "int8"), default="fp32")
+    parser.add_argument("--precision_check", help="compare recall@1/10/30 on --dev_file with fp32 first, stop if it drops",
+                        type=str2bool, default=False)
+    parser.add_argument("--precision_tolerance", help="largest recall drop of --precision_check", type=float, default=0.01)
+
+    # dimensionality reduction for test: the KB is scored in a PCA space of fewer dimensions
+    parser.add_argument("--projection_dim", help="number of PCA dimensions the KB is stored and scored in, 0 to keep the encoder dimension",
+                        type=int, default=0)
+    parser.add_argument("--projection_report", help="comma separated dimensions whose recall is compared with the full dimension, "
+                                                    "empty for no report", default="")
+    parser.add_argument("--projection_sample_size", help="max number of KB encodings the PCA is fit on", type=int, default=100000)
+
+    # memory planner for test: peak memory is estimated before the KB is encoded
+    parser.add_argument("--memory_budget", help="max RSS in MB, queries are ranked in chunks whose score matrices fit in it, 0 for no budget",
+                        type=int, default=0)
+    parser.add_argument("--memory_report", help="print the estimated and the actual peak RSS of each test stage",
+                        type=str2bool, default=False)
+
+    # profiling: named spans around loading, batching, encoding, scoring, ranking, writing, eval and checkpointing
+    parser.add_argument("--trace", help="print the time spent in each stage when the process exits", type=str2bool, default=False)
+    parser.add_argument("--trace_file", help="with --trace, also write the spans as a Chrome trace JSON file, empty for none", default="")
+    parser.add_argument("--trace_max_events", help="max number of spans kept for --trace_file", type=int, default=1000000)
 
     # pivoting for test
     #pivoting
@@ -90,22 +169,68 @@ def argps():
     parser.add_argument("--pivot_result", default="")
     parser.add_argument("--pivot_is_src", type=str2bool)
     parser.add_argument("--pivot_is_mid", type=str2bool)
+    return parser
 
-
+def argps():
+    parser = build_parser()
     args = parser.parse_args()
-
-    # convert intermediate stuff
-    # name, file_name, str_idx, id_idx, encoded_file, load_encoded, is_src
-    args.intermediate_stuff = []
-    args.intermediate_stuff.append(["pivot", args.pivot_file, args.pivot_str_idx, args.pivot_id_idx, args.pivot_type_idx,
-                                    args.encoded_pivot_file, args.load_encoded_pivot, args.pivot_is_src, args.pivot_is_mid])
-
-    # result files
-    args.result_file = {}
-    args.result_file["no_pivot"] = args.no_pivot_result + ".id"
-    args.result_file["no_pivot_str"] = args.no_pivot_result + ".str"
-    args.result_file["pivot"] = args.pivot_result + ".id"
-    args.result_file["pivot_str"] = args.pivot_result + ".str"
+    if args.bundle_dir:
+        args = apply_bundle_args(args, parser)
+    elif args.encoder_graph:
+        parser.error("--encoder_graph needs --bundle_dir")
+    if args.inference_precision != "fp32" and args.encoder_graph:
+        parser.error("--inference_precision could not be used with --encoder_graph")
+    if args.precision_check and not args.dev_file:
+        parser.error("--precision_check needs --dev_file")
+    if args.tier_sizes and (args.test_type_idx >= 0 or args.shortlist_size > 0 or args.prefilter_size > 0):
+        parser.error("--tier_sizes could not be used with --test_type_idx, --shortlist_size or --prefilter_size")
+    # fast path matches are unique in the whole KB, not in the type partition of a mention
+    if args.fast_path and args.test_type_idx >= 0:
+        parser.error("--fast_path could not be used with --test_type_idx")
+    # the prefilter is only built without the cascade
+    if args.shortlist_size > 0 and args.prefilter_size > 0:
+        parser.error("--shortlist_size could not be used with --prefilter_size")
+    # the cascade encodes the shortlisted KB entities itself, they are not projected
+    if (args.projection_dim > 0 or args.projection_report) and args.shortlist_size > 0:
+        parser.error("--projection_dim and --projection_report could not be used with --shortlist_size")
+    # these options read the rows of --kb_file, the rows of the KB index change with its updates
+    if args.kb_index_dir and (args.test_type_idx >= 0 or args.shortlist_size > 0 or args.prefilter_size > 0 or args.tier_sizes
+                              or args.fast_path or args.load_encoded_kb):
+        parser.error("--kb_index_dir could not be used with --test_type_idx, --shortlist_size, --prefilter_size, --tier_sizes, "
+                     "--fast_path or --load_encoded_kb")
+
+    # several test files (e.g. one per test language) could be evaluated in one run, the KB is encoded only once
+    # --test_file, --no_pivot_result and --pivot_result are then comma separated lists of the same length
+    # --pivot_file is either one file shared by all test files or a list of the same length
+    test_files = args.test_file.split(",")
+    no_pivot_results = args.no_pivot_result.split(",")
+    pivot_results = args.pivot_result.split(",")
+    pivot_files = args.pivot_file.split(",")
+    if len(pivot_files) == 1:
+        pivot_files = pivot_files * len(test_files)
+    if not len(test_files) == len(no_pivot_results) == len(pivot_results) == len(pivot_files):
+        parser.error("--test_file, --no_pivot_result, --pivot_result and --pivot_file should have the same number of files")
+
+    args.test_runs = []
+    for test_file, no_pivot_result, pivot_file, pivot_result in zip(test_files, no_pivot_results, pivot_files, pivot_results):
+        # convert intermediate stuff
+        # name, file_name, str_idx, id_idx, encoded_file, load_encoded, is_src
+        intermediate_stuff = []
+        intermediate_stuff.append(["pivot", pivot_file, args.pivot_str_idx, args.pivot_id_idx, args.pivot_type_idx,
+                                   args.encoded_pivot_file, args.load_encoded_pivot, args.pivot_is_src, args.pivot_is_mid])
+
+        # result files
+        result_file = {}
+        result_file["no_pivot"] = no_pivot_result + ".id"
+        result_file["no_pivot_str"] = no_pivot_result + ".str"
+        result_file["pivot"] = pivot_result + ".id"
+        result_file["pivot_str"] = pivot_result + ".str"
+        args.test_runs.append({"test_file": test_file, "intermediate_stuff": intermediate_stuff, "result_file": result_file})
+
+    # the first test file goes through the single file code path
+    args.test_file = test_files[0]
+    args.intermediate_stuff = args.test_runs[0]["intermediate_stuff"]
+    args.result_file = args.test_runs[0]["result_file"]
 
     # print config
     pprint.pprint(vars(args))
@@ -113,9 +238,6 @@ def argps():
 
 if __name__ == "__main__":
     args = argps()
-    if args.model == "charagram":
-        charagram.main(args)
-    elif args.model in ["lstm", "avg_lstm"]:
-        lstm.main(args)
-    elif args.model == "charcnn":
-        charcnn.main(args)
+    init_trace(args)
+    # only the module of the model is imported
+    importlib.import_module("models." + MODEL_MODULES[args.model]).main(args)
@@ -85,4 +85,30 @@ class Encoder(nn.Module):
         self.similarity_measure.set_src_trg_bl(self.src_trg_bl)
         self.similarity_measure.set_src_mid_bl(self.src_mid_bl)
         self.similarity_measure.set_src_affine(self.src_affine)
-        self.similarity_measure.set_trg_affine(self.trg_affine)
\ No newline at end of file
+        self.similarity_measure.set_trg_affine(self.trg_affine)
+
+class GraphEncoder(Encoder):
+    '''
+    encoder made of the TorchScript graphs of the src and trg sides of a model (side_encoder of each model),
+    used at test time without the model classes. trg_graph is None if the KB side is not exported
+    :param matrices: src_trg_bl, src_mid_bl, src_affine and trg_affine of the model, for the similarity
+    '''
+    def __init__(self, src_graph, trg_graph, similarity_measure, matrices: dict):
+        # the matrices of Encoder are not created, they are the ones of the model
+        nn.Module.__init__(self)
+        self.name = src_graph.name
+        self.hidden_size = src_graph.hidden_size
+        self.src_graph = src_graph
+        self.trg_graph = trg_graph
+        for name, matrix in matrices.items():
+            setattr(self, name, nn.Parameter(matrix, requires_grad=False))
+        self.similarity_measure = similarity_measure
+
+    def calc_encode(self, batch: BaseBatch, is_src, is_mid=False):
+        if is_mid:
+            raise NotImplementedError
+        if is_src:
+            return self.src_graph(*batch.get_src())
+        if self.trg_graph is None:
+            raise NotImplementedError("the KB side encoder is not in the bundle")
+        return self.trg_graph(*batch.get_trg())
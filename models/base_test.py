@@ -1,4 +1,5 @@
 import functools
+import itertools
 import torch
 import numpy as np
 import time
@@ -7,23 +8,45 @@ from models.base_encoder import Encoder
 from data_loader.data_loader import BaseDataLoader, BaseBatch
 from utils.similarity_calculator import Similarity
 from utils.constant import DEVICE
+from utils.string_store import load_string_column, find_strings, ConcatStrings
+from utils.encoding_cache import EncodingCache, hash_sequence
+from utils.pipeline import run_pipeline
+from utils.result_cache import QueryResultCache
+from utils.vocab import KEY_SUFFIX
+from utils.type_index import TypeIndex, load_type_index, read_type_column, NO_TYPE
+from utils.trace import span, traced
+from models.memory_plan import MemoryPlan, memory_stage, count_lines, encoding_dim
+from models.bundle import checkpoint_file, checkpoint_hash
 
 device = DEVICE
 print = functools.partial(print, flush=True)
 # load data for ONE side (e.g KB or test data)
 
 
-def get_rank(scores:np.ndarray, kb_id:np.ndarray, kb_entity_string:list, topk=100):
-    limit = min(len(scores), topk)
-    # find the index of top_limit elements
-    max_idx = np.argpartition(scores, -limit)[-limit:]
-    # sort these index by their scores
-    ranked_idxs = max_idx[np.argsort(scores[max_idx])][::-1]
-    ranked_ids = kb_id[ranked_idxs]
-    ranked_entity_string = [kb_entity_string[i] for i in ranked_idxs]
-    ranked_scores = scores[ranked_idxs]
-
-    return ranked_ids, ranked_entity_string, ranked_scores
+def get_topk(scores:np.ndarray, topk=100, chunk_size=1024):
+    '''
+    :return: index and score of the topk entries of each row, sorted by score, [query_size, topk]
+    '''
+    limit = min(scores.shape[1], topk)
+    all_idx, all_scores = [], []
+    # row by chunk, argpartition keeps a copy of its input
+    for st in range(0, scores.shape[0], chunk_size):
+        cur_scores = scores[st:st + chunk_size]
+        # find the index of top_limit elements
+        max_idx = np.argpartition(cur_scores, -limit, axis=1)[:, -limit:]
+        max_scores = np.take_along_axis(cur_scores, max_idx, axis=1)
+        # sort these index by their scores
+        order = np.argsort(max_scores, axis=1)[:, ::-1]
+        all_idx.append(np.take_along_axis(max_idx, order, axis=1))
+        all_scores.append(np.take_along_axis(max_scores, order, axis=1))
+    return np.vstack(all_idx), np.vstack(all_scores)
+
+def merge_topk(top_idx1, top_scores1, top_idx2, top_scores2, offset2, topk=100):
+    # merge two topk lists of the same queries, idx in the second list are shifted by offset2
+    idx = np.hstack([top_idx1, top_idx2 + offset2])
+    scores = np.hstack([top_scores1, top_scores2])
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :topk]
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(scores, order, axis=1)
 
 def update_recall(gold_id:int, top_predict_ids:np.ndarray, recall_dict:dict, topk_list:list):
     for topk in topk_list:
@@ -41,11 +64,15 @@ def record_result(opened_file, opened_file_string, plain_text, top_predict_ids:n
     string_score_pair = " || ".join(string_score_pair)
     opened_file_string.write(string_score_pair + "\n")
 
-def calc_scores(scores, data_plain, gold_kb_ids, kb_ids, kb_entity_string, result_file: list, record_recall, recall_file, topk_list):
-    print("[INFO] current score matrix shape: ", str(scores.shape))
-    assert scores.shape[0] == len(data_plain) and len(data_plain) == len(gold_kb_ids)
-    for idx, (cur_scores, plain_text, gold_kb_id) in enumerate(zip(scores, data_plain, gold_kb_ids)):
-        ranked_ids, ranked_entity_string, ranked_scores = get_rank(cur_scores, kb_ids, kb_entity_string)
+@traced("write_results")
+def record_topk(top_idx, top_scores, data_plain, gold_kb_ids, kb_ids, kb_entity_string, result_file: list, record_recall, recall_file, topk_list):
+    assert top_idx.shape[0] == len(data_plain) and len(data_plain) == len(gold_kb_ids)
+    for ranked_idxs, ranked_scores, plain_text, gold_kb_id in zip(top_idx, top_scores, data_plain, gold_kb_ids):
+        # lists of small type partitions are padded with -1
+        keep = ranked_idxs >= 0
+        ranked_idxs, ranked_scores = ranked_idxs[keep], ranked_scores[keep]
+        ranked_ids = kb_ids[ranked_idxs]
+        ranked_entity_string = [kb_entity_string[i] for i in ranked_idxs]
         record_result(result_file[0], result_file[1], plain_text, ranked_ids, ranked_entity_string, ranked_scores)
         if record_recall:
             update_recall(gold_kb_id, ranked_ids, recall_file, topk_list)
@@ -55,80 +82,351 @@ def close_file_list(file_list):
         f.close()
 
 
-def exact_match(original_scores, test_data_plain, kb_entity_strings):
+def exact_match(original_scores, test_data_plain, kb_entity_strings, skip=None, kb_rows=None, kb_first=False):
+    '''
+    :param skip: bool mask of queries that are not matched, e.g. those already matched in the KB when matching pivot strings
+    :param kb_rows: the columns of original_scores are these (sorted) rows of kb_entity_strings, e.g. a type partition,
+    the first occurrence of a string among them is matched (a title can also be in rows of other partitions)
+    :param kb_first: with kb_rows, match the first occurrence in the whole KB only if it is one of kb_rows, as ranking
+    the whole KB would (candidates of a shortlist)
+    '''
     i, j = original_scores.shape
     assert len(test_data_plain) == i
-    assert len(kb_entity_strings) == j
+    assert (len(kb_entity_strings) if kb_rows is None else len(kb_rows)) == j
     updated_scores = np.copy(original_scores)
-    for idx, data_plain in enumerate(test_data_plain):
-        if data_plain in kb_entity_strings:
-            target_idx = kb_entity_strings.index(data_plain)
+    matched_idx = find_strings(kb_entity_strings, test_data_plain, None if kb_first else kb_rows)
+    if kb_rows is not None and j != 0:
+        pos = np.minimum(np.searchsorted(kb_rows, matched_idx), j - 1)
+        matched_idx = np.where((matched_idx != -1) & (kb_rows[pos] == matched_idx), pos, -1)
+    if skip is not None:
+        matched_idx[skip] = -1
+    for idx, target_idx in enumerate(matched_idx):
+        if target_idx != -1:
             updated_scores[idx, target_idx] = 1000.0
     return updated_scores
 
 
 
+def gather_kb_rows(kb_encodings:np.ndarray, kb_rows:np.ndarray, trg_encoding_num):
+    # encodings of some KB rows, in the same layout: all first versions, then all second versions, ...
+    kb_size = kb_encodings.shape[0] // trg_encoding_num
+    return kb_encodings[(np.arange(trg_encoding_num)[:, None] * kb_size + kb_rows[None, :]).reshape(-1)]
+
+def rank_shortlist(test_data_encodings:np.ndarray, test_data_plain:list, shortlist:np.ndarray, encode_rows,
+                   kb_entity_string:list, similarity_calculator: Similarity, trg_encoding_num,
+                   use_exact_match=True, topk=100, chunk_size=1024):
+    '''
+    rank the shortlist of each query only, e.g. from a cascade or the n-gram prefilter
+    :param shortlist: KB rows of the candidates of each query, -1 for padding
+    :param encode_rows: sorted KB rows -> their encodings, all first versions, then all second versions, ...
+    :return: topk of each query among its shortlist, idx are rows of the whole KB
+    '''
+    limit = min(shortlist.shape[1], topk)
+    all_idx, all_scores = [], []
+    for st in range(0, shortlist.shape[0], chunk_size):
+        cur_shortlist = shortlist[st:st + chunk_size]
+        # candidates shared by queries of the chunk are scored once
+        rows = np.unique(cur_shortlist[cur_shortlist >= 0])
+        if len(rows) == 0:
+            all_idx.append(np.full((cur_shortlist.shape[0], limit), -1, dtype=np.int64))
+            all_scores.append(np.full((cur_shortlist.shape[0], limit), -np.inf, dtype=np.float32))
+            continue
+        with span("similarity"):
+            scores = similarity_calculator(test_data_encodings[st:st + chunk_size], encode_rows(rows), is_src_trg=True, split=True,
+                                           pieces=max(1, min(100, len(rows) // 1000)), negative_sample=None, encoding_num=trg_encoding_num)
+        if use_exact_match:
+            with span("exact_match"):
+                scores = exact_match(scores, test_data_plain[st:st + chunk_size], kb_entity_string, kb_rows=rows, kb_first=True)
+        with span("ranking"):
+            pos = np.minimum(np.searchsorted(rows, cur_shortlist), len(rows) - 1)
+            candidate_scores = np.where(cur_shortlist >= 0, np.take_along_axis(scores, pos, axis=1), -np.inf)
+            top_pos, top_scores = get_topk(candidate_scores, topk)
+        all_idx.append(np.take_along_axis(cur_shortlist, top_pos, axis=1))
+        all_scores.append(top_scores)
+    return np.vstack(all_idx), np.vstack(all_scores)
+
+def rank_kb(test_data_encodings:np.ndarray, test_data_plain:list,
+            kb_encodings:np.ndarray, kb_entity_string:list,
+            similarity_calculator: Similarity, trg_encoding_num, use_exact_match=True, kb_rows=None, pieces=100, topk=100):
+    '''
+    :param kb_rows: only score these (sorted) KB rows, e.g. one type partition, None for the whole KB
+    :return: topk of each query, idx are rows of the whole KB
+    '''
+    if kb_rows is not None:
+        kb_encodings = gather_kb_rows(kb_encodings, kb_rows, trg_encoding_num)
+    # split_kb_encodings = np.split(kb_encodings, trg_encoding_num, axis=0)
+    # kb_size = split_kb_encodings[0].shape[0]
+    # base_scores = np.zeros((tot, kb_size)) - 10000
+    # st_time = time.time()
+    # for cur_kb_encodings in split_kb_encodings:
+    with span("similarity"):
+        base_scores = similarity_calculator(test_data_encodings, kb_encodings,
+                                            is_src_trg=True, split=True, pieces=pieces, negative_sample=None, encoding_num=trg_encoding_num)
+    # calc exact match
+    if use_exact_match:
+        with span("exact_match"):
+            base_scores = exact_match(base_scores, test_data_plain, kb_entity_string, kb_rows=kb_rows)
+    print("[INFO] current score matrix shape: ", str(base_scores.shape))
+    with span("ranking"):
+        top_idx, top_scores = get_topk(base_scores, topk)
+    if kb_rows is not None:
+        top_idx = kb_rows[top_idx]
+    return top_idx, top_scores
+
+def rank_queries(test_data_encodings:np.ndarray, test_data_plain:list,
+                 kb_encodings:np.ndarray, kb_entity_string:list,
+                 intermediate_info:dict,
+                 method, similarity_calculator: Similarity,
+                 trg_encoding_num, mid_encoding_num, use_exact_match=True,
+                 query_types:list=None, type_index: TypeIndex=None, topk=100,
+                 shortlist:np.ndarray=None, shortlister=None, tiers=None):
+    '''
+    :param query_types: entity type of each query, with type_index a query only searches the KB entities of its type
+    :param shortlist: with shortlister (models/cascade.py, models/prefilter.py), only these KB rows of each query are ranked
+    :param tiers: if not None, queries are ranked against the popular entities first (see models/tiers.py)
+    :return: {"base": (top_idx, top_scores)}, plus "pivot" for the pivoting method where idx of pivot strings are shifted by the KB size
+    '''
+    pieces=100
+    kb_size = len(kb_entity_string)
+    if shortlister is not None:
+        ranked = {"base": shortlister.rerank(test_data_encodings, test_data_plain, shortlist, kb_encodings, kb_entity_string,
+                                         similarity_calculator, use_exact_match, topk)}
+    elif tiers is not None:
+        ranked = {"base": tiers.rank(test_data_encodings, test_data_plain, kb_encodings, kb_entity_string,
+                                     similarity_calculator, trg_encoding_num, use_exact_match, topk)}
+    elif type_index is None or query_types is None:
+        ranked = {"base": rank_kb(test_data_encodings, test_data_plain, kb_encodings, kb_entity_string,
+                                  similarity_calculator, trg_encoding_num, use_exact_match, pieces=pieces, topk=topk)}
+    else:
+        # queries are scored group by group, partitions smaller than topk leave -1 at the end of the list
+        limit = min(kb_size, topk)
+        top_idx = np.full((len(test_data_plain), limit), -1, dtype=np.int64)
+        top_scores = np.full((len(test_data_plain), limit), -np.inf, dtype=np.float32)
+        for query_idx, kb_rows in type_index.group_queries(query_types):
+            cur_idx, cur_scores = rank_kb(test_data_encodings[query_idx], [test_data_plain[i] for i in query_idx],
+                                          kb_encodings, kb_entity_string, similarity_calculator, trg_encoding_num,
+                                          use_exact_match, kb_rows=kb_rows, pieces=pieces, topk=topk)
+            top_idx[query_idx, :cur_idx.shape[1]] = cur_idx
+            top_scores[query_idx, :cur_idx.shape[1]] = cur_scores
+        ranked = {"base": (top_idx, top_scores)}
+
+    if method == "pivoting":
+        pivot_encodings = intermediate_info["encodings"]["pivot"]
+        with span("similarity"):
+            pivot_scores = similarity_calculator(test_data_encodings, pivot_encodings,
+                                                 is_src_trg=False, split=True, pieces=pieces, negative_sample=None, encoding_num=mid_encoding_num)
+        # exact match, a query that matches a KB title is already boosted in the base topk
+        if use_exact_match:
+            kb_matched = ranked["base"][1][:, 0] >= 1000.0
+            with span("exact_match"):
+                pivot_scores = exact_match(pivot_scores, test_data_plain, intermediate_info["plain_text"]["pivot"], skip=kb_matched)
+        # topk of the pivot side, merged with the base topk
+        print("[INFO] current score matrix shape: ", str(pivot_scores.shape))
+        with span("ranking"):
+            pivot_top_idx, pivot_top_scores = get_topk(pivot_scores)
+            ranked["pivot"] = merge_topk(*ranked["base"], pivot_top_idx, pivot_top_scores, kb_size)
+    return ranked
+
+def get_query_keys(test_data_plain:list, test_data_types:list=None):
+    # the same mention with another type searches another partition
+    return test_data_plain if test_data_types is None else list(zip(test_data_plain, test_data_types))
+
+def dedup_queries(test_data_plain:list, test_data_types:list=None, result_cache: QueryResultCache=None, fast_path=None):
+    '''
+    :param fast_path: if not None, queries it answers (see models/fast_path.py) are not ranked
+    :return: idx of the first occurrence of each unique query that is not cached, and the cached results
+    '''
+    query_keys = get_query_keys(test_data_plain, test_data_types)
+    first_idx = {}
+    for i, key in enumerate(query_keys):
+        first_idx.setdefault(key, i)
+    cached = result_cache.get_many(list(first_idx.keys())) if result_cache is not None else {}
+    if fast_path is not None:
+        uncached = [(key, i) for key, i in first_idx.items() if key not in cached]
+        answered = fast_path.answer([test_data_plain[i] for _, i in uncached])
+        for key, i in uncached:
+            if test_data_plain[i] in answered:
+                cached[key] = answered[test_data_plain[i]]
+    todo_idx = [i for key, i in first_idx.items() if key not in cached]
+    print("[INFO] {} queries, {} unique, {} to rank".format(len(query_keys), len(first_idx), len(todo_idx)))
+    return todo_idx, cached
+
+def stack_rows(rows:list, fill):
+    # rows of different length (e.g. direct answers of the fast path) are padded with fill
+    width = max(len(x) for x in rows)
+    stacked = np.full((len(rows), width), fill, dtype=rows[0].dtype)
+    for i, x in enumerate(rows):
+        stacked[i, :len(x)] = x
+    return stacked
+
+def rank_unique_queries(todo_encodings:np.ndarray, test_data_plain:list, test_data_types:list, todo_idx:list, cached:dict,
+                        result_cache: QueryResultCache, *rank_args, rank_chunk_size=0, **rank_kwargs):
+    '''
+    rank the queries in todo_idx (see rank_queries for rank_args) and fan the results out to every occurrence of each query
+    :param rank_chunk_size: if not 0, queries are ranked this many at a time, which bounds the size of the score matrices
+    '''
+    query_keys = get_query_keys(test_data_plain, test_data_types)
+    shortlist = rank_kwargs.pop("shortlist", None)
+    results = dict(cached)
+    if len(todo_idx) != 0:
+        todo_plain = [test_data_plain[i] for i in todo_idx]
+        todo_types = [test_data_types[i] for i in todo_idx] if test_data_types is not None else None
+        todo_shortlist = shortlist[todo_idx] if shortlist is not None else None
+        chunk_size = rank_chunk_size if rank_chunk_size > 0 else len(todo_idx)
+        new_results = {}
+        for st in range(0, len(todo_idx), chunk_size):
+            ed = st + chunk_size
+            ranked = rank_queries(todo_encodings[st:ed], todo_plain[st:ed], *rank_args,
+                                  query_types=todo_types[st:ed] if todo_types is not None else None,
+                                  shortlist=todo_shortlist[st:ed] if todo_shortlist is not None else None, **rank_kwargs)
+            new_results.update({query_keys[i]: {name: (top_idx[j], top_scores[j]) for name, (top_idx, top_scores) in ranked.items()}
+                                for j, i in enumerate(todo_idx[st:ed])})
+        if result_cache is not None:
+            result_cache.put_many(new_results)
+        results.update(new_results)
+    if len(query_keys) == 0:
+        # an empty test file or chunk, "pivot" is only read with the pivoting method
+        return {name: (np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0), dtype=np.float32)) for name in ["base", "pivot"]}
+    names = results[query_keys[0]].keys()
+    return {name: (stack_rows([results[x][name][0] for x in query_keys], -1),
+                   stack_rows([results[x][name][1] for x in query_keys], -np.inf)) for name in names}
+
+def get_pivot_kb(kb_ids, kb_entity_string, intermediate_info):
+    # ids and strings of the KB followed by the pivot strings, the idx space of ranked["pivot"]
+    pivot_kb_ids = np.concatenate([kb_ids, intermediate_info["kb_id"]["pivot"]])
+    pivot_kb_entity_string = ConcatStrings([kb_entity_string, intermediate_info["plain_text"]["pivot"]])
+    return pivot_kb_ids, pivot_kb_entity_string
+
+def print_recall(title, recall_dict, tot):
+    print("==============={}===============".format(title))
+    for topk, recall in recall_dict.items():
+        print("[INFO] top {}: {:.2f}/{:.2f}={:.4f}".format(topk, recall, tot, recall / tot if tot != 0 else 0.0))
+
 def calc_result(test_data_encodings:np.ndarray, test_gold_kb_ids:np.ndarray, test_data_plain:list,
                 kb_encodings:np.ndarray, kb_ids:np.ndarray, kb_entity_string:list,
                 intermediate_info:dict,
                 method, similarity_calculator: Similarity,
                 save_files:dict, trg_encoding_num, mid_encoding_num, topk_list = (1, 2, 5, 10, 30),
-                record_recall=False, use_exact_match=True):
-    pieces=100
+                record_recall=False, use_exact_match=True, result_cache: QueryResultCache=None,
+                test_data_types:list=None, type_index: TypeIndex=None, shortlist:np.ndarray=None, shortlister=None, tiers=None,
+                fast_path=None, rank_chunk_size=0):
     # no pivoting, base method
     tot = float(test_data_encodings.shape[0])
+    todo_idx, cached = dedup_queries(test_data_plain, test_data_types, result_cache, fast_path)
+    ranked = rank_unique_queries(test_data_encodings[todo_idx], test_data_plain, test_data_types, todo_idx, cached, result_cache,
+                                 kb_encodings, kb_entity_string, intermediate_info,
+                                 method, similarity_calculator, trg_encoding_num, mid_encoding_num, use_exact_match,
+                                 type_index=type_index, shortlist=shortlist, shortlister=shortlister, tiers=tiers,
+                                 rank_chunk_size=rank_chunk_size)
     # base method
     base_recall = {str(topk):0 for topk in topk_list}
     base_result_file = open(save_files["no_pivot"], "w+", encoding="utf-8")
     base_result_string_file = open(save_files["no_pivot_str"], "w+", encoding="utf-8")
     base_files = [base_result_file, base_result_string_file]
-
-    # split_kb_encodings = np.split(kb_encodings, trg_encoding_num, axis=0)
-    # kb_size = split_kb_encodings[0].shape[0]
-    # base_scores = np.zeros((tot, kb_size)) - 10000
-    # st_time = time.time()
-    # for cur_kb_encodings in split_kb_encodings:
-    base_scores = similarity_calculator(test_data_encodings, kb_encodings,
-                                        is_src_trg=True, split=True, pieces=pieces, negative_sample=None, encoding_num=trg_encoding_num)
-    # calc exact match
-    if use_exact_match:
-        base_scores = exact_match(base_scores, test_data_plain, kb_entity_string)
-    calc_scores(base_scores, test_data_plain, test_gold_kb_ids, kb_ids, kb_entity_string, base_files, record_recall, base_recall, topk_list)
-
-    print("===============encoding recall===============")
-    for topk, recall in base_recall.items():
-        print("[INFO] top {}: {:.2f}/{:.2f}={:.4f}".format(topk, recall, tot, recall / tot))
-
+    record_topk(*ranked["base"], test_data_plain, test_gold_kb_ids, kb_ids, kb_entity_string,
+                base_files, record_recall, base_recall, topk_list)
+    print_recall("encoding recall", base_recall, tot)
     close_file_list(base_files)
 
     if method == "pivoting":
         pivot_recall = {str(topk):0 for topk in topk_list}
-        pivot_encodings = intermediate_info["encodings"]["pivot"]
-        pivot_kb_ids = intermediate_info["kb_id"]["pivot"]
-        pivot_kb_ids = np.concatenate([kb_ids, pivot_kb_ids])
-
-        pivot_kb_entity_string = intermediate_info["plain_text"]["pivot"]
-        pivot_kb_entity_string = kb_entity_string + pivot_kb_entity_string
+        pivot_kb_ids, pivot_kb_entity_string = get_pivot_kb(kb_ids, kb_entity_string, intermediate_info)
 
         pivot_result_file = open(save_files["pivot"], "w+", encoding="utf-8")
         pivot_result_string_file = open(save_files["pivot_str"], "w+", encoding="utf-8")
         pivot_files = [pivot_result_file, pivot_result_string_file]
+        record_topk(*ranked["pivot"], test_data_plain, test_gold_kb_ids, pivot_kb_ids, pivot_kb_entity_string,
+                    pivot_files, record_recall, pivot_recall, topk_list)
+        print_recall("pivoting recall", pivot_recall, tot)
+        close_file_list(pivot_files)
 
-        pivot_scores = similarity_calculator(test_data_encodings, pivot_encodings,
-                                             is_src_trg=False, split=True, pieces=pieces, negative_sample=None, encoding_num=mid_encoding_num)
-        combined_scores = np.hstack([base_scores, pivot_scores])
-        # exact match
-        if use_exact_match:
-            combined_scores = exact_match(combined_scores, test_data_plain, pivot_kb_entity_string)
-        calc_scores(combined_scores, test_data_plain, test_gold_kb_ids, pivot_kb_ids, pivot_kb_entity_string, pivot_files, record_recall, pivot_recall, topk_list)
-
-        print("===============pivoting recall===============")
-        for topk, recall in pivot_recall.items():
-            print("[INFO] top {}: {:.2f}/{:.2f}={:.4f}".format(topk, recall, tot, recall / tot))
+def read_query_chunks(data_loader: BaseDataLoader, chunk_size):
+    '''
+    read the test file of data_loader chunk by chunk
+    :return: a generator of (side data, gold kb ids, plain text, entity types or None) of each chunk
+    '''
+    test_file = data_loader.test_file
+    entries = data_loader.load_data(test_file.src_file_name, test_file.src_str_idx, test_file.src_id_idx,
+                                    is_src=True, encoding_num=1, type_idx=None)
+    with open(test_file.src_file_name, "r", encoding="utf-8") as f:
+        lines = (line.strip().split(" ||| ") for line in f)
+        while True:
+            chunk = list(itertools.islice(zip(entries, lines), chunk_size))
+            if len(chunk) == 0:
+                break
+            side_data = [x for x, _ in chunk]
+            if data_loader.n_gram_threshold != 0:
+                side_data = data_loader.n_gram_filter(side_data, data_loader.src_freq_map)
+            gold_kb_ids = np.array([int(tks[test_file.src_id_idx]) for _, tks in chunk])
+            plain_text = [tks[test_file.src_str_idx] for _, tks in chunk]
+            entity_types = [tks[test_file.src_type_idx] if test_file.src_type_idx < len(tks) else NO_TYPE for _, tks in chunk] \
+                if test_file.src_type_idx >= 0 else None
+            yield side_data, gold_kb_ids, plain_text, entity_types
+
+def eval_query_stream(model: Encoder, test_data_loader: BaseDataLoader, encoding_cache: EncodingCache,
+                      kb_encodings:np.ndarray, kb_ids:np.ndarray, kb_entity_string:list,
+                      intermediate_info:dict, method, similarity_calculator: Similarity,
+                      save_files:dict, trg_encoding_num, mid_encoding_num, chunk_size,
+                      topk_list=(1, 2, 5, 10, 30), record_recall=False, use_exact_match=True, result_cache: QueryResultCache=None,
+                      type_index: TypeIndex=None, shortlister=None, tiers=None, fast_path=None):
+    '''
+    the test file is processed chunk by chunk, encoding, scoring/ranking and writing of different chunks overlap
+    results of each chunk are written as soon as it is ranked, memory does not grow with the size of the test file
+    '''
+    def encode(chunk):
+        side_data, gold_kb_ids, plain_text, entity_types, shortlist = chunk
+        # only unique queries without cached results are encoded and ranked
+        todo_idx, cached = dedup_queries(plain_text, entity_types, result_cache, fast_path)
+        # no_grad is thread local
+        with torch.no_grad():
+            encodings = encode_side_data(model, test_data_loader, [side_data[i] for i in todo_idx], encoding_cache,
+                                         is_src=True, is_mid=False, encoding_num=1) if len(todo_idx) != 0 else None
+        return encodings, todo_idx, cached, gold_kb_ids, plain_text, entity_types, shortlist
+
+    def rank(chunk):
+        encodings, todo_idx, cached, gold_kb_ids, plain_text, entity_types, shortlist = chunk
+        with torch.no_grad():
+            ranked = rank_unique_queries(encodings, plain_text, entity_types, todo_idx, cached, result_cache,
+                                         kb_encodings, kb_entity_string, intermediate_info,
+                                         method, similarity_calculator, trg_encoding_num, mid_encoding_num, use_exact_match,
+                                         type_index=type_index, shortlist=shortlist, shortlister=shortlister, tiers=tiers)
+        return ranked, gold_kb_ids, plain_text
 
+    base_recall = {str(topk):0 for topk in topk_list}
+    base_files = [open(save_files["no_pivot"], "w+", encoding="utf-8"), open(save_files["no_pivot_str"], "w+", encoding="utf-8")]
+    if method == "pivoting":
+        pivot_recall = {str(topk): 0 for topk in topk_list}
+        pivot_files = [open(save_files["pivot"], "w+", encoding="utf-8"), open(save_files["pivot_str"], "w+", encoding="utf-8")]
+        pivot_kb_ids, pivot_kb_entity_string = get_pivot_kb(kb_ids, kb_entity_string, intermediate_info)
+    chunks = read_query_chunks(test_data_loader, chunk_size)
+    if shortlister is not None:
+        # the shortlister reads the test file in the same chunks
+        chunks = zip(chunks, shortlister.shortlist_chunks(test_data_loader.test_file, chunk_size, type_index))
+        chunks = (chunk + (shortlist,) for chunk, shortlist in chunks)
+    else:
+        chunks = (chunk + (None,) for chunk in chunks)
+    tot = 0
+    for ranked, gold_kb_ids, plain_text in run_pipeline(chunks, [encode, rank]):
+        record_topk(*ranked["base"], plain_text, gold_kb_ids, kb_ids, kb_entity_string,
+                    base_files, record_recall, base_recall, topk_list)
+        if method == "pivoting":
+            record_topk(*ranked["pivot"], plain_text, gold_kb_ids, pivot_kb_ids, pivot_kb_entity_string,
+                        pivot_files, record_recall, pivot_recall, topk_list)
+        tot += len(plain_text)
+        print("[INFO] done {} queries".format(tot))
+
+    tot = float(tot)
+    print_recall("encoding recall", base_recall, tot)
+    close_file_list(base_files)
+    if method == "pivoting":
+        print_recall("pivoting recall", pivot_recall, tot)
         close_file_list(pivot_files)
 
-def get_kb_id(fname, str_idx, id_idx):
+@traced("load_data")
+def get_kb_id(fname, str_idx, id_idx, compact=False):
+    # compact: the strings are returned as an mmap-ed StringTable instead of a list, used for the KB
+    if compact:
+        return load_string_column(fname, str_idx, id_idx)
     gold_kb_id = []
     plain_text = []
     with open(fname, "r", encoding="utf-8") as f:
@@ -139,17 +437,81 @@ def get_kb_id(fname, str_idx, id_idx):
     gold_kb_id = np.array(gold_kb_id)
     return gold_kb_id, plain_text
 
-def get_encodings(model: Encoder, data_loader: BaseDataLoader, load_encoding: bool, save_file, is_src, is_mid, encoding_num):
-    if not load_encoding:
+def encode_unmatched(model: Encoder, data_loader: BaseDataLoader, encoding_cache: EncodingCache, fast_path):
+    '''
+    encode the test queries that the fast path does not answer, rows of the answered ones are left 0 and never used
+    :return: the same as get_encodings
+    '''
+    test_file = data_loader.test_file
+    gold_kb_id, data_plain = get_kb_id(test_file.src_file_name, test_file.src_str_idx, test_file.src_id_idx)
+    todo_idx = np.nonzero(fast_path.match(data_plain) == -1)[0]
+    side_data = data_loader.get_test_data(is_src=True, is_mid=False)
+    todo_encodings = encode_side_data(model, data_loader, [side_data[i] for i in todo_idx], encoding_cache,
+                                      is_src=True, is_mid=False, encoding_num=1) if len(todo_idx) != 0 else np.zeros((0, 1))
+    encodings = np.zeros((len(data_plain), todo_encodings.shape[1]), dtype=np.float32)
+    encodings[todo_idx] = todo_encodings
+    return encodings, gold_kb_id, data_plain
+
+def encode_with_cache(model: Encoder, data_loader: BaseDataLoader, encoding_cache: EncodingCache, is_src, is_mid, encoding_num):
+    return encode_side_data(model, data_loader, data_loader.get_test_data(is_src, is_mid), encoding_cache, is_src, is_mid, encoding_num)
+
+def encode_side_data(model: Encoder, data_loader: BaseDataLoader, side_data: list, encoding_cache: EncodingCache, is_src, is_mid, encoding_num):
+    # encode each unique string once and only if it is not in the cache
+    side = "mid" if is_mid else ("src" if is_src else "trg")
+    start_time = time.time()
+    # the same order as encodings from batches, all first versions, then all second versions, ...
+    seqs = [entry[0][0][v] for v in range(encoding_num) for entry in side_data]
+    unique_keys, first_idx, inverse = np.unique([hash_sequence(x) for x in seqs], return_index=True, return_inverse=True)
+    unique_keys = unique_keys.tolist()
+    found = encoding_cache.get(side, unique_keys)
+    missing = np.array([i for i, x in enumerate(found) if x is None], dtype=np.int64)
+    print("[INFO] {} strings, {} unique, {} not cached".format(len(seqs), len(unique_keys), len(missing)))
+    # one encoding of each unique string, cached and new encodings are written into it directly
+    unique_encodings = None
+    cached = [i for i, x in enumerate(found) if x is not None]
+    if len(cached) != 0:
+        unique_encodings = np.empty((len(unique_keys), len(found[cached[0]])), dtype=np.float32)
+        for i in cached:
+            unique_encodings[i] = found[i]
+    found = None
+    batches = []
+    if len(missing) != 0:
+        batches = data_loader.create_sequence_batches([seqs[first_idx[i]] for i in missing], is_src, is_mid)
+        start = 0
+        with span("encoding"):
+            for batch in batches:
+                cur_encodings = np.array(model.calc_encode(batch, is_src=is_src, is_mid=is_mid).cpu())
+                if unique_encodings is None:
+                    unique_encodings = np.empty((len(unique_keys), cur_encodings.shape[1]), dtype=np.float32)
+                unique_encodings[missing[start:start + len(cur_encodings)]] = cur_encodings
+                start += len(cur_encodings)
+        # no copy if nothing was cached
+        new_encodings = unique_encodings if len(missing) == len(unique_keys) else unique_encodings[missing]
+        encoding_cache.put(side, [unique_keys[i] for i in missing], new_encodings)
+        new_encodings = None
+    if unique_encodings is None:
+        # an empty test file or chunk
+        unique_encodings = np.zeros((0, encoding_dim(model, data_loader)), dtype=np.float32)
+    encodings = unique_encodings[inverse.reshape(-1)]
+    print("[INFO] encoding shape: {}".format(str(encodings.shape)))
+    print("[INFO] done {} batches, using {:.2f} seconds".format(len(batches), time.time() - start_time))
+    return encodings
+
+def get_encodings(model: Encoder, data_loader: BaseDataLoader, load_encoding: bool, save_file, is_src, is_mid, encoding_num,
+                  encoding_cache: EncodingCache=None):
+    if not load_encoding and encoding_cache is not None:
+        encodings = encode_with_cache(model, data_loader, encoding_cache, is_src, is_mid, encoding_num)
+    elif not load_encoding:
         batches = data_loader.create_batches("test", is_src=is_src, is_mid=is_mid)
         # encodings = np.empty((0, encoder.hidden_size*2))
         encodings = [[] for _ in range(encoding_num)]
         start_time = time.time()
-        for idx, batch in enumerate(batches):
-            if (idx + 1) % 10000 == 0:
-                print("[INFO] process {} batches, using {:.2f} seconds".format(idx + 1, time.time() - start_time))
-            cur_encodings = np.array(model.calc_encode(batch, is_src=is_src, is_mid=is_mid).cpu())
-            append_multiple_encodings(encodings, cur_encodings, encoding_num)
+        with span("encoding"):
+            for idx, batch in enumerate(batches):
+                if (idx + 1) % 10000 == 0:
+                    print("[INFO] process {} batches, using {:.2f} seconds".format(idx + 1, time.time() - start_time))
+                cur_encodings = np.array(model.calc_encode(batch, is_src=is_src, is_mid=is_mid).cpu())
+                append_multiple_encodings(encodings, cur_encodings, encoding_num)
         encodings = list2nparr(encodings, model.hidden_size, merge=True)
         print("[INFO] encoding shape: {}".format(str(encodings.shape)))
         print("[INFO] done all {} batches, using {:.2f} seconds".format(len(batches), time.time() - start_time))
@@ -172,7 +534,7 @@ def get_encodings(model: Encoder, data_loader: BaseDataLoader, load_encoding: bo
         else:
             kb_ids, data_plain = get_kb_id(data_loader.test_file.trg_file_name,
                                            data_loader.test_file.trg_str_idx,
-                                           data_loader.test_file.trg_id_idx)
+                                           data_loader.test_file.trg_id_idx, compact=True)
 
     assert kb_ids.shape[0] == int(encodings.shape[0] / encoding_num) \
            and len(data_plain) == int(encodings.shape[0] / encoding_num), \
@@ -181,8 +543,32 @@ def get_encodings(model: Encoder, data_loader: BaseDataLoader, load_encoding: bo
     return encodings, kb_ids, data_plain
 
 
+def plan_memory(memory_plan: MemoryPlan, model: Encoder, base_data_loader: BaseDataLoader, intermediate_stuff, extra_runs, kb_index,
+                method, trg_encoding_num, mid_encoding_num, query_chunk_size, shortlister=None, projection=None):
+    '''
+    the sizes eval_dataset works with, from the files before they are encoded (see MemoryPlan.plan)
+    :return: the number of queries to rank at once, 0 for all of them
+    '''
+    kb_size = len(kb_index.live_rows()[0]) if kb_index is not None else count_lines(base_data_loader.test_file.trg_file_name)
+    query_num = max(count_lines(x.test_file.src_file_name) for x in [base_data_loader] + [run[0] for run in extra_runs])
+    # intermediate files shared by several test files are encoded once and kept until the end
+    pivot_files = set()
+    if method != "base":
+        for stuff in [intermediate_stuff] + [run[1] for run in extra_runs]:
+            pivot_files.update((x[1].get_test_data_file(x[4], x[5]), x[4], x[5]) for x in stuff)
+    pivot_size = sum(count_lines(x[0]) for x in pivot_files)
+    dim = encoding_dim(model, base_data_loader)
+    # a cascade encodes the shortlisted entities only, a projected KB is kept in fewer dimensions (and in full for the report)
+    kb_rows = 0 if shortlister is not None and not shortlister.encodes_kb else kb_size
+    kb_dim = dim
+    if projection is not None and projection.dim > 0:
+        kb_dim = projection.dim + (dim if projection.report_dims else 0)
+    return memory_plan.plan(kb_size, query_num, pivot_size, dim, trg_encoding_num, mid_encoding_num, method, query_chunk_size,
+                            kb_rows=kb_rows, kb_dim=kb_dim)
+
 # intermediate_stuff contains arguments from pivoting et al
 # method, pivoting et al
+@traced("eval")
 def eval_dataset(model:Encoder, similarity_calculator: Similarity,
                  base_data_loader:BaseDataLoader,
                  encoded_test_file, load_encoded_test,
@@ -192,33 +578,139 @@ def eval_dataset(model:Encoder, similarity_calculator: Similarity,
                  trg_encoding_num,
                  mid_encoding_num,
                  result_files:dict,
-                 record_recall: bool):
+                 record_recall: bool,
+                 encoding_cache: EncodingCache=None,
+                 extra_runs=(),
+                 query_chunk_size=0,
+                 result_cache: QueryResultCache=None,
+                 shortlister=None,
+                 tiers=None,
+                 fast_path=None,
+                 kb_index=None,
+                 projection=None,
+                 memory_plan: MemoryPlan=None):
+    '''
+    :param extra_runs: (test data loader, intermediate_stuff, result_files) of more test files, e.g. other test languages.
+    they are evaluated against the same KB encodings
+    :param query_chunk_size: if not 0, test files are streamed through eval_query_stream in chunks of this size
+    :param shortlister: if not None, only the shortlist of each query is ranked (models/cascade.py, models/prefilter.py),
+    the KB is not encoded by model if the shortlister encodes its candidates itself
+    :param tiers: if not None, queries are ranked against popular entities first and escalate to the others when not confident
+    :param fast_path: if not None, mentions that match one KB title or alias are answered directly without encoding
+    :param kb_index: if not None, the KB encodings are taken from this updatable index (models/kb_index.py) instead of encoding the KB file
+    :param projection: if not None, the KB is kept in fewer dimensions (models/projection.py), queries are projected when scored against it
+    :param memory_plan: if not None, the peak memory of each stage is estimated before the KB is encoded and reported at the end,
+    with a budget the queries are ranked in chunks that fit in it (models/memory_plan.py)
+    '''
     with torch.no_grad():
         model.eval()
         model.to(device)
-        encoded_test, test_gold_kb_id, test_data_plain = get_encodings(model, base_data_loader, load_encoded_test, encoded_test_file, is_src=True, is_mid=False, encoding_num=1)
-        encoded_kb, kb_ids, kb_entity_string = get_encodings(model, base_data_loader, load_encoded_kb, encoded_kb_file, is_src=False, is_mid=False, encoding_num=trg_encoding_num)
-        intermediate_info = {}
-        if method != "base":
-            intermediate_encodings = {}
-            intermediate_kb_id = {}
-            intermediate_plain_text = {}
-            for stuff in intermediate_stuff:
-                # name is used to present the contain of this intermediate stuff
-                name, data_loader, encoded_file, load_encoded, is_src, is_mid = stuff
-                encoded_stuff, gold_kb_id, plain_text = get_encodings(model, data_loader, load_encoded, encoded_file, is_src=is_src, is_mid=is_mid, encoding_num=mid_encoding_num)
-                intermediate_encodings[name] = encoded_stuff
-                intermediate_kb_id[name] = gold_kb_id
-                intermediate_plain_text[name] = plain_text
-            intermediate_info["encodings"] = intermediate_encodings
-            intermediate_info["kb_id"] = intermediate_kb_id
-            intermediate_info["plain_text"] = intermediate_plain_text
-        start_time = time.time()
-        calc_result(encoded_test, test_gold_kb_id, test_data_plain,
-                    encoded_kb, kb_ids, kb_entity_string,
-                    intermediate_info, method, similarity_calculator, result_files, trg_encoding_num, mid_encoding_num, record_recall=record_recall)
-
-        print("[INFO] take {:.4f}s to calculate similarity".format(time.time() - start_time))
+        rank_chunk_size = 0
+        if memory_plan is not None:
+            rank_chunk_size = plan_memory(memory_plan, model, base_data_loader, intermediate_stuff, extra_runs, kb_index, method,
+                                          trg_encoding_num, mid_encoding_num, query_chunk_size, shortlister, projection)
+            # streamed queries are ranked chunk by chunk already
+            if query_chunk_size > 0 and rank_chunk_size > 0:
+                query_chunk_size = rank_chunk_size
+        with memory_stage(memory_plan, "encode_kb"):
+            if shortlister is not None and not shortlister.encodes_kb:
+                encoded_kb = None
+                kb_ids, kb_entity_string = get_kb_id(base_data_loader.test_file.trg_file_name, base_data_loader.test_file.trg_str_idx,
+                                                     base_data_loader.test_file.trg_id_idx, compact=True)
+            elif kb_index is not None:
+                encoded_kb, kb_ids, kb_entity_string = kb_index.view()
+                if kb_index.compact_after_view:
+                    # queries are ranked against the view while the segments are merged
+                    kb_index.compact_in_background()
+            else:
+                encoded_kb, kb_ids, kb_entity_string = get_encodings(model, base_data_loader, load_encoded_kb, encoded_kb_file, is_src=False, is_mid=False, encoding_num=trg_encoding_num,
+                                                                     encoding_cache=encoding_cache)
+            full_kb, full_similarity = None, similarity_calculator
+            if projection is not None:
+                projection.fit(encoded_kb, similarity_calculator)
+                # the full KB is only kept for the recall report
+                full_kb = encoded_kb if projection.report_dims else None
+                if projection.dim > 0:
+                    similarity_calculator, encoded_kb = projection.reduce(encoded_kb, similarity_calculator, projection.dim)
+        # with the type of each mention (--test_type_idx), mentions only search the KB entities of the same type
+        type_index = load_type_index(base_data_loader.test_file.trg_file_name, base_data_loader.test_file.trg_type_idx) \
+            if base_data_loader.test_file.src_type_idx >= 0 else None
+        runs = [(base_data_loader, intermediate_stuff, result_files, encoded_test_file, load_encoded_test)]
+        runs += [(data_loader, stuff, files, "", False) for data_loader, stuff, files in extra_runs]
+        # intermediate files (e.g. pivot) shared by several runs are encoded once
+        encoded_intermediate = {}
+        for test_data_loader, cur_intermediate_stuff, cur_result_files, cur_encoded_test_file, cur_load_encoded_test in runs:
+            if len(runs) > 1:
+                print("[INFO] evaluate {}".format(test_data_loader.test_file.src_file_name))
+            intermediate_info = {}
+            if method != "base":
+                intermediate_encodings = {}
+                intermediate_kb_id = {}
+                intermediate_plain_text = {}
+                for stuff in cur_intermediate_stuff:
+                    # name is used to present the contain of this intermediate stuff
+                    name, data_loader, encoded_file, load_encoded, is_src, is_mid = stuff
+                    key = (data_loader.get_test_data_file(is_src, is_mid), is_src, is_mid)
+                    if key not in encoded_intermediate:
+                        with memory_stage(memory_plan, "encode_pivot"):
+                            encoded_intermediate[key] = get_encodings(model, data_loader, load_encoded, encoded_file, is_src=is_src, is_mid=is_mid, encoding_num=mid_encoding_num,
+                                                                      encoding_cache=encoding_cache)
+                            if projection is not None and projection.dim > 0:
+                                # pivot strings are scored in the projected space of the KB, their scores are merged with the KB scores
+                                encoded_stuff, gold_kb_id, plain_text = encoded_intermediate[key]
+                                encoded_intermediate[key] = similarity_calculator.project_trg(encoded_stuff), gold_kb_id, plain_text
+                    encoded_stuff, gold_kb_id, plain_text = encoded_intermediate[key]
+                    intermediate_encodings[name] = encoded_stuff
+                    intermediate_kb_id[name] = gold_kb_id
+                    intermediate_plain_text[name] = plain_text
+                intermediate_info["encodings"] = intermediate_encodings
+                intermediate_info["kb_id"] = intermediate_kb_id
+                intermediate_info["plain_text"] = intermediate_plain_text
+            start_time = time.time()
+            if result_cache is not None:
+                result_cache.set_context([x[1].get_test_data_file(x[4], x[5]) for x in cur_intermediate_stuff] if method != "base" else [])
+            if query_chunk_size > 0:
+                # queries are encoded in the chunks they are ranked in
+                with memory_stage(memory_plan, "rank"):
+                    eval_query_stream(model, test_data_loader, encoding_cache,
+                                      encoded_kb, kb_ids, kb_entity_string,
+                                      intermediate_info, method, similarity_calculator, cur_result_files, trg_encoding_num, mid_encoding_num,
+                                      query_chunk_size, record_recall=record_recall, result_cache=result_cache, type_index=type_index,
+                                      shortlister=shortlister, tiers=tiers, fast_path=fast_path)
+            else:
+                with memory_stage(memory_plan, "encode_queries"):
+                    if fast_path is not None and not cur_load_encoded_test:
+                        encoded_test, test_gold_kb_id, test_data_plain = encode_unmatched(model, test_data_loader, encoding_cache, fast_path)
+                    else:
+                        encoded_test, test_gold_kb_id, test_data_plain = get_encodings(model, test_data_loader, cur_load_encoded_test, cur_encoded_test_file, is_src=True, is_mid=False, encoding_num=1,
+                                                                                       encoding_cache=encoding_cache)
+                if full_kb is not None:
+                    projection.report(encoded_test, test_gold_kb_id, test_data_plain, full_kb, kb_ids, kb_entity_string,
+                                      full_similarity, trg_encoding_num)
+                test_file = test_data_loader.test_file
+                test_data_types = read_type_column(test_file.src_file_name, test_file.src_type_idx) if test_file.src_type_idx >= 0 else None
+                shortlist = shortlister.shortlist_file(test_file, type_index) if shortlister is not None else None
+                with memory_stage(memory_plan, "rank"):
+                    calc_result(encoded_test, test_gold_kb_id, test_data_plain,
+                                encoded_kb, kb_ids, kb_entity_string,
+                                intermediate_info, method, similarity_calculator, cur_result_files, trg_encoding_num, mid_encoding_num, record_recall=record_recall,
+                                result_cache=result_cache, test_data_types=test_data_types, type_index=type_index,
+                                shortlist=shortlist, shortlister=shortlister, tiers=tiers, fast_path=fast_path,
+                                rank_chunk_size=rank_chunk_size)
+            if shortlister is not None:
+                shortlister.print_recall()
+            if tiers is not None:
+                tiers.print_stats(test_data_loader.test_file)
+            if fast_path is not None:
+                fast_path.print_stats()
+
+            print("[INFO] take {:.4f}s to calculate similarity".format(time.time() - start_time))
+        if encoding_cache is not None:
+            print("[INFO] encoding cache hit/miss: {}/{}".format(encoding_cache.hit, encoding_cache.miss))
+        if result_cache is not None:
+            print("[INFO] result cache hit/miss: {}/{}".format(result_cache.hit, result_cache.miss))
+        if memory_plan is not None:
+            memory_plan.report()
 
 # reset the pad embedding to 0 at test time
 def reset_unk_weight(model):
@@ -227,26 +719,67 @@ def reset_unk_weight(model):
             embed_size = param.shape[1]
             param[0] = torch.zeros((1, embed_size))
 
+def init_encoding_cache(args):
+    # without --encoding_cache_dir the cache only lives in memory, it still removes duplicate strings
+    return EncodingCache(checkpoint_hash(args) if args.encoding_cache_dir else "", args.encoding_cache_dir, args.encoding_cache_size)
+
+def init_result_cache(args):
+    # results depend on the checkpoint, the KB side (KB, alias and map files) and these settings
+    files = [checkpoint_file(args), args.kb_file, args.alia_file, args.map_file + "_trg" + KEY_SUFFIX]
+    if args.kb_index_dir:
+        files += [args.kb_diff_file]
+    if args.tier_sizes:
+        files += args.prior_file.split(",")
+    settings = (args.method, args.similarity_measure, args.trg_encoding_num, args.mid_encoding_num, args.n_gram_threshold,
+                args.test_type_idx, args.kb_type_idx, args.shortlist_size, args.shortlist_model_path, args.shortlist_epoch,
+                args.prefilter_size, args.prefilter_max_df, args.tier_sizes, args.tier_threshold,
+                args.fast_path, args.fast_path_min_prefix, args.kb_index_dir, args.projection_dim, args.inference_precision)
+    return QueryResultCache(args.result_cache_size, files, settings)
+
 def init_test(args, DataLoader):
     test_file = FileInfo()
-    test_file.set_src(args.test_file, args.test_str_idx, args.test_id_idx)
-    test_file.set_trg(args.kb_file, args.kb_str_idx, args.kb_id_idx, args.kb_type_idx)
+    test_file.set_src(args.test_file, args.test_str_idx, args.test_id_idx, stream=args.query_chunk_size > 0, type_idx=args.test_type_idx)
+    # with --kb_index_dir the KB is encoded by the index, it is not loaded here
+    if not args.kb_index_dir:
+        test_file.set_trg(args.kb_file, args.kb_str_idx, args.kb_id_idx, args.kb_type_idx)
     base_data_loader = DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=test_file)
+    intermediate_stuff = init_intermediate_stuff(args, DataLoader, args.intermediate_stuff)
+
+    return base_data_loader, intermediate_stuff
+
+def init_intermediate_stuff(args, DataLoader, all_stuff, loaded=None):
+    # loaded: data loaders that are already created, keyed by the file they load
+    loaded = {} if loaded is None else loaded
     intermediate_stuff = []
     if args.method != "base":
-        for stuff in args.intermediate_stuff:
+        for stuff in all_stuff:
             name, file_name, str_idx, id_idx, type_idx, encoded_file, load_encoded, is_src, is_mid = stuff
-            inter_file = FileInfo()
-            if is_mid:
-                inter_file.set_mid(file_name, str_idx, id_idx, type_idx)
-            else:
-                if is_src:
-                    inter_file.set_src(file_name, str_idx, id_idx)
+            key = (file_name, is_src, is_mid)
+            if key not in loaded:
+                inter_file = FileInfo()
+                if is_mid:
+                    inter_file.set_mid(file_name, str_idx, id_idx, type_idx)
                 else:
-                    inter_file.set_trg(file_name, str_idx, id_idx, type_idx)
-            inter_data_loader = DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=inter_file)
-            intermediate_stuff.append((name, inter_data_loader, encoded_file, load_encoded, is_src, is_mid))
-
-    return base_data_loader, intermediate_stuff
+                    if is_src:
+                        inter_file.set_src(file_name, str_idx, id_idx)
+                    else:
+                        inter_file.set_trg(file_name, str_idx, id_idx, type_idx)
+                loaded[key] = DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=inter_file)
+            intermediate_stuff.append((name, loaded[key], encoded_file, load_encoded, is_src, is_mid))
+    return intermediate_stuff
+
+def init_test_runs(args, DataLoader):
+    '''
+    data loaders of the test files after the first one (--test_file a,b,c), see eval_dataset
+    '''
+    runs = []
+    loaded = {}
+    for run in args.test_runs[1:]:
+        test_file = FileInfo()
+        test_file.set_src(run["test_file"], args.test_str_idx, args.test_id_idx, stream=args.query_chunk_size > 0, type_idx=args.test_type_idx)
+        test_data_loader = DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=test_file)
+        intermediate_stuff = init_intermediate_stuff(args, DataLoader, run["intermediate_stuff"], loaded)
+        runs.append((test_data_loader, intermediate_stuff, run["result_file"]))
+    return runs
 
 
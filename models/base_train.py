@@ -12,15 +12,20 @@ from utils.constant import RANDOM_SEED, PATIENT, EPOCH_CHECK, DEVICE, UPDATE_PAT
 from models.base_encoder import Encoder
 from data_loader.data_loader import BaseDataLoader, BaseBatch
 from utils.func import list2nparr, append_multiple_encodings, FileInfo
+from utils.trace import span, traced
 
 print = functools.partial(print, flush=True)
 device = DEVICE
 
 
-def calc_batch_loss(model, criterion, batch: BaseBatch, proportion, trg_encoding_num, mid_encoding_num):
+def calc_batch_loss(model, criterion, batch: BaseBatch, proportion, trg_encoding_num, mid_encoding_num, autocast=False):
     # src_tensor, src_lens, src_perm_idx, trg_tensor, trg_kb_id, trg_lens, trg_perm_idx
-    similarity, diff = model.calc_batch_similarity(batch, use_negative=True, use_mid=True,
-                                                   proportion=proportion, trg_encoding_num=trg_encoding_num, mid_encoding_num=mid_encoding_num)
+    # autocast: the encoders and the similarity run in bf16 (--train_precision bf16), the weights stay float32
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=autocast):
+        similarity, diff = model.calc_batch_similarity(batch, use_negative=True, use_mid=True,
+                                                       proportion=proportion, trg_encoding_num=trg_encoding_num, mid_encoding_num=mid_encoding_num)
+    # the loss is computed in float32
+    similarity = similarity.float()
     if diff is not None:
         loss = criterion(similarity) + diff
     else:
@@ -46,6 +51,7 @@ def merge_encodings(encoding1:List[np.ndarray], encoding2:List[np.ndarray]):
     return combined_encodings
 
 # evaluate the whole dataset
+@traced("eval")
 def eval_data(model: Encoder, train_batches:List[BaseBatch], dev_batches: List[BaseBatch], similarity_measure: Similarity, args_dict: dict):
     use_mid = args_dict["use_mid"]
     topk = args_dict["topk"]
@@ -155,6 +161,8 @@ def run(data_loader: BaseDataLoader, encoder: Encoder, criterion, optimizer: opt
         "trg_encoding_num": args.trg_encoding_num,
         "mid_encoding_num": args.mid_encoding_num
     }
+    if args.train_precision == "bf16":
+        print("[INFO] train with bf16 autocast, the loss and the weights are float32")
     # lr_decay = scheduler is not None
     # if lr_decay:
     #     print("[INFO] using learning rate decay")
@@ -173,22 +181,26 @@ def run(data_loader: BaseDataLoader, encoder: Encoder, criterion, optimizer: opt
         t = 0
         for idx, batch in enumerate(train_batches):
             optimizer.zero_grad()
-            cur_loss = calc_batch_loss(encoder, criterion, batch, args.mid_proportion, args.trg_encoding_num, args.mid_encoding_num)
-            train_loss += cur_loss.item()
-            cur_loss.backward()
+            with span("forward"):
+                cur_loss = calc_batch_loss(encoder, criterion, batch, args.mid_proportion, args.trg_encoding_num, args.mid_encoding_num,
+                                           autocast=args.train_precision == "bf16")
+                train_loss += cur_loss.item()
+            with span("backward"):
+                cur_loss.backward()
             # optimizer.step()
 
-            for p in list(filter(lambda p: p.grad is not None, encoder.parameters())):
-                t += p.grad.data.norm(2).item()
+            with span("optimizer_step"):
+                for p in list(filter(lambda p: p.grad is not None, encoder.parameters())):
+                    t += p.grad.data.norm(2).item()
 
-            torch.nn.utils.clip_grad_norm_(encoder.parameters(), max_norm=5)
-            optimizer.step()
+                torch.nn.utils.clip_grad_norm_(encoder.parameters(), max_norm=5)
+                optimizer.step()
 
-            if encoder.name == "bilstm":
-                # set all but forget gate bias to 0
-                reset_bias(encoder.src_lstm)
-                reset_bias(encoder.trg_lstm)
-                # pass
+                if encoder.name == "bilstm":
+                    # set all but forget gate bias to 0
+                    reset_bias(encoder.src_lstm)
+                    reset_bias(encoder.trg_lstm)
+                    # pass
             batch_num += 1
         print("[INFO] epoch {:d}: train loss={:.8f}, time={:.2f}".format(ep, train_loss / batch_num,
                                                                          time.time()-start_time))
@@ -205,12 +217,13 @@ def run(data_loader: BaseDataLoader, encoder: Encoder, criterion, optimizer: opt
                 recall, tot = eval_data(encoder, train_batches, dev_batches, similarity_measure, dev_arg_dict)
                 dev_pivot_acc = recall[0] / float(tot)
                 dev_encode_acc = recall[1] / float(tot)
-                if dev_encode_acc > best_accs["encode_acc"]:
-                    best_accs["encode_acc"] = dev_encode_acc
-                    best_accs["pivot_acc"] = dev_pivot_acc
-                    last_update = ep + 1
-                    save_model(encoder, ep + 1, train_loss / batch_num, optimizer, args.model_path + "_" + "best" + ".tar")
-                save_model(encoder, ep + 1, train_loss / batch_num, optimizer, args.model_path + "_" + "last" + ".tar")
+                with span("checkpoint"):
+                    if dev_encode_acc > best_accs["encode_acc"]:
+                        best_accs["encode_acc"] = dev_encode_acc
+                        best_accs["pivot_acc"] = dev_pivot_acc
+                        last_update = ep + 1
+                        save_model(encoder, ep + 1, train_loss / batch_num, optimizer, args.model_path + "_" + "best" + ".tar")
+                    save_model(encoder, ep + 1, train_loss / batch_num, optimizer, args.model_path + "_" + "last" + ".tar")
                 print("[INFO] epoch {:d}: encoding/pivoting dev acc={:.4f}/{:.4f}, time={:.2f}".format(
                                                                                             ep, dev_encode_acc, dev_pivot_acc,
                                                                                             time.time()-start_time))
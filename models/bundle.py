@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import warnings
+import importlib
+import functools
+import contextlib
+import torch
+import numpy as np
+from models.base_encoder import GraphEncoder
+from utils.similarity_calculator import Similarity
+from utils.encoding_cache import hash_file
+from utils.vocab import KEY_SUFFIX, ID_SUFFIX, COUNT_SUFFIX, compact_map_exists, convert_pickle_map
+
+print = functools.partial(print, flush=True)
+
+CONFIG = "config.json"
+WEIGHTS = "weights.npy"
+MAP_PREFIX = "map"
+KB_INDEX = "kb_index"
+SRC_GRAPH = "src_encoder.pt"
+TRG_GRAPH = "trg_encoder.pt"
+# --model -> module of models/ with its main(args), and its model class
+MODEL_MODULES = {"charagram": "charagram", "lstm": "lstm", "avg_lstm": "lstm", "charcnn": "charcnn"}
+MODEL_CLASSES = {"charagram": "Charagram", "lstm": "LSTMEncoder", "avg_lstm": "LSTMEncoder", "charcnn": "CharCNN"}
+# the parameters of the similarity, not part of the encoder graphs
+MATRICES = ("src_trg_bl", "src_mid_bl", "src_affine", "trg_affine")
+# parameters of the mid encoder, never used at test time
+MID_PREFIXES = ("mid_", "bias_mid")
+# parameters of the KB side encoder, not needed when the KB encodings are in the bundled KB index
+# (trg_affine is part of the similarity matrices, it is kept)
+TRG_PREFIXES = ("trg_lookup", "trg_lstm", "trg_conv1d_list", "bias_trg")
+
+
+def read_bundle_config(bundle_dir) -> dict:
+    with open(os.path.join(bundle_dir, CONFIG), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def checkpoint_file(args):
+    # the file that identifies the weights for the result cache: the checkpoint, or the config of the bundle
+    if args.bundle_dir:
+        return os.path.join(args.bundle_dir, CONFIG)
+    return args.model_path + "_" + str(args.test_epoch) + ".tar"
+
+
+def checkpoint_hash(args):
+    # a bundle keeps the hash of the checkpoint it is exported from, encodings cached or indexed for it stay valid
+    checkpoint = read_bundle_config(args.bundle_dir)["checkpoint"] if args.bundle_dir else hash_file(checkpoint_file(args))
+    # encodings of another --inference_precision are not the same
+    return checkpoint if args.inference_precision == "fp32" else checkpoint + "_" + args.inference_precision
+
+
+def model_kwargs(model, model_info: dict) -> dict:
+    # constructor arguments of the model class besides similarity_measure and use_mid
+    kwargs = {"src_vocab_size": model_info["src_vocab_size"], "trg_vocab_size": model_info["trg_vocab_size"],
+              "embed_size": model_info["embed_size"]}
+    if model in ["lstm", "avg_lstm"]:
+        kwargs.update({"hidden_size": model_info["hidden_size"], "use_avg": "avg" in model})
+    elif model == "charcnn":
+        kwargs.update({"hidden_size": model_info["hidden_size"], "pooling_method": model_info["pooling_method"]})
+    return kwargs
+
+
+def copy_maps(map_file, bundle_dir):
+    # the compact (mmap-ed) vocab and frequency maps, maps of older versions are converted first
+    for side in ["_src", "_trg", "_src_freq", "_trg_freq"]:
+        if not compact_map_exists(map_file + side):
+            continue
+        suffixes = [COUNT_SUFFIX] if side.endswith("_freq") else [KEY_SUFFIX, ID_SUFFIX]
+        if not os.path.exists(map_file + side + suffixes[0]):
+            convert_pickle_map(map_file + side)
+        for suffix in suffixes:
+            shutil.copyfile(map_file + side + suffix, os.path.join(bundle_dir, MAP_PREFIX + side + suffix))
+
+
+def export_graphs(bundle_dir, config: dict):
+    # TorchScript graphs of the src and trg side of the model, loaded by --encoder_graph without the model classes
+    model_class = getattr(importlib.import_module("models." + MODEL_MODULES[config["model"]]), MODEL_CLASSES[config["model"]])
+    model, _ = load_bundle_model(argparse.Namespace(bundle_dir=bundle_dir, similarity_measure=config["similarity_measure"],
+                                                    encoder_graph=False), model_class)
+    model.eval()
+    with warnings.catch_warnings():
+        # torch.jit is deprecated in favor of torch.export, which does not handle the packed sequences of the LSTM
+        warnings.simplefilter("ignore", FutureWarning)
+        for is_src, fname in [(True, SRC_GRAPH), (False, TRG_GRAPH)]:
+            if is_src or not config["src_only"]:
+                torch.jit.script(model.side_encoder(is_src)).save(os.path.join(bundle_dir, fname))
+
+
+def export_bundle(model, model_path, test_epoch, map_file, bundle_dir, kb_index_dir="", src_only=False, encoder_graphs=False):
+    '''
+    write an inference bundle: config.json (model, constructor arguments, tensor layout), the weights without optimizer
+    state and mid parameters as one float32 .npy, the compact vocab maps and optionally the KB index
+    every file is opened with mmap at test time (--bundle_dir)
+    :param src_only: also drop the KB side encoder, the KB encodings are then read from the bundled KB index only
+    :param encoder_graphs: also write the TorchScript graphs of the encoders (--encoder_graph)
+    '''
+    if src_only and not kb_index_dir:
+        raise ValueError("a src only bundle needs the KB index (--kb_index_dir) to encode the KB")
+    checkpoint = model_path + "_" + str(test_epoch) + ".tar"
+    model_info = torch.load(checkpoint, map_location="cpu")
+    os.makedirs(bundle_dir, exist_ok=True)
+    tensors, layout, offset = [], [], 0
+    for name, param in model_info["model_state_dict"].items():
+        if name.startswith(MID_PREFIXES) or (src_only and name.startswith(TRG_PREFIXES)):
+            continue
+        param = param.detach().float().clone()
+        # the pad embedding is 0 at test time (reset_unk_weight)
+        if "_lookup" in name:
+            param[0] = 0
+        tensors.append(param.reshape(-1).numpy())
+        layout.append({"name": name, "offset": offset, "shape": list(param.shape)})
+        offset += param.numel()
+    np.save(os.path.join(bundle_dir, WEIGHTS), np.concatenate(tensors))
+    copy_maps(map_file, bundle_dir)
+    if kb_index_dir:
+        with open(os.path.join(kb_index_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            if json.load(f)["checkpoint"] != hash_file(checkpoint):
+                raise ValueError("the KB index {} is not encoded with {}".format(kb_index_dir, checkpoint))
+        if os.path.exists(os.path.join(bundle_dir, KB_INDEX)):
+            shutil.rmtree(os.path.join(bundle_dir, KB_INDEX))
+        shutil.copytree(kb_index_dir, os.path.join(bundle_dir, KB_INDEX))
+    config = {"model": model, "model_kwargs": model_kwargs(model, model_info),
+              "similarity_measure": model_info["similarity_measure"], "checkpoint": hash_file(checkpoint),
+              "epoch": model_info["epoch"], "src_only": src_only, "dropped": list(TRG_PREFIXES) if src_only else [],
+              "kb_index": bool(kb_index_dir), "graphs": encoder_graphs, "tensors": layout}
+    with open(os.path.join(bundle_dir, CONFIG), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    if encoder_graphs:
+        export_graphs(bundle_dir, config)
+    print("[INFO] export {} ({} tensors, {:.1f}MB of weights) to {}".format(checkpoint, len(layout), offset * 4 / 2 ** 20, bundle_dir))
+
+
+def apply_bundle_args(args, parser):
+    '''
+    the model, vocab and KB index of --bundle_dir replace --model, --similarity_measure, --map_file and --kb_index_dir
+    '''
+    config = read_bundle_config(args.bundle_dir)
+    if args.is_train:
+        parser.error("--bundle_dir is only used for testing")
+    args.model = config["model"]
+    if args.similarity_measure != config["similarity_measure"]:
+        print("[WARNING] --similarity_measure {} is replaced by {} of the bundle".format(args.similarity_measure, config["similarity_measure"]))
+    args.similarity_measure = config["similarity_measure"]
+    args.map_file = os.path.join(args.bundle_dir, MAP_PREFIX)
+    if config["kb_index"] and not args.kb_index_dir:
+        args.kb_index_dir = os.path.join(args.bundle_dir, KB_INDEX)
+    if args.encoder_graph and not config.get("graphs", False):
+        parser.error("--encoder_graph needs a bundle exported with --encoder_graphs 1")
+    if config["src_only"]:
+        # nothing could encode KB lines, or pivot strings on the KB side
+        if not args.kb_index_dir or args.kb_diff_file or (args.method == "pivoting" and not args.pivot_is_src):
+            parser.error("a src only bundle needs its KB index, no --kb_diff_file and --pivot_is_src 1")
+    return args
+
+
+@contextlib.contextmanager
+def skip_init():
+    # the random initialization of the parameters is skipped, they are replaced by the bundled weights
+    # (the meta device would skip it too, but meta kernels import torch._dynamo and sympy, more than a second)
+    saved = {name: fn for name, fn in vars(torch.nn.init).items() if name.endswith("_") and not name.startswith("_")}
+    for name in saved:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, fn in saved.items():
+            setattr(torch.nn.init, name, fn)
+
+
+def load_bundle_graphs(args, config: dict, weights: np.ndarray, similarity_measure: Similarity) -> GraphEncoder:
+    layout = {tensor["name"]: tensor for tensor in config["tensors"]}
+    matrices = {name: torch.from_numpy(weights[layout[name]["offset"]:layout[name]["offset"] + int(np.prod(layout[name]["shape"]))]
+                                       .reshape(layout[name]["shape"])) for name in MATRICES}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        src_graph = torch.jit.load(os.path.join(args.bundle_dir, SRC_GRAPH))
+        trg_graph = torch.jit.load(os.path.join(args.bundle_dir, TRG_GRAPH)) if not config["src_only"] else None
+    return GraphEncoder(src_graph, trg_graph, similarity_measure, matrices)
+
+
+def load_bundle_model(args, model_class):
+    '''
+    build the model of --bundle_dir, its parameters are created without initialization (their pages are never touched)
+    and replaced by views of the mmap-ed weights. with --encoder_graph, the encoder is made of the TorchScript graphs
+    of the bundle instead, model_class is not used
+    :return: model, similarity_measure
+    '''
+    start_time = time.time()
+    config = read_bundle_config(args.bundle_dir)
+    similarity_measure = Similarity(args.similarity_measure)
+    # copy on write, the weights are read only on disk but tensors could still be changed in place
+    weights = np.load(os.path.join(args.bundle_dir, WEIGHTS), mmap_mode="c")
+    if args.encoder_graph:
+        model = load_bundle_graphs(args, config, weights, similarity_measure)
+        model.set_similarity_matrix()
+        print("[INFO] load the encoder graphs of {} from {} in {:.3f}s".format(config["model"], args.bundle_dir, time.time() - start_time))
+        return model, similarity_measure
+    with skip_init():
+        model = model_class(similarity_measure=similarity_measure, use_mid=False, **config["model_kwargs"])
+    # the dropped encoder is removed, using it fails instead of reading uninitialized weights
+    for name in config["dropped"]:
+        if hasattr(model, name):
+            setattr(model, name, None)
+    state_dict = {}
+    for tensor in config["tensors"]:
+        size = int(np.prod(tensor["shape"]))
+        state_dict[tensor["name"]] = torch.from_numpy(weights[tensor["offset"]:tensor["offset"] + size].reshape(tensor["shape"]))
+    model.load_state_dict(state_dict, assign=True)
+    model.set_similarity_matrix()
+    print("[INFO] load {} from {} in {:.3f}s".format(config["model"], args.bundle_dir, time.time() - start_time))
+    return model, similarity_measure
+
+
+if __name__ == "__main__":
+    # write the inference bundle of a trained model, for --bundle_dir
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", choices=tuple(MODEL_MODULES), required=True)
+    parser.add_argument("--model_path", required=True)
+    parser.add_argument("--test_epoch", default="best")
+    parser.add_argument("--map_file", required=True)
+    parser.add_argument("--bundle_dir", required=True)
+    parser.add_argument("--kb_index_dir", help="KB index built with this checkpoint (main.py --kb_index_dir), copied into the bundle",
+                        default="")
+    parser.add_argument("--src_only", help="1 to drop the KB side encoder, needs --kb_index_dir", type=int, default=0)
+    parser.add_argument("--encoder_graphs", help="1 to also write the TorchScript graphs of the encoders", type=int, default=0)
+    args = parser.parse_args()
+    export_bundle(args.model, args.model_path, args.test_epoch, args.map_file, args.bundle_dir, args.kb_index_dir, bool(args.src_only),
+                  bool(args.encoder_graphs))
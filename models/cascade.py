@@ -0,0 +1,100 @@
+import copy
+import functools
+import torch
+import numpy as np
+from models import charagram
+from models.base_encoder import Encoder
+from models.prefilter import init_prefilter
+from models.base_test import get_encodings, encode_side_data, read_query_chunks, rank_queries, rank_shortlist, print_recall
+from data_loader.data_loader import BaseDataLoader
+from utils.encoding_cache import EncodingCache
+from utils.func import FileInfo
+from utils.similarity_calculator import Similarity
+from utils.constant import DEVICE
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+
+class Cascade:
+    '''
+    two stage retrieval: a charagram model ranks the whole KB and keeps the top shortlist_size entities of each query,
+    only these entities are encoded by the main model (LSTM, CharCNN) and reranked
+    '''
+    def __init__(self, args, model: Encoder, kb_data_loader: BaseDataLoader, encoding_cache: EncodingCache):
+        self.model = model
+        self.kb_data_loader = kb_data_loader
+        self.kb_side_data = kb_data_loader.get_test_data(is_src=False, is_mid=False)
+        self.encoding_cache = encoding_cache
+        self.trg_encoding_num = args.trg_encoding_num
+        # the KB is not encoded by the main model
+        self.encodes_kb = False
+        self.shortlist_size = args.shortlist_size
+        # the charagram model has its own checkpoint and vocab
+        self.args = copy.copy(args)
+        self.args.model_path = args.shortlist_model_path
+        self.args.test_epoch = args.shortlist_epoch
+        self.args.map_file = args.shortlist_map_file
+        model_info = torch.load(self.args.model_path + "_" + str(self.args.test_epoch) + ".tar")
+        self.shortlist_model, self.similarity_calculator = charagram.load_test_model(self.args, model_info["similarity_measure"])
+        self.shortlist_model.eval()
+        self.shortlist_model.to(device)
+        # memory only, charagram encodings must not be mixed with those of the main model
+        self.shortlist_cache = EncodingCache("", "", args.encoding_cache_size)
+        kb_file = FileInfo()
+        kb_file.set_trg(args.kb_file, args.kb_str_idx, args.kb_id_idx, args.kb_type_idx)
+        shortlist_kb_loader = charagram.DataLoader(is_train=False, args=self.args, train_file=None, dev_file=None, test_file=kb_file)
+        with torch.no_grad():
+            self.kb_encodings, self.kb_ids, self.kb_entity_string = get_encodings(self.shortlist_model, shortlist_kb_loader, False, "",
+                                                                                  is_src=False, is_mid=False, encoding_num=self.trg_encoding_num,
+                                                                                  encoding_cache=self.shortlist_cache)
+        self.recall, self.tot = 0, 0
+
+    def shortlist_chunks(self, test_file: FileInfo, chunk_size, type_index=None):
+        '''
+        read the test file with the charagram model, in the same chunks as read_query_chunks
+        :return: a generator of the shortlist of each chunk, KB rows [chunk_size, shortlist_size], -1 for padding
+        '''
+        query_file = FileInfo()
+        query_file.set_src(test_file.src_file_name, test_file.src_str_idx, test_file.src_id_idx, stream=True, type_idx=test_file.src_type_idx)
+        query_data_loader = charagram.DataLoader(is_train=False, args=self.args, train_file=None, dev_file=None, test_file=query_file)
+        self.recall, self.tot = 0, 0
+        for side_data, gold_kb_ids, plain_text, entity_types in read_query_chunks(query_data_loader, chunk_size):
+            # no_grad is thread local, this could run in the source thread of a pipeline
+            with torch.no_grad():
+                encodings = encode_side_data(self.shortlist_model, query_data_loader, side_data, self.shortlist_cache,
+                                             is_src=True, is_mid=False, encoding_num=1)
+                shortlist, _ = rank_queries(encodings, plain_text, self.kb_encodings, self.kb_entity_string, {}, "base",
+                                            self.similarity_calculator, self.trg_encoding_num, 1,
+                                            query_types=entity_types, type_index=type_index, topk=self.shortlist_size)["base"]
+            # the recall of the shortlist bounds the recall of the cascade
+            for cur_shortlist, gold_kb_id in zip(shortlist, gold_kb_ids):
+                self.recall += gold_kb_id in self.kb_ids[cur_shortlist[cur_shortlist >= 0]]
+            self.tot += len(plain_text)
+            yield shortlist
+
+    def shortlist_file(self, test_file: FileInfo, type_index=None, chunk_size=1024):
+        return np.vstack(list(self.shortlist_chunks(test_file, chunk_size, type_index)))
+
+    def print_recall(self):
+        print_recall("shortlist recall", {str(self.shortlist_size): self.recall}, float(self.tot))
+
+    def rerank(self, test_data_encodings: np.ndarray, test_data_plain: list, shortlist: np.ndarray, kb_encodings, kb_entity_string,
+               similarity_calculator: Similarity, use_exact_match=True, topk=100):
+        '''
+        :param test_data_encodings: encodings of the main model
+        :param kb_encodings: not used, only the shortlisted entities are encoded by the main model
+        '''
+        # the encoding cache avoids encoding entities shortlisted in several chunks again
+        def encode_rows(rows):
+            return encode_side_data(self.model, self.kb_data_loader, [self.kb_side_data[r] for r in rows], self.encoding_cache,
+                                    is_src=False, is_mid=False, encoding_num=self.trg_encoding_num)
+        return rank_shortlist(test_data_encodings, test_data_plain, shortlist, encode_rows, kb_entity_string,
+                              similarity_calculator, self.trg_encoding_num, use_exact_match, topk)
+
+
+def init_cascade(args, model: Encoder, kb_data_loader: BaseDataLoader, encoding_cache: EncodingCache):
+    # --shortlist_size 0 disables the cascade, the n-gram prefilter could still shortlist candidates of the main model
+    if args.shortlist_size <= 0:
+        return init_prefilter(args)
+    return Cascade(args, model, kb_data_loader, encoding_cache)
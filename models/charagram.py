@@ -5,9 +5,19 @@ import random
 from models.base_train import run, init_train
 from models.base_encoder import Encoder, create_optimizer
 from data_loader.data_loader import BaseBatch, BaseDataLoader
-from models.base_test import init_test, eval_dataset, reset_unk_weight
+from models.base_test import init_test, eval_dataset, reset_unk_weight, init_encoding_cache, init_test_runs, init_result_cache
+from models.tiers import init_tiers
+from models.fast_path import init_fast_path
+from models.prefilter import init_prefilter
+from models.kb_index import init_kb_index
+from models.projection import init_projection
+from models.memory_plan import init_memory_plan
+from models.bundle import load_bundle_model
+from models.precision import init_precision
 from utils.similarity_calculator import Similarity
 from utils.constant import DEVICE, RANDOM_SEED
+from utils.vocab import lookup_tokens
+from utils.ngram import get_ngram
 import numpy as np
 
 random_seed = RANDOM_SEED
@@ -17,42 +27,22 @@ np.random.seed(random_seed)
 print = functools.partial(print, flush=True)
 device = DEVICE
 
-START_SYMBOL = "<s>"
-END_SYMBOL = "</s>"
-
-def get_ngram(string, ngram_list=(2,3,4,5)):
-    all_ngrams = []
-    all_st_idx = []
-    all_ed_idx = []
-    char_list = [START_SYMBOL] + list(string) + [END_SYMBOL]
-    for n in ngram_list:
-        cur_ngram = zip(*[char_list[i:] for i in range(n)])
-        cur_ngram = ["".join(x) for x in cur_ngram]
-        all_ngrams += cur_ngram
-
-        idx_list = [i for i in range(len(char_list))]
-        cur_idx_ngram = zip(*[idx_list[i:] for i in range(n)])
-        st_ed = [[x[0], x[-1]] for x in cur_idx_ngram]
-        all_st_idx += [x[0] for x in st_ed]
-        all_ed_idx += [x[1] for x in st_ed]
-    return all_ngrams, all_st_idx, all_ed_idx
-
 
 class Batch(BaseBatch):
     def set_src(self, src_tensor, src_mask, src_gold_kb_ids):
-        self.src_tensor = src_tensor.long()
+        self.src_tensor = src_tensor
         self.src_mask = src_mask
         self.gold_kb_ids = src_gold_kb_ids
         self.src_flag = True
 
     def set_trg(self, trg_tensor, trg_mask, trg_kb_ids):
-        self.trg_tensor = trg_tensor.long()
+        self.trg_tensor = trg_tensor
         self.trg_mask = trg_mask
         self.trg_kb_ids = trg_kb_ids
         self.trg_flag = True
 
     def set_mid(self, mid_tensor, mid_mask, mid_kb_ids):
-        self.mid_tensor = mid_tensor.long()
+        self.mid_tensor = mid_tensor
         self.mid_mask = mid_mask
         self.mid_kb_ids= mid_mask
         self.mid_flag = True
@@ -99,21 +89,20 @@ class DataLoader(BaseDataLoader):
                 tks = line.strip().split(" ||| ")
                 if encoding_num == 1:
                     all_n_gram, st, ed = get_ngram(tks[str_idx])
-                    string = [x2i_map[ngram] for ngram in all_n_gram]
-                    all_string = [string]
+                    all_string = lookup_tokens(x2i_map, [all_n_gram])
                     all_st = [st]
                     all_ed = [ed]
                 else:
-                    all_string = []
+                    all_n_gram_list = []
                     all_st = []
                     all_ed = []
                     alias = self.get_alias(tks, str_idx, id_idx, encoding_num)
                     for i in range(encoding_num):
                         all_n_gram, st, ed = get_ngram(alias[i])
-                        string = [x2i_map[ngram] for ngram in all_n_gram]
-                        all_string.append(string)
+                        all_n_gram_list.append(all_n_gram)
                         all_st.append(st)
                         all_ed.append(ed)
+                    all_string = lookup_tokens(x2i_map, all_n_gram_list)
                 for s in all_string:
                     for ss in s:
                         freq_map[ss] += 1
@@ -122,13 +111,8 @@ class DataLoader(BaseDataLoader):
                 yield (all_info, tks[id_idx])
         print("[INFO] number of lines in {}: {}".format(file_name, str(line_tot)))
 
-    def transform_one_batch(self, data):
-        data_len = [len(x) for x in data]
-        cur_size = len(data_len)
-        max_data_len = max(data_len)
-        data_tensor = torch.zeros((cur_size, max_data_len))
-        for idx, id_list in enumerate(data):
-            data_tensor[idx, :data_len[idx]] = torch.LongTensor(id_list)
+    def transform_padded(self, data_tensor, data_lens):
+        # unknown n-grams are the pad idx as well, they are masked out
         mask = (data_tensor != self.pad_idx).unsqueeze(-1)
         return [data_tensor, mask]
     
@@ -165,6 +149,12 @@ class Charagram(Encoder):
     def assign_weight(self, lookup, weight):
         lookup.weight = nn.Parameter(weight, requires_grad=False)
 
+    def side_encoder(self, is_src):
+        # calc_encode of one side as a module that could be scripted (models/bundle.py)
+        if is_src:
+            return CharagramSide(self.src_lookup, self.bias_src, self.hidden_size)
+        return CharagramSide(self.trg_lookup, self.bias_trg, self.hidden_size)
+
     # calc_batch_similarity will return the similarity of the batch
     # while calc encode only return the encoding result of src or trg of the batch
     def calc_encode(self, batch: Batch, is_src, is_mid=False):
@@ -193,6 +183,24 @@ class Charagram(Encoder):
         encoded = self.activate(torch.sum(embed, dim=1, keepdim=False) + bias)
         return encoded
 
+class CharagramSide(nn.Module):
+    '''
+    calc_encode of the src or trg side at test time, without the branches on the side
+    its TorchScript graph is loaded without the model classes (GraphEncoder)
+    '''
+    def __init__(self, lookup: nn.Embedding, bias: nn.Parameter, hidden_size: int):
+        super(CharagramSide, self).__init__()
+        self.name = "charagram"
+        self.hidden_size = hidden_size
+        self.lookup = lookup
+        self.bias = bias
+
+    def forward(self, input, mask):
+        # [batch_size, max_len, embed_size]
+        embed = self.lookup(input).masked_fill(mask == 0, 0)
+        # [batch_size, embed_size]
+        return torch.tanh(torch.sum(embed, dim=1, keepdim=False) + self.bias)
+
 def save_model(model:Charagram, epoch, loss, optimizer, model_path):
     torch.save({"model_state_dict": model.state_dict(),
                 "optimizer_statte_dict": optimizer.state_dict(),
@@ -205,6 +213,20 @@ def save_model(model:Charagram, epoch, loss, optimizer, model_path):
                 "loss": loss}, model_path)
     print("[INFO] save model!")
 
+def load_test_model(args, similarity_method=None):
+    # similarity_method: None to use --similarity_measure
+    model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
+    similarity_measure = Similarity(similarity_method if similarity_method is not None else args.similarity_measure)
+    model = Charagram(model_info["src_vocab_size"], model_info["trg_vocab_size"],
+                    model_info["embed_size"],
+                    similarity_measure=similarity_measure,
+                    use_mid=args.use_mid,
+                    mid_vocab_size=model_info.get("mid_vocab_size", 0))
+    model.load_state_dict(model_info["model_state_dict"])
+    reset_unk_weight(model)
+    model.set_similarity_matrix()
+    return model, similarity_measure
+
 def main(args):
     if args.is_train:
         data_loader, criterion, similarity_measure = init_train(args, DataLoader)
@@ -222,17 +244,23 @@ def main(args):
         run(data_loader, model, criterion, optimizer, scheduler, similarity_measure, save_model, args)
     else:
         base_data_loader, intermedia_stuff = init_test(args, DataLoader)
-        model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
-        similarity_measure = Similarity(args.similarity_measure)
-        model = Charagram(model_info["src_vocab_size"], model_info["trg_vocab_size"],
-                        model_info["embed_size"],
-                        similarity_measure=similarity_measure,
-                        use_mid=args.use_mid,
-                        mid_vocab_size=model_info.get("mid_vocab_size", 0))
-        model.load_state_dict(model_info["model_state_dict"])
-        reset_unk_weight(model)
-        model.set_similarity_matrix()
+        if args.bundle_dir:
+            model, similarity_measure = load_bundle_model(args, Charagram)
+        else:
+            model, similarity_measure = load_test_model(args)
+        model = init_precision(args, model, similarity_measure, DataLoader)
+        encoding_cache = init_encoding_cache(args)
         eval_dataset(model, similarity_measure, base_data_loader, args.encoded_test_file, args.load_encoded_test,
                      args.encoded_kb_file, args.load_encoded_kb, intermedia_stuff, args.method, args.trg_encoding_num,
                      args.mid_encoding_num,
-                     args.result_file, args.record_recall)
+                     args.result_file, args.record_recall,
+                     encoding_cache=encoding_cache,
+                     extra_runs=init_test_runs(args, DataLoader),
+                     query_chunk_size=args.query_chunk_size,
+                     result_cache=init_result_cache(args),
+                     shortlister=init_prefilter(args),
+                     tiers=init_tiers(args),
+                     fast_path=init_fast_path(args),
+                     kb_index=init_kb_index(args, model, DataLoader, encoding_cache),
+                     projection=init_projection(args),
+                     memory_plan=init_memory_plan(args))
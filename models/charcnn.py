@@ -6,9 +6,18 @@ import torch.nn.functional as F
 from models.base_train import run, init_train
 from models.base_encoder import Encoder, create_optimizer
 from data_loader.data_loader import BaseBatch, BaseDataLoader
-from models.base_test import init_test, eval_dataset, reset_unk_weight
+from models.base_test import init_test, eval_dataset, reset_unk_weight, init_encoding_cache, init_test_runs, init_result_cache
+from models.tiers import init_tiers
+from models.fast_path import init_fast_path
+from models.cascade import init_cascade
+from models.kb_index import init_kb_index
+from models.projection import init_projection
+from models.memory_plan import init_memory_plan
+from models.bundle import load_bundle_model
+from models.precision import init_precision
 from utils.similarity_calculator import Similarity
 from utils.constant import DEVICE, RANDOM_SEED
+from utils.vocab import lookup_tokens
 import numpy as np
 
 random_seed = RANDOM_SEED
@@ -21,19 +30,19 @@ device = DEVICE
 
 class Batch(BaseBatch):
     def set_src(self, src_tensor, src_mask, src_gold_kb_ids):
-        self.src_tensor = src_tensor.long()
+        self.src_tensor = src_tensor
         self.src_mask = src_mask
         self.gold_kb_ids = src_gold_kb_ids
         self.src_flag = True
 
     def set_trg(self, trg_tensor, trg_mask, trg_kb_ids):
-        self.trg_tensor = trg_tensor.long()
+        self.trg_tensor = trg_tensor
         self.trg_mask = trg_mask
         self.trg_kb_ids = trg_kb_ids
         self.trg_flag = True
 
     def set_mid(self, mid_tensor, mid_mask, mid_kb_ids):
-        self.mid_tensor = mid_tensor.long()
+        self.mid_tensor = mid_tensor
         self.mid_mask = mid_mask
         self.mid_kb_ids = mid_mask
         self.mid_flag = True
@@ -78,19 +87,14 @@ class DataLoader(BaseDataLoader):
                 tks = line.strip().split(" ||| ")
                 mention_string = "<" +  tks[str_idx] + ">"
                 if encoding_num == 1:
-                    string = [x2i_map[x] for x in mention_string]
-                    all_string = [string]
-                    all_st = [0 for x in range(len(string))]
-                    all_ed = [0 for x in range(len(string))]
+                    all_string = lookup_tokens(x2i_map, [mention_string])
+                    all_st = [0 for x in range(len(mention_string))]
+                    all_ed = [0 for x in range(len(mention_string))]
                 else:
-                    all_string = []
                     all_st = []
                     all_ed = []
                     alias = self.get_alias(tks, str_idx, id_idx, encoding_num)
-                    for i in range(encoding_num):
-                        cur_mention_string = "<" + alias[i] + ">"
-                        string = [x2i_map[x] for x in cur_mention_string]
-                        all_string.append(string)
+                    all_string = lookup_tokens(x2i_map, ["<" + alias[i] + ">" for i in range(encoding_num)])
 
                 for s in all_string:
                     for ss in s:
@@ -101,13 +105,7 @@ class DataLoader(BaseDataLoader):
 
         print("[INFO] number of lines in {}: {}".format(file_name, str(line_tot)))
 
-    def transform_one_batch(self, data):
-        data_len = [len(x) for x in data]
-        cur_size = len(data_len)
-        max_data_len = max(data_len)
-        data_tensor = torch.zeros((cur_size, max_data_len))
-        for idx, id_list in enumerate(data):
-            data_tensor[idx, :data_len[idx]] = torch.LongTensor(id_list)
+    def transform_padded(self, data_tensor, data_lens):
         mask = (data_tensor != self.pad_idx)
         return [data_tensor, mask]
 
@@ -151,6 +149,14 @@ class CharCNN(Encoder):
     def assign_weight(self, lookup, weight):
         lookup.weight = nn.Parameter(weight, requires_grad=False)
 
+    def side_encoder(self, is_src):
+        # calc_encode of one side as a module that could be scripted (models/bundle.py)
+        if is_src:
+            return CharCNNSide(self.src_lookup, self.src_conv1d_list, self.linear, self.padding, self.window_size,
+                               self.pooling_method, self.hidden_size)
+        return CharCNNSide(self.trg_lookup, self.trg_conv1d_list, self.linear, self.padding, self.window_size,
+                           self.pooling_method, self.hidden_size)
+
     # calc_batch_similarity will return the similarity of the batch
     # while calc encode only return the encoding result of src or trg of the batch
     def calc_encode(self, batch: Batch, is_src, is_mid=False):
@@ -206,6 +212,49 @@ class CharCNN(Encoder):
         return encode
 
 
+class CharCNNSide(nn.Module):
+    '''
+    calc_encode of the src or trg side at test time (no dropout), without the branches on the side
+    its TorchScript graph is loaded without the model classes (GraphEncoder)
+    '''
+    def __init__(self, lookup: nn.Embedding, conv1d_list: nn.ModuleList, linear: nn.Linear, padding: list, window_size: list,
+                 pooling_method: str, hidden_size: int):
+        super(CharCNNSide, self).__init__()
+        if pooling_method not in ["max", "mean", "sum"]:
+            raise NotImplementedError
+        self.name = "charcnn"
+        self.hidden_size = hidden_size
+        self.lookup = lookup
+        self.conv1d_list = conv1d_list
+        self.linear = linear
+        self.padding = padding
+        self.window_size = window_size
+        self.pooling_method = pooling_method
+
+    def forward(self, input, mask):
+        # [batch_size, embed_size, max_len]
+        reshape_embed = torch.transpose(self.lookup(input), 1, 2)
+        pooling_list = []
+        i = 0
+        for conv1d_layer in self.conv1d_list:
+            # [batch_size, 1, length - window_size + 1]
+            if self.padding[i] == 0:
+                cur_mask = mask[:, self.window_size[i] - 1:].unsqueeze(1).float()
+            else:
+                cur_mask = mask.unsqueeze(1).float()
+            conv_result = F.relu(conv1d_layer(reshape_embed))
+            if self.pooling_method == "max":
+                conv_result = conv_result - (1 - cur_mask) * 1e10
+                pooling = F.max_pool1d(conv_result, kernel_size=conv_result.size(2)).squeeze(2)
+            else:
+                pooling = torch.sum(cur_mask * conv_result, dim=-1, keepdim=False)
+                if self.pooling_method == "mean":
+                    pooling = pooling / torch.sum(cur_mask.squeeze(1), dim=-1, keepdim=True)
+            pooling_list.append(pooling)
+            i += 1
+        return self.linear(torch.cat(pooling_list, dim=1))
+
+
 def save_model(model: CharCNN, epoch, loss, optimizer, model_path):
     torch.save({"model_state_dict": model.state_dict(),
                 "optimizer_statte_dict": optimizer.state_dict(),
@@ -242,19 +291,34 @@ def main(args):
 
     else:
         base_data_loader, intermedia_stuff = init_test(args, DataLoader)
-        model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
-        similarity_measure = Similarity(args.similarity_measure)
-        model = CharCNN(model_info["src_vocab_size"], model_info["trg_vocab_size"],
-                          model_info["embed_size"],
-                          model_info["hidden_size"],
-                          similarity_measure=similarity_measure,
-                          use_mid=args.use_mid,
-                          pooling_method= model_info["pooling_method"],
-                          mid_vocab_size=model_info.get("mid_vocab_size", 0))
-        model.load_state_dict(model_info["model_state_dict"])
-        reset_unk_weight(model)
-        model.set_similarity_matrix()
+        if args.bundle_dir:
+            model, similarity_measure = load_bundle_model(args, CharCNN)
+        else:
+            model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
+            similarity_measure = Similarity(args.similarity_measure)
+            model = CharCNN(model_info["src_vocab_size"], model_info["trg_vocab_size"],
+                              model_info["embed_size"],
+                              model_info["hidden_size"],
+                              similarity_measure=similarity_measure,
+                              use_mid=args.use_mid,
+                              pooling_method= model_info["pooling_method"],
+                              mid_vocab_size=model_info.get("mid_vocab_size", 0))
+            model.load_state_dict(model_info["model_state_dict"])
+            reset_unk_weight(model)
+            model.set_similarity_matrix()
+        model = init_precision(args, model, similarity_measure, DataLoader)
+        encoding_cache = init_encoding_cache(args)
         eval_dataset(model, similarity_measure, base_data_loader, args.encoded_test_file, args.load_encoded_test,
                      args.encoded_kb_file, args.load_encoded_kb, intermedia_stuff, args.method, args.trg_encoding_num,
                      args.mid_encoding_num,
-                     args.result_file, args.record_recall)
+                     args.result_file, args.record_recall,
+                     encoding_cache=encoding_cache,
+                     extra_runs=init_test_runs(args, DataLoader),
+                     query_chunk_size=args.query_chunk_size,
+                     result_cache=init_result_cache(args),
+                     shortlister=init_cascade(args, model, base_data_loader, encoding_cache),
+                     tiers=init_tiers(args),
+                     fast_path=init_fast_path(args),
+                     kb_index=init_kb_index(args, model, DataLoader, encoding_cache),
+                     projection=init_projection(args),
+                     memory_plan=init_memory_plan(args))
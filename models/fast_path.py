@@ -0,0 +1,57 @@
+import functools
+import numpy as np
+from utils.lexical_index import load_lexical_index
+from utils.string_store import load_string_column
+
+print = functools.partial(print, flush=True)
+
+# same score as exact_match
+MATCH_SCORE = 1000.0
+
+
+class FastPath:
+    '''
+    mentions that match exactly one KB entity by a normalized title / alias (or a long enough prefix of one)
+    are answered with that entity directly, they are neither encoded nor scored
+    '''
+    def __init__(self, index, names, min_prefix_len=0):
+        self.index = index
+        self.names = names
+        self.min_prefix_len = min_prefix_len
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.exact_hit, self.prefix_hit, self.tot = 0, 0, 0
+
+    def match(self, test_data_plain: list) -> np.ndarray:
+        matched, _ = self.index.match(test_data_plain, self.min_prefix_len)
+        return matched
+
+    def answer(self, test_data_plain: list) -> dict:
+        '''
+        :return: plain text -> ranked result of the same form as rank_queries, for the mentions that are hit
+        '''
+        matched, is_prefix = self.index.match(test_data_plain, self.min_prefix_len)
+        self.tot += len(test_data_plain)
+        self.exact_hit += int(np.sum((matched != -1) & ~is_prefix))
+        self.prefix_hit += int(np.sum(is_prefix))
+        results = {}
+        for plain_text, row in zip(test_data_plain, matched):
+            if row != -1:
+                result = (np.array([row], dtype=np.int64), np.array([MATCH_SCORE], dtype=np.float32))
+                results[plain_text] = {name: result for name in self.names}
+        return results
+
+    def print_stats(self):
+        print("[INFO] fast path: {} exact and {} prefix hits out of {} unique mentions".format(self.exact_hit, self.prefix_hit, self.tot))
+        self.reset_stats()
+
+
+def init_fast_path(args):
+    if not args.fast_path:
+        return None
+    kb_ids, kb_entity_string = load_string_column(args.kb_file, args.kb_str_idx, args.kb_id_idx)
+    index = load_lexical_index(args.kb_file, args.kb_str_idx, kb_ids, kb_entity_string,
+                               args.alia_file if args.alia_file != "HOLDER" else None)
+    names = ["base", "pivot"] if args.method == "pivoting" else ["base"]
+    return FastPath(index, names, args.fast_path_min_prefix)
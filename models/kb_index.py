@@ -0,0 +1,354 @@
+import os
+import json
+import shutil
+import argparse
+import functools
+import threading
+import torch
+import numpy as np
+from models.base_encoder import Encoder
+from models.base_test import encode_side_data
+from utils.encoding_cache import EncodingCache
+from models.bundle import checkpoint_hash
+from utils.func import FileInfo
+from utils.result_cache import file_signature
+from utils.string_store import StringTable, load_string_column
+from utils.constant import DEVICE
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+MANIFEST = "manifest.json"
+
+
+def read_lines(fname) -> list:
+    # lines of a ||| separated KB file in file order, as a full build reads them
+    with open(fname, "r", encoding="utf-8") as f:
+        return [x for x in (line.strip() for line in f) if x]
+
+
+def read_kb_lines(fname, id_idx) -> dict:
+    # id -> lines of a ||| separated KB file, an id could have several lines
+    lines = {}
+    for line in read_lines(fname):
+        lines.setdefault(int(line.split(" ||| ")[id_idx]), []).append(line)
+    return lines
+
+
+def diff_kb_files(old_kb, new_kb, id_idx, str_idx, old_alias=None, new_alias=None) -> list:
+    '''
+    :param old_alias, new_alias: the alias files of both versions, entities whose aliases changed are encoded again
+    :return: lines of the diff, "- id" for a removed entity, "+ KB line" for each line of an added or changed (e.g. renamed) entity
+    '''
+    old_lines, new_lines = read_kb_lines(old_kb, id_idx), read_kb_lines(new_kb, id_idx)
+    diff = ["- {}".format(kb_id) for kb_id in old_lines if kb_id not in new_lines]
+    # aliases are looked up by wikipedia id and by title (BaseDataLoader.get_alias)
+    changed_keys = set()
+    if old_alias is not None and new_alias is not None:
+        with open(old_alias, "r", encoding="utf-8") as f_old, open(new_alias, "r", encoding="utf-8") as f_new:
+            changed = set(x.strip() for x in f_old) ^ set(x.strip() for x in f_new)
+        for line in changed:
+            tks = line.split(" ||| ")
+            if len(tks) == 4:
+                changed_keys.update([tks[1], tks[2]])
+    for kb_id, lines in new_lines.items():
+        tks = [x.split(" ||| ") for x in lines]
+        if old_lines.get(kb_id) != lines or any(x[id_idx] in changed_keys or x[str_idx] in changed_keys for x in tks):
+            diff += ["+ " + x for x in lines]
+    return diff
+
+
+def read_kb_diff(fname, id_idx):
+    '''
+    :return: KB lines to add or replace (the + lines of an id replace all its rows) and ids to remove
+    '''
+    upserts, removed = {}, set()
+    with open(fname, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("+ "):
+                kb_id = int(line[2:].split(" ||| ")[id_idx])
+                upserts.setdefault(kb_id, []).append(line[2:])
+                removed.discard(kb_id)
+            elif line.startswith("- "):
+                kb_id = int(line[2:])
+                upserts.pop(kb_id, None)
+                removed.add(kb_id)
+    return [line for lines in upserts.values() for line in lines], removed
+
+
+class KBSegment:
+    '''
+    KB lines added by one update (segment_dir/kb) and their encodings (all first versions, then all second versions, ...)
+    rows whose entity is removed or replaced by a later segment are tombstoned in live,
+    positions are the places of the rows in the KB file (see KBIndex.positions)
+    '''
+    def __init__(self, segment_dir, str_idx, id_idx):
+        self.segment_dir = segment_dir
+        self.kb_file = os.path.join(segment_dir, "kb")
+        self.ids, self.strings = load_string_column(self.kb_file, str_idx, id_idx)
+        self.encodings = np.load(os.path.join(segment_dir, "encodings.npy"), mmap_mode="r")
+        self.live = np.load(os.path.join(segment_dir, "live.npy"))
+        self.positions = np.load(os.path.join(segment_dir, "positions.npy"))
+
+    def tombstone(self, kb_ids) -> int:
+        dead = self.live & np.isin(self.ids, kb_ids)
+        if dead.any():
+            self.live = self.live & ~dead
+            np.save(os.path.join(self.segment_dir, "live.npy"), self.live)
+        return int(dead.sum())
+
+    def version_encodings(self, trg_encoding_num) -> np.ndarray:
+        # [trg_encoding_num, rows, hidden]
+        return self.encodings.reshape(trg_encoding_num, len(self.ids), -1)
+
+
+class KBIndex:
+    '''
+    updatable KB encodings: a list of segments, the first one from a full build and one more per update (read_kb_diff)
+    only the added or changed entities of an update are encoded, removed entities are tombstoned,
+    compact() merges all segments into one without the tombstoned rows
+    each row has a position, the live rows are read in that order: the rows of a full build are in file order,
+    a replaced entity keeps the positions of its old rows and a new one is added after all the rows,
+    so the view is the same as a full build of a KB file that is updated in place and appended to
+    '''
+    def __init__(self, args, index_dir):
+        self.args = args
+        self.index_dir = index_dir
+        self.str_idx, self.id_idx = args.kb_str_idx, args.kb_id_idx
+        self.trg_encoding_num = args.trg_encoding_num
+        # updates, compaction and view do not run at the same time
+        self.lock = threading.Lock()
+        self.compaction = None
+        # compact once the KB is read for testing (eval_dataset)
+        self.compact_after_view = args.kb_compact
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_file = os.path.join(index_dir, MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"checkpoint": "", "segments": [], "next_segment": 0, "next_position": 0, "applied": []}
+        self.segments = [KBSegment(os.path.join(index_dir, x), self.str_idx, self.id_idx) for x in self.manifest["segments"]]
+
+    def save_manifest(self):
+        # written to a temporary file and renamed, a crash leaves either the old or the new manifest
+        self.manifest["segments"] = [os.path.basename(x.segment_dir) for x in self.segments]
+        manifest_file = os.path.join(self.index_dir, MANIFEST)
+        with open(manifest_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def encode_kb_file(self, model: Encoder, DataLoader, kb_file_name, encoding_cache: EncodingCache) -> np.ndarray:
+        kb_file = FileInfo()
+        kb_file.set_trg(kb_file_name, self.str_idx, self.id_idx, self.args.kb_type_idx)
+        kb_data_loader = DataLoader(is_train=False, args=self.args, train_file=None, dev_file=None, test_file=kb_file)
+        return encode_side_data(model, kb_data_loader, kb_data_loader.get_test_data(is_src=False, is_mid=False), encoding_cache,
+                                is_src=False, is_mid=False, encoding_num=self.trg_encoding_num)
+
+    def new_segment(self, model: Encoder, DataLoader, lines: list, positions: np.ndarray, encodings: np.ndarray=None,
+                    encoding_cache: EncodingCache=None) -> KBSegment:
+        segment_dir = os.path.join(self.index_dir, "seg{:05d}".format(self.manifest["next_segment"]))
+        self.manifest["next_segment"] += 1
+        os.makedirs(segment_dir, exist_ok=True)
+        with open(os.path.join(segment_dir, "kb"), "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line + "\n")
+        if encodings is None:
+            encodings = self.encode_kb_file(model, DataLoader, os.path.join(segment_dir, "kb"), encoding_cache)
+        np.save(os.path.join(segment_dir, "encodings.npy"), encodings)
+        np.save(os.path.join(segment_dir, "live.npy"), np.ones(len(lines), dtype=bool))
+        np.save(os.path.join(segment_dir, "positions.npy"), positions)
+        return KBSegment(segment_dir, self.str_idx, self.id_idx)
+
+    def check_checkpoint(self, model: Encoder, DataLoader, checkpoint, encoding_cache: EncodingCache):
+        # encodings of another checkpoint are useless, every segment is encoded again
+        if self.manifest["checkpoint"] == checkpoint:
+            return
+        with self.lock:
+            for segment in self.segments:
+                print("[INFO] checkpoint changed, encode {} again".format(segment.kb_file))
+                # the old file is still mmap-ed, the new one is written aside and renamed
+                np.save(os.path.join(segment.segment_dir, "encodings.tmp.npy"),
+                        self.encode_kb_file(model, DataLoader, segment.kb_file, encoding_cache))
+                os.replace(os.path.join(segment.segment_dir, "encodings.tmp.npy"), os.path.join(segment.segment_dir, "encodings.npy"))
+                segment.encodings = np.load(os.path.join(segment.segment_dir, "encodings.npy"), mmap_mode="r")
+            self.manifest["checkpoint"] = checkpoint
+            self.save_manifest()
+
+    def positions(self, upserts: list) -> np.ndarray:
+        '''
+        positions of the rows of upserts: the rows of an entity already in the index take the positions of its old rows
+        (the last one for the rows it has more), the rows of a new entity come after all the rows, in their order
+        '''
+        old_positions = {}
+        if len(self.segments) != 0:
+            segment_idx, rows = self.live_rows()
+            for s, r in zip(segment_idx, rows):
+                old_positions.setdefault(int(self.segments[s].ids[r]), []).append(int(self.segments[s].positions[r]))
+        positions = np.zeros(len(upserts), dtype=np.int64)
+        seen = {}
+        for i, line in enumerate(upserts):
+            kb_id = int(line.split(" ||| ")[self.id_idx])
+            j = seen.get(kb_id, 0)
+            seen[kb_id] = j + 1
+            if kb_id in old_positions:
+                positions[i] = old_positions[kb_id][min(j, len(old_positions[kb_id]) - 1)]
+            else:
+                positions[i] = self.manifest["next_position"]
+                self.manifest["next_position"] += 1
+        return positions
+
+    def update(self, model: Encoder, DataLoader, upserts: list, removed, encoding_cache: EncodingCache):
+        '''
+        :param upserts: KB lines of added or changed entities, all the rows of an entity already in the index are replaced
+        :param removed: ids of removed entities
+        '''
+        with self.lock:
+            old_segments = list(self.segments)
+            kb_ids = list(removed)
+            if len(upserts) != 0:
+                segment = self.new_segment(model, DataLoader, upserts, self.positions(upserts), encoding_cache=encoding_cache)
+                self.segments.append(segment)
+                kb_ids += segment.ids.tolist()
+            # the manifest is saved before the tombstones, after a crash an entity could be alive in two segments
+            # and view takes the latest one, it is never lost
+            self.save_manifest()
+            dead = sum(x.tombstone(kb_ids) for x in old_segments)
+            print("[INFO] KB index update: {} entities encoded, {} rows tombstoned, {} segments".format(len(upserts), dead, len(self.segments)))
+
+    def apply_diff(self, model: Encoder, DataLoader, diff_file, encoding_cache: EncodingCache):
+        # a diff is applied once, the index remembers the diff files it has seen
+        signature = list(file_signature(diff_file))
+        if signature in self.manifest["applied"]:
+            print("[INFO] {} is already applied".format(diff_file))
+            return
+        upserts, removed = read_kb_diff(diff_file, self.id_idx)
+        self.update(model, DataLoader, upserts, removed, encoding_cache)
+        with self.lock:
+            self.manifest["applied"].append(signature)
+            self.save_manifest()
+
+    def live_rows(self):
+        '''
+        :return: segment and row of each live row, sorted by position (rows with the same position by segment and row)
+        '''
+        segment_idx = np.concatenate([np.full(x.live.sum(), i, dtype=np.int64) for i, x in enumerate(self.segments)])
+        rows = np.concatenate([np.nonzero(x.live)[0] for x in self.segments])
+        ids = np.concatenate([x.ids[x.live] for x in self.segments])
+        positions = np.concatenate([x.positions[x.live] for x in self.segments])
+        # after a crash an entity could be alive in two segments (see update), only the rows of the latest one are kept
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        latest = np.zeros(len(unique_ids), dtype=np.int64)
+        np.maximum.at(latest, inverse, segment_idx)
+        keep = segment_idx == latest[inverse]
+        order = np.lexsort((rows[keep], segment_idx[keep], positions[keep]))
+        return segment_idx[keep][order], rows[keep][order]
+
+    def gather(self, segment_idx, rows):
+        # encodings, ids and strings of (segment, row) pairs in their order
+        encodings = np.zeros((self.trg_encoding_num, len(rows), self.segments[0].encodings.shape[1]), dtype=self.segments[0].encodings.dtype)
+        ids = np.zeros(len(rows), dtype=np.int64)
+        strings = [None for _ in range(len(rows))]
+        for i, segment in enumerate(self.segments):
+            pos = np.nonzero(segment_idx == i)[0]
+            encodings[:, pos] = segment.version_encodings(self.trg_encoding_num)[:, rows[pos]]
+            ids[pos] = segment.ids[rows[pos]]
+            for p, r in zip(pos, rows[pos]):
+                strings[p] = segment.strings[r]
+        return encodings.reshape(self.trg_encoding_num * len(rows), -1), ids, strings
+
+    def view(self):
+        '''
+        :return: KB encodings, ids and strings (StringTable) of the live rows in KB file order, as get_encodings of the KB
+        '''
+        with self.lock:
+            encodings, kb_ids, strings = self.gather(*self.live_rows())
+        print("[INFO] KB index: {} entities in {} segments".format(len(kb_ids), len(self.segments)))
+        return encodings, kb_ids, StringTable.build(strings)
+
+    def check(self, model: Encoder, DataLoader, kb_file_name, encoding_cache: EncodingCache, atol=1e-5) -> bool:
+        '''
+        compare the view with a full build of kb_file_name (the current KB): the same ids and strings in the same order,
+        and encodings equal up to float rounding of batched encoding
+        '''
+        encodings, kb_ids, strings = self.view()
+        full_ids, full_strings = load_string_column(kb_file_name, self.str_idx, self.id_idx)
+        passed = len(kb_ids) == len(full_ids) and np.array_equal(kb_ids, full_ids) \
+            and all(strings[i] == full_strings[i] for i in range(len(full_strings)))
+        if passed:
+            full_encodings = self.encode_kb_file(model, DataLoader, kb_file_name, encoding_cache)
+            max_diff = float(np.abs(encodings - full_encodings).max()) if len(full_encodings) != 0 else 0.0
+            passed = max_diff <= atol
+            print("[INFO] KB index check: largest encoding difference with a full build {:.2e}".format(max_diff))
+        if passed:
+            print("[INFO] KB index check: the index is the same as a full build of {}".format(kb_file_name))
+        else:
+            print("[WARNING] KB index check: the index differs from a full build of {}".format(kb_file_name))
+        return passed
+
+    def compact(self):
+        with self.lock:
+            if len(self.segments) <= 1 and all(x.live.all() for x in self.segments):
+                return
+            segment_idx, rows = self.live_rows()
+            encodings, _, _ = self.gather(segment_idx, rows)
+            positions = np.array([self.segments[s].positions[r] for s, r in zip(segment_idx, rows)], dtype=np.int64)
+            segment_lines = []
+            for segment in self.segments:
+                with open(segment.kb_file, "r", encoding="utf-8") as f:
+                    segment_lines.append([x.strip() for x in f])
+            lines = [segment_lines[s][r] for s, r in zip(segment_idx, rows)]
+            # the merged segment is not encoded again, its rows keep their encodings
+            merged = self.new_segment(None, None, lines, positions, encodings=encodings)
+            old_segments, self.segments = self.segments, [merged]
+            self.save_manifest()
+            for segment in old_segments:
+                shutil.rmtree(segment.segment_dir)
+        print("[INFO] KB index compacted, {} segments -> 1, {} entities".format(len(old_segments), len(lines)))
+
+    def compact_in_background(self):
+        # the process waits for the compaction before it exits
+        self.compaction = threading.Thread(target=self.compact)
+        self.compaction.start()
+
+
+def init_kb_index(args, model: Encoder, DataLoader, encoding_cache: EncodingCache):
+    '''
+    open --kb_index_dir, build it from --kb_file if it is empty and apply --kb_diff_file
+    '''
+    if not args.kb_index_dir:
+        return None
+    kb_index = KBIndex(args, args.kb_index_dir)
+    checkpoint = checkpoint_hash(args)
+    with torch.no_grad():
+        model.eval()
+        model.to(device)
+        if len(kb_index.segments) == 0:
+            kb_index.manifest["checkpoint"] = checkpoint
+            kb_index.update(model, DataLoader, read_lines(args.kb_file), set(), encoding_cache)
+        else:
+            kb_index.check_checkpoint(model, DataLoader, checkpoint, encoding_cache)
+        if args.kb_diff_file:
+            kb_index.apply_diff(model, DataLoader, args.kb_diff_file, encoding_cache)
+        if args.kb_index_check and not kb_index.check(model, DataLoader, args.kb_index_check, encoding_cache):
+            exit(1)
+    return kb_index
+
+
+if __name__ == "__main__":
+    # write the diff between two versions of the KB (and alias) file, for --kb_diff_file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--old_kb_file", required=True)
+    parser.add_argument("--new_kb_file", required=True)
+    parser.add_argument("--old_alia_file", default=None)
+    parser.add_argument("--new_alia_file", default=None)
+    parser.add_argument("--kb_str_idx", type=int, default=1)
+    parser.add_argument("--kb_id_idx", type=int, default=0)
+    parser.add_argument("--diff_file", required=True)
+    args = parser.parse_args()
+    diff = diff_kb_files(args.old_kb_file, args.new_kb_file, args.kb_id_idx, args.kb_str_idx, args.old_alia_file, args.new_alia_file)
+    with open(args.diff_file, "w", encoding="utf-8") as f:
+        for line in diff:
+            f.write(line + "\n")
+    print("[INFO] {} removed, {} added or changed".format(sum(x.startswith("- ") for x in diff), sum(x.startswith("+ ") for x in diff)))
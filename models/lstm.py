@@ -6,9 +6,18 @@ from  torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from models.base_train import run, init_train
 from models.base_encoder import Encoder, create_optimizer
 from data_loader.data_loader import BaseBatch, BaseDataLoader
-from models.base_test import init_test, eval_dataset, reset_unk_weight
+from models.base_test import init_test, eval_dataset, reset_unk_weight, init_encoding_cache, init_test_runs, init_result_cache
+from models.tiers import init_tiers
+from models.fast_path import init_fast_path
+from models.cascade import init_cascade
+from models.kb_index import init_kb_index
+from models.projection import init_projection
+from models.memory_plan import init_memory_plan
+from models.bundle import load_bundle_model
+from models.precision import init_precision
 from utils.similarity_calculator import Similarity
 from utils.constant import DEVICE, RANDOM_SEED
+from utils.vocab import lookup_tokens
 import numpy as np
 
 random_seed = RANDOM_SEED
@@ -84,14 +93,10 @@ class DataLoader(BaseDataLoader):
                 tks = line.strip().split(" ||| ")
                 if encoding_num == 1:
                     # make it a list
-                    string = [x2i_map[char] for char in tks[str_idx]]
-                    all_string = [string]
+                    all_string = lookup_tokens(x2i_map, [tks[str_idx]])
                 else:
-                    all_string = []
                     alias = self.get_alias(tks, str_idx, id_idx, encoding_num)
-                    for i in range(encoding_num):
-                        string = [x2i_map[char] for char in alias[i]]
-                        all_string.append(string)
+                    all_string = lookup_tokens(x2i_map, alias[:encoding_num])
 
                 for s in all_string:
                     for ss in s:
@@ -100,13 +105,7 @@ class DataLoader(BaseDataLoader):
                 yield ([all_string], tks[id_idx])
         print("[INFO] number of lines in {}: {}".format(file_name, str(line_tot)))
 
-    def transform_one_batch(self, batch_data: list) -> list:
-        batch_size = len(batch_data)
-        batch_lens = torch.LongTensor([len(x) for x in batch_data])
-        max_len = torch.max(batch_lens)
-        batch_tensor = torch.zeros((batch_size, max_len)).long()
-        for idx, (seq, seq_len) in enumerate(zip(batch_data, batch_lens)):
-            batch_tensor[idx, :seq_len] = torch.LongTensor(seq)
+    def transform_padded(self, batch_tensor, batch_lens) -> list:
         # sort
         batch_lens, perm_idx = torch.sort(batch_lens, dim=0, descending=True)
         batch_tensor = batch_tensor[perm_idx]
@@ -159,6 +158,12 @@ class LSTMEncoder(Encoder):
                 else:
                     nn.init.constant_(param, 0.0)
 
+    def side_encoder(self, is_src):
+        # calc_encode of one side as a module that could be scripted (models/bundle.py)
+        if is_src:
+            return LSTMSide(self.src_lookup, self.src_lstm, self.use_avg, self.hidden_size)
+        return LSTMSide(self.trg_lookup, self.trg_lstm, self.use_avg, self.hidden_size)
+
     # calc_batch_similarity will return the similarity of the batch
     # while calc encode only return the encoding result of src or trg of the batch
     def calc_encode(self, batch, is_src, is_mid=False):
@@ -203,6 +208,32 @@ class LSTMEncoder(Encoder):
 
         return reorder_encoded
 
+class LSTMSide(nn.Module):
+    '''
+    calc_encode of the src or trg side at test time, without the branches on the side
+    its TorchScript graph is loaded without the model classes (GraphEncoder)
+    '''
+    def __init__(self, lookup: nn.Embedding, lstm: nn.LSTM, use_avg: bool, hidden_size: int):
+        super(LSTMSide, self).__init__()
+        self.name = "bilstm"
+        self.hidden_size = hidden_size
+        self.lookup = lookup
+        self.lstm = lstm
+        self.use_avg = use_avg
+
+    def forward(self, input, input_lens, perm_idx):
+        packed = pack_padded_sequence(self.lookup(input), input_lens, batch_first=False)
+        packed_output, (hidden, cached) = self.lstm(packed)
+        if not self.use_avg:
+            # [batch, hidden * 2], the last hidden states of both directions
+            encoded = torch.transpose(hidden, 0, 1).contiguous().view(-1, self.hidden_size)
+        else:
+            output, _ = pad_packed_sequence(packed_output)
+            # [batch, 2 * hidden]
+            encoded = torch.sum(torch.transpose(output, 0, 1), dim=1) / input_lens.unsqueeze(-1).float()
+        # back to the order of the batch
+        return encoded[torch.sort(perm_idx, 0)[1]]
+
 class AvgLSTMEncoder(LSTMEncoder):
     def __init__(self, src_vocab_size, trg_vocab_size, embed_size, hidden_size, similarity_measure:Similarity,
                  use_mid, mid_vocab_size=0):
@@ -275,17 +306,32 @@ def main(args):
         run(data_loader, model, criterion, optimizer, scheduler, similarity_measure, save_model, args)
     else:
         base_data_loader, intermedia_stuff = init_test(args, DataLoader)
-        model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
-        similarity_measure = Similarity(args.similarity_measure)
-        model = LSTMEncoder(model_info["src_vocab_size"], model_info["trg_vocab_size"],
-                        args.embed_size, args.hidden_size,
-                        similarity_measure=similarity_measure,
-                        use_mid=args.use_mid, use_avg=use_avg,
-                        mid_vocab_size=model_info.get("mid_vocab_size", 0))
-
-        model.load_state_dict(model_info["model_state_dict"], strict=False)
-        reset_unk_weight(model)
-        model.set_similarity_matrix()
+        if args.bundle_dir:
+            model, similarity_measure = load_bundle_model(args, LSTMEncoder)
+        else:
+            model_info = torch.load(args.model_path + "_" + str(args.test_epoch) + ".tar")
+            similarity_measure = Similarity(args.similarity_measure)
+            model = LSTMEncoder(model_info["src_vocab_size"], model_info["trg_vocab_size"],
+                            args.embed_size, args.hidden_size,
+                            similarity_measure=similarity_measure,
+                            use_mid=args.use_mid, use_avg=use_avg,
+                            mid_vocab_size=model_info.get("mid_vocab_size", 0))
+
+            model.load_state_dict(model_info["model_state_dict"], strict=False)
+            reset_unk_weight(model)
+            model.set_similarity_matrix()
+        model = init_precision(args, model, similarity_measure, DataLoader)
+        encoding_cache = init_encoding_cache(args)
         eval_dataset(model, similarity_measure, base_data_loader, args.encoded_test_file, args.load_encoded_test,
                      args.encoded_kb_file, args.load_encoded_kb, intermedia_stuff, args.method, args.trg_encoding_num,
-                     args.mid_encoding_num, args.result_file, args.record_recall)
+                     args.mid_encoding_num, args.result_file, args.record_recall,
+                     encoding_cache=encoding_cache,
+                     extra_runs=init_test_runs(args, DataLoader),
+                     query_chunk_size=args.query_chunk_size,
+                     result_cache=init_result_cache(args),
+                     shortlister=init_cascade(args, model, base_data_loader, encoding_cache),
+                     tiers=init_tiers(args),
+                     fast_path=init_fast_path(args),
+                     kb_index=init_kb_index(args, model, DataLoader, encoding_cache),
+                     projection=init_projection(args),
+                     memory_plan=init_memory_plan(args))
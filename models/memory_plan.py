@@ -0,0 +1,170 @@
+import functools
+import resource
+import torch
+from data_loader.data_loader import BaseDataLoader
+from models.base_encoder import Encoder
+from utils.trace import NULL_SPAN
+
+print = functools.partial(print, flush=True)
+
+MB = float(2 ** 20)
+
+
+def read_status_mb(key):
+    # VmRSS (current) or VmHWM (peak) resident memory from /proc, None if it is not available (not linux)
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_mb():
+    rss = read_status_mb("VmRSS")
+    return rss if rss is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def peak_rss_mb():
+    peak = read_status_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    # on linux, writing 5 to clear_refs resets the peak RSS (VmHWM) to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def count_lines(fname):
+    with open(fname, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+
+
+def encoding_dim(model: Encoder, data_loader: BaseDataLoader):
+    # the size of one encoding, e.g. the 300 dimensions of the linear layer of charcnn
+    batch = data_loader.create_sequence_batches([[data_loader.pad_idx] * 8], is_src=True, is_mid=False)[0]
+    with torch.no_grad():
+        return int(model.calc_encode(batch, is_src=True).shape[1])
+
+
+class MemoryStage:
+    def __init__(self, memory_plan, name):
+        self.memory_plan = memory_plan
+        self.name = name
+
+    def __enter__(self):
+        self.reset = reset_peak_rss()
+        return self
+
+    def __exit__(self, *exc):
+        # without a reset the peak is the one of the process so far
+        self.memory_plan.record(self.name, peak_rss_mb(), self.reset)
+        return False
+
+
+class MemoryPlan:
+    '''
+    estimate of the peak RSS of each test stage, computed before the KB is encoded from the memory already in use
+    (model, vocab maps, loaded test data) and the size of the encodings and score matrices.
+    score matrices grow with the number of queries ranked at once, with --memory_budget the queries are ranked
+    in the largest chunks that fit. the actual peak RSS of each stage is reported at the end
+    '''
+    def __init__(self, budget_mb=0):
+        self.budget_mb = budget_mb
+        self.estimates = {}
+        # stage -> (peak RSS MB, whether the peak was reset at the start of the stage)
+        self.peaks = {}
+
+    @staticmethod
+    def score_bytes_per_query(size, encoding_num):
+        # one row of the scores of all versions and their hstack copy (Similarity split), then the max over versions
+        # with its exact_match copy and the argpartition indices of get_topk
+        return 8 * size * max(encoding_num, 2) + 8 * size
+
+    def estimate(self, base_mb, kb_size, query_num, pivot_size, dim, trg_encoding_num, mid_encoding_num, method, chunk_size,
+                 kb_rows=None, kb_dim=None):
+        '''
+        :param base_mb: RSS before the KB is encoded
+        :param chunk_size: number of queries ranked at once
+        :param kb_rows: number of KB rows encoded and kept (kb_size by default, 0 if a cascade encodes its shortlists only)
+        :param kb_dim: floats kept per KB encoding (dim by default, fewer with --projection_dim)
+        :return: stage -> estimated peak RSS in MB
+        '''
+        kb_rows = kb_size if kb_rows is None else kb_rows
+        kb_dim = dim if kb_dim is None else kb_dim
+        # the KB is encoded in dim dimensions, then projected
+        encoded_kb_mb = kb_rows * trg_encoding_num * dim * 4 / MB
+        kb_mb = kb_rows * trg_encoding_num * kb_dim * 4 / MB
+        pivot_mb = pivot_size * mid_encoding_num * dim * 4 / MB if method == "pivoting" else 0.0
+        query_mb = query_num * dim * 4 / MB
+        score_mb = self.score_bytes_per_query(kb_size, trg_encoding_num) * chunk_size / MB
+        if method == "pivoting":
+            # the scores of the KB are freed before the pivot strings are scored
+            score_mb = max(score_mb, self.score_bytes_per_query(pivot_size, mid_encoding_num) * chunk_size / MB)
+        # encodings are collected batch by batch and then stacked, both copies exist for a while
+        estimates = {"encode_kb": base_mb + 2 * encoded_kb_mb + (kb_mb if kb_dim != dim else 0.0)}
+        if method == "pivoting":
+            estimates["encode_pivot"] = base_mb + kb_mb + 2 * pivot_mb
+        estimates["encode_queries"] = base_mb + kb_mb + pivot_mb + 2 * query_mb
+        estimates["rank"] = base_mb + kb_mb + pivot_mb + query_mb + score_mb
+        return estimates
+
+    def plan(self, kb_size, query_num, pivot_size, dim, trg_encoding_num, mid_encoding_num, method, query_chunk_size=0,
+             kb_rows=None, kb_dim=None):
+        '''
+        :param query_chunk_size: chunk size of the streamed queries (--query_chunk_size), 0 if the queries are not streamed
+        :param kb_rows, kb_dim: KB encodings kept during the test, see estimate
+        :return: the number of queries to rank at once, 0 for all of them
+        '''
+        base_mb = current_rss_mb()
+        chunk_size = query_chunk_size if query_chunk_size > 0 else query_num
+        estimate = functools.partial(self.estimate, base_mb, kb_size, query_num, pivot_size, dim, trg_encoding_num, mid_encoding_num, method,
+                                     kb_rows=kb_rows, kb_dim=kb_dim)
+        if self.budget_mb > 0:
+            fixed = estimate(0)["rank"]
+            one = estimate(1)["rank"] - fixed
+            chunk_size = max(1, min(chunk_size, int((self.budget_mb - fixed) / one)))
+        self.estimates = estimate(chunk_size)
+        print("[INFO] memory plan: {} KB entities x {} versions ({} encoded, {} dimensions kept), {} queries, {} pivot strings, "
+              "{} dimensions, {} queries ranked at once".format(kb_size, trg_encoding_num, kb_size if kb_rows is None else kb_rows,
+                                                                dim if kb_dim is None else kb_dim, query_num, pivot_size, dim, chunk_size))
+        for name, mb in self.estimates.items():
+            print("[INFO] estimated peak RSS of {}: {:.1f}MB".format(name, mb))
+        if self.budget_mb > 0:
+            over = [name for name, mb in self.estimates.items() if mb > self.budget_mb]
+            if len(over) != 0:
+                print("[WARNING] {} could exceed --memory_budget {}MB even with {} queries at once".format(
+                    ", ".join(over), self.budget_mb, chunk_size))
+        return chunk_size if chunk_size < query_num else 0
+
+    def stage(self, name):
+        return MemoryStage(self, name)
+
+    def record(self, name, peak_mb, reset):
+        # a stage of several test files keeps its largest peak
+        old_peak, old_reset = self.peaks.get(name, (0.0, True))
+        self.peaks[name] = (max(old_peak, peak_mb), old_reset and reset)
+
+    def report(self):
+        print("===============peak RSS of each stage===============")
+        for name, (peak_mb, reset) in self.peaks.items():
+            estimate = " (estimated {:.1f}MB)".format(self.estimates[name]) if name in self.estimates else ""
+            print("[INFO] {}: {:.1f}MB{}{}".format(name, peak_mb, estimate, "" if reset else ", peak of the process so far"))
+
+
+def memory_stage(memory_plan: MemoryPlan, name):
+    # with memory_stage(memory_plan, "rank"): ... records the peak RSS of the block, nothing if memory_plan is None
+    return memory_plan.stage(name) if memory_plan is not None else NULL_SPAN
+
+
+def init_memory_plan(args):
+    if args.memory_budget <= 0 and not args.memory_report:
+        return None
+    return MemoryPlan(args.memory_budget)
@@ -0,0 +1,125 @@
+import io
+import copy
+import functools
+import warnings
+import contextlib
+import torch
+import numpy as np
+from torch import nn
+from models.base_encoder import Encoder
+from models.base_test import get_encodings
+from data_loader.data_loader import BaseBatch
+from utils.similarity_calculator import Similarity
+from utils.func import FileInfo
+from utils.constant import DEVICE
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+# recall@k of the dev file compared between float32 and the reduced precision
+CHECK_TOPK = (1, 10, 30)
+
+
+def quantize_int8(model: Encoder, inplace=True) -> Encoder:
+    '''
+    dynamic int8 quantization: int8 weights of the Linear and LSTM layers, activations are quantized per batch,
+    and int8 rows (with a scale per row) for the n-gram embeddings of charagram, most of its weights
+    the conv layers of charcnn have no dynamic int8 kernel, they stay float32
+    '''
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favor of torchao, which is not a dependency
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+        qconfig_spec = {nn.Linear: default_dynamic_qconfig, nn.LSTM: default_dynamic_qconfig}
+        # the quantized embedding needs contiguous indices, the char inputs of the LSTM are transposed
+        if model.name == "charagram":
+            qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+        return quantize_dynamic(model if inplace else copy.deepcopy(model), qconfig_spec, dtype=torch.qint8)
+
+
+class PrecisionEncoder(Encoder):
+    '''
+    model that encodes in reduced precision: bf16 autocast (matmuls, convolutions and the LSTM in bf16,
+    charagram only sums embeddings and is not changed) or dynamic int8 quantization (quantize_int8)
+    encodings are float32 as those of the model, the similarity matrices are the ones of the model
+    :param keep_model: quantize a copy, model is still used in float32 (check_precision)
+    '''
+    def __init__(self, model: Encoder, precision, keep_model=False):
+        # the matrices of Encoder are not created
+        nn.Module.__init__(self)
+        self.name = model.name
+        self.hidden_size = model.hidden_size
+        self.precision = precision
+        self.model = quantize_int8(model, inplace=not keep_model) if precision == "int8" else model
+        self.src_trg_bl, self.src_mid_bl = model.src_trg_bl, model.src_mid_bl
+        self.src_affine, self.trg_affine = model.src_affine, model.trg_affine
+        self.similarity_measure = model.similarity_measure
+
+    def calc_encode(self, batch: BaseBatch, is_src, is_mid=False):
+        if self.precision == "bf16":
+            with torch.autocast(device.type, dtype=torch.bfloat16):
+                return self.model.calc_encode(batch, is_src=is_src, is_mid=is_mid).float()
+        return self.model.calc_encode(batch, is_src=is_src, is_mid=is_mid)
+
+
+def dev_recall(model: Encoder, similarity_measure: Similarity, data_loader, trg_encoding_num, topk=CHECK_TOPK):
+    '''
+    the dev mentions ranked against the dev entities (with their aliases)
+    :return: recall@k for each k in topk, top 30 entity ids of each mention
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        src_encodings, gold_ids, _ = get_encodings(model, data_loader, False, None, is_src=True, is_mid=False, encoding_num=1)
+        trg_encodings, kb_ids, _ = get_encodings(model, data_loader, False, None, is_src=False, is_mid=False,
+                                                 encoding_num=trg_encoding_num)
+        scores = similarity_measure(src_encodings, trg_encodings, is_src_trg=True, split=True, pieces=10, negative_sample=None,
+                                    encoding_num=trg_encoding_num)
+    ranked = kb_ids[np.argsort(-scores, axis=1, kind="stable")[:, :max(topk)]]
+    recall = {k: float(np.mean(np.any(ranked[:, :k] == gold_ids[:, None], axis=1))) for k in topk}
+    return recall, ranked
+
+
+def check_precision(args, model: Encoder, reduced: Encoder, similarity_measure: Similarity, DataLoader):
+    '''
+    recall@k of the dev file (--dev_file, mentions against the entities of the file) in float32 and in --inference_precision
+    :return: whether no recall drops by more than --precision_tolerance
+    '''
+    dev_file = FileInfo()
+    dev_file.set_all(args.dev_file, args.src_idx, args.trg_idx, args.trg_id_idx, args.trg_type_idx)
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_loader = DataLoader(is_train=False, args=args, train_file=None, dev_file=None, test_file=dev_file)
+    with torch.no_grad():
+        model.eval()
+        model.to(device)
+        reduced.eval()
+        reduced.to(device)
+        fp32_recall, fp32_ranked = dev_recall(model, similarity_measure, data_loader, args.trg_encoding_num)
+        recall, ranked = dev_recall(reduced, similarity_measure, data_loader, args.trg_encoding_num)
+    passed = True
+    print("===============recall of {} against fp32 on {}===============".format(args.inference_precision, args.dev_file))
+    for k in CHECK_TOPK:
+        drop = fp32_recall[k] - recall[k]
+        passed = passed and drop <= args.precision_tolerance
+        print("[INFO] recall@{}: fp32 {:.4f}, {} {:.4f} ({:+.4f})".format(k, fp32_recall[k], args.inference_precision, recall[k], -drop))
+    print("[INFO] same top 1: {:.4f}".format(float(np.mean(ranked[:, 0] == fp32_ranked[:, 0]))))
+    if passed:
+        print("[INFO] {} passes the check, no recall drops by more than {}".format(args.inference_precision, args.precision_tolerance))
+    else:
+        print("[WARNING] {} fails the check, a recall drops by more than {}".format(args.inference_precision, args.precision_tolerance))
+    return passed
+
+
+def init_precision(args, model: Encoder, similarity_measure: Similarity, DataLoader) -> Encoder:
+    '''
+    the model in --inference_precision, checked against float32 on --dev_file first with --precision_check
+    the test stops (exit code 1) if the check fails
+    '''
+    if args.inference_precision == "fp32":
+        return model
+    if args.inference_precision == "int8" and device.type != "cpu":
+        raise ValueError("dynamic int8 quantization runs on CPU only")
+    reduced = PrecisionEncoder(model, args.inference_precision, keep_model=args.precision_check)
+    if args.precision_check and not check_precision(args, model, reduced, similarity_measure, DataLoader):
+        exit(1)
+    print("[INFO] encode in {}".format(args.inference_precision))
+    return reduced
@@ -0,0 +1,83 @@
+import functools
+import itertools
+import numpy as np
+from models.base_test import rank_shortlist, gather_kb_rows, print_recall
+from utils.func import FileInfo
+from utils.ngram_index import load_ngram_index
+from utils.similarity_calculator import Similarity
+from utils.string_store import load_string_column, find_strings
+from utils.type_index import TypeIndex, NO_TYPE
+
+print = functools.partial(print, flush=True)
+
+
+class NgramPrefilter:
+    '''
+    lexical prefilter: the character n-gram index of the KB strings gives the candidates of each query,
+    only these candidates are scored with the dense encodings instead of the whole KB
+    '''
+    def __init__(self, args):
+        # the KB is encoded by the main model, candidates are taken from its encodings
+        self.encodes_kb = True
+        self.prefilter_size = args.prefilter_size
+        self.max_df = args.prefilter_max_df
+        self.trg_encoding_num = args.trg_encoding_num
+        self.kb_ids, self.kb_entity_string = load_string_column(args.kb_file, args.kb_str_idx, args.kb_id_idx)
+        self.index = load_ngram_index(args.kb_file, args.kb_str_idx, self.kb_entity_string)
+        self.recall, self.tot, self.candidate_tot = 0, 0, 0
+
+    def search(self, plain_text, kb_rows=None, exact_row=-1):
+        rows = self.index.search(plain_text, self.prefilter_size, self.max_df, kb_rows=kb_rows)
+        # the exact match of the query is always a candidate
+        if exact_row != -1 and (kb_rows is None or np.isin(exact_row, kb_rows)):
+            rows = np.concatenate([[exact_row], rows[rows != exact_row]])[:self.prefilter_size]
+        return rows
+
+    def shortlist_chunks(self, test_file: FileInfo, chunk_size, type_index: TypeIndex=None):
+        '''
+        read the test file in the same chunks as read_query_chunks
+        :return: a generator of the shortlist of each chunk, KB rows [chunk_size, prefilter_size], -1 for padding
+        '''
+        self.recall, self.tot, self.candidate_tot = 0, 0, 0
+        with open(test_file.src_file_name, "r", encoding="utf-8") as f:
+            lines = (line.strip().split(" ||| ") for line in f)
+            while True:
+                chunk = list(itertools.islice(lines, chunk_size))
+                if len(chunk) == 0:
+                    break
+                plain_text = [tks[test_file.src_str_idx] for tks in chunk]
+                exact_rows = find_strings(self.kb_entity_string, plain_text)
+                shortlist = np.full((len(chunk), self.prefilter_size), -1, dtype=np.int64)
+                for i, tks in enumerate(chunk):
+                    kb_rows = None
+                    if type_index is not None and test_file.src_type_idx >= 0:
+                        kb_rows = type_index.partition(tks[test_file.src_type_idx] if test_file.src_type_idx < len(tks) else NO_TYPE)
+                    rows = self.search(plain_text[i], kb_rows, exact_rows[i])
+                    shortlist[i, :len(rows)] = rows
+                    # the recall of the candidates bounds the recall of the dense model
+                    self.recall += int(tks[test_file.src_id_idx]) in self.kb_ids[rows]
+                    self.candidate_tot += len(rows)
+                self.tot += len(chunk)
+                yield shortlist
+
+    def shortlist_file(self, test_file: FileInfo, type_index: TypeIndex=None, chunk_size=1024):
+        return np.vstack(list(self.shortlist_chunks(test_file, chunk_size, type_index)))
+
+    def print_recall(self):
+        print_recall("prefilter recall", {str(self.prefilter_size): self.recall}, float(self.tot))
+        avg_candidate = self.candidate_tot / max(self.tot, 1)
+        print("[INFO] {:.1f} candidates per query, {:.4f} of the KB".format(avg_candidate, avg_candidate / len(self.kb_entity_string)))
+
+    def rerank(self, test_data_encodings: np.ndarray, test_data_plain: list, shortlist: np.ndarray, kb_encodings: np.ndarray, kb_entity_string,
+               similarity_calculator: Similarity, use_exact_match=True, topk=100):
+        def encode_rows(rows):
+            return gather_kb_rows(kb_encodings, rows, self.trg_encoding_num)
+        return rank_shortlist(test_data_encodings, test_data_plain, shortlist, encode_rows, kb_entity_string,
+                              similarity_calculator, self.trg_encoding_num, use_exact_match, topk)
+
+
+def init_prefilter(args):
+    # --prefilter_size 0 disables the prefilter, every query is scored against the whole KB
+    if args.prefilter_size <= 0:
+        return None
+    return NgramPrefilter(args)
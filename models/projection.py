@@ -0,0 +1,109 @@
+import functools
+import torch
+import numpy as np
+from models.base_test import rank_kb, update_recall, print_recall
+from utils.similarity_calculator import Similarity
+from utils.constant import DEVICE, RANDOM_SEED
+
+print = functools.partial(print, flush=True)
+device = DEVICE
+
+
+def to_score_space(similarity_calculator: Similarity, encodings: np.ndarray, is_src, chunk_size=100000) -> np.ndarray:
+    '''
+    encodings in the space where the score is a dot product (bl) or a cosine (cosine, lcosine):
+    the affine matrices of lcosine and the bilinear matrix of bl are applied to one side, cosine vectors are normalized
+    '''
+    method = similarity_calculator.method
+    chunks = []
+    for st in range(0, encodings.shape[0], chunk_size):
+        x = torch.from_numpy(np.ascontiguousarray(encodings[st:st + chunk_size])).to(device).float()
+        if method == "lcosine":
+            x = torch.mm(x, similarity_calculator.src_affine if is_src else similarity_calculator.trg_affine)
+        elif method == "bl" and not is_src:
+            # src bl trg^T = src (trg bl^T)^T
+            x = torch.mm(x, torch.transpose(similarity_calculator.src_trg_bl, 1, 0))
+        if method != "bl":
+            x = x / torch.norm(x, dim=1, keepdim=True)
+        chunks.append(x.cpu().numpy())
+    return np.vstack(chunks) if len(chunks) != 0 else np.zeros((0, encodings.shape[1]), dtype=np.float32)
+
+
+class ReducedSimilarity(Similarity):
+    '''
+    similarity between queries and a KB projected by KBProjection.reduce, queries are projected at each call
+    intermediate encodings (e.g. pivot) are projected like the KB (project_trg), so their scores are on the scale of the KB scores
+    '''
+    def __init__(self, full_similarity: Similarity, components: np.ndarray):
+        # bl becomes a dot product in the projected space, cosine and lcosine a cosine
+        super(ReducedSimilarity, self).__init__("bl" if full_similarity.method == "bl" else "cosine")
+        self.full_similarity = full_similarity
+        self.components = components
+        self.src_trg_bl = torch.eye(components.shape[0]).to(device)
+
+    def project(self, src_encoded: np.ndarray) -> np.ndarray:
+        return to_score_space(self.full_similarity, src_encoded, is_src=True) @ self.components.T
+
+    def project_trg(self, trg_encoded: np.ndarray) -> np.ndarray:
+        return (to_score_space(self.full_similarity, trg_encoded, is_src=False) @ self.components.T).astype(np.float32)
+
+    def __call__(self, src_encoded: np.ndarray, trg_encoded: np.ndarray, is_src_trg, split, pieces, negative_sample, encoding_num):
+        # trg_encoded is projected (KB or intermediate encodings), both are scored in the projected space
+        return super(ReducedSimilarity, self).__call__(self.project(src_encoded), trg_encoded, True,
+                                                       split, pieces, negative_sample, encoding_num)
+
+
+class KBProjection:
+    '''
+    PCA of the KB encodings in the score space (to_score_space), the KB is stored with dim dimensions
+    and queries are projected the same way when they are scored against it
+    '''
+    def __init__(self, dim, report_dims=(), sample_size=100000):
+        self.dim = dim
+        self.report_dims = list(report_dims)
+        self.sample_size = sample_size
+        self.components = None
+
+    def fit(self, kb_encodings: np.ndarray, similarity_calculator: Similarity):
+        # the principal directions of a sample of the KB (all versions), not centered, so dot products are kept
+        rows = np.arange(kb_encodings.shape[0])
+        if len(rows) > self.sample_size:
+            rows = np.sort(np.random.RandomState(RANDOM_SEED).choice(len(rows), self.sample_size, replace=False))
+        sample = to_score_space(similarity_calculator, kb_encodings[rows], is_src=False)
+        _, singular_values, self.components = np.linalg.svd(sample, full_matrices=False)
+        energy = np.cumsum(singular_values ** 2) / np.sum(singular_values ** 2)
+        for dim in sorted(set([self.dim] + self.report_dims) - {0}):
+            print("[INFO] {} dimensions keep {:.4f} of the KB energy".format(dim, energy[min(dim, len(energy)) - 1]))
+
+    def reduce(self, kb_encodings: np.ndarray, similarity_calculator: Similarity, dim):
+        '''
+        :return: the similarity to use with the projected KB, and the projected KB (same layout as kb_encodings)
+        '''
+        reduced_similarity = ReducedSimilarity(similarity_calculator, self.components[:dim])
+        reduced_kb = reduced_similarity.project_trg(kb_encodings)
+        print("[INFO] KB encodings {:.1f}MB -> {:.1f}MB".format(kb_encodings.nbytes / 2 ** 20, reduced_kb.nbytes / 2 ** 20))
+        return reduced_similarity, reduced_kb
+
+    def report(self, test_data_encodings: np.ndarray, test_gold_kb_ids: np.ndarray, test_data_plain: list,
+               kb_encodings: np.ndarray, kb_ids: np.ndarray, kb_entity_string, similarity_calculator: Similarity, trg_encoding_num,
+               topk_list=(1, 2, 5, 10, 30)):
+        # recall of the full dimension and of each --projection_report size, with the full (not projected) kb_encodings
+        for dim in [0] + self.report_dims:
+            if dim == 0:
+                cur_similarity, cur_kb = similarity_calculator, kb_encodings
+            else:
+                cur_similarity, cur_kb = self.reduce(kb_encodings, similarity_calculator, dim)
+            top_idx, _ = rank_kb(test_data_encodings, test_data_plain, cur_kb, kb_entity_string, cur_similarity,
+                                 trg_encoding_num, topk=max(topk_list))
+            recall = {str(topk): 0 for topk in topk_list}
+            for ranked_idxs, gold_kb_id in zip(top_idx, test_gold_kb_ids):
+                update_recall(gold_kb_id, kb_ids[ranked_idxs[ranked_idxs >= 0]], recall, topk_list)
+            print_recall("projection recall, {} dimensions".format(dim if dim != 0 else "full"), recall, float(len(test_data_plain)))
+
+
+def init_projection(args):
+    # neither --projection_dim nor --projection_report, the KB keeps the dimension of the encoder
+    if args.projection_dim <= 0 and not args.projection_report:
+        return None
+    report_dims = [int(x) for x in args.projection_report.split(",")] if args.projection_report else []
+    return KBProjection(args.projection_dim, report_dims, args.projection_sample_size)
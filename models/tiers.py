@@ -0,0 +1,142 @@
+import functools
+import numpy as np
+from models.base_test import rank_kb, merge_topk
+from models.fast_path import MATCH_SCORE
+from utils.func import FileInfo
+from utils.similarity_calculator import Similarity
+from utils.string_store import load_string_column, find_strings
+
+print = functools.partial(print, flush=True)
+
+
+def load_prior(files, kb_ids: np.ndarray, id_idx=0) -> np.ndarray:
+    '''
+    :param files: link files (one link to the entity in column id_idx per line, e.g. ee-me_train)
+    or count files (id ||| count per line)
+    :return: prior count of each KB row
+    '''
+    ids, counts = [], []
+    for fname in files:
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                tks = line.strip().split(" ||| ")
+                if len(tks) == 2:
+                    ids.append(int(tks[0]))
+                    counts.append(int(tks[1]))
+                elif len(tks) > id_idx:
+                    ids.append(int(tks[id_idx]))
+                    counts.append(1)
+    ids, counts = np.array(ids, dtype=np.int64), np.array(counts, dtype=np.int64)
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    unique_counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique_ids))
+    prior = np.zeros(len(kb_ids), dtype=np.int64)
+    if len(unique_ids) != 0:
+        pos = np.minimum(np.searchsorted(unique_ids, kb_ids), len(unique_ids) - 1)
+        found = unique_ids[pos] == kb_ids
+        prior[found] = unique_counts[pos[found]]
+    return prior
+
+
+class PopularityTiers:
+    '''
+    KB rows split into tiers by their prior (most linked first), queries are ranked against the hot tier first
+    and only go on to the next tier when their best score is below threshold
+    '''
+    def __init__(self, kb_ids: np.ndarray, prior: np.ndarray, tier_sizes: list, threshold):
+        self.kb_ids = kb_ids
+        self.threshold = threshold
+        order = np.argsort(-prior, kind="stable")
+        bounds = [0] + [x for x in np.cumsum(tier_sizes) if x < len(order)] + [len(order)]
+        self.tier_rows = [np.sort(order[st:ed]) for st, ed in zip(bounds[:-1], bounds[1:])]
+        self.row_tier = np.zeros(len(order), dtype=np.int64)
+        for tier, rows in enumerate(self.tier_rows):
+            self.row_tier[rows] = tier
+        print("[INFO] KB tiers: {}".format([len(x) for x in self.tier_rows]))
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.tier_queries = [0 for _ in self.tier_rows]
+        # mention -> the tier it stopped at, the same string always stops at the same tier
+        self.exit_tier = {}
+        # mention -> encoding and returned rows of the queries that stopped before the last tier, checked by print_stats
+        self.early_exit = {}
+        self.full_search = None
+
+    def rank(self, test_data_encodings: np.ndarray, test_data_plain: list, kb_encodings: np.ndarray, kb_entity_string,
+             similarity_calculator: Similarity, trg_encoding_num, use_exact_match=True, topk=100):
+        '''
+        :return: topk of each query among the tiers it was ranked against, idx are rows of the whole KB
+        the exact match of a query (as in rank_kb, the first KB row of the same title) is always first, whatever its tier
+        '''
+        limit = min(len(self.kb_ids), topk)
+        top_idx = np.full((len(test_data_plain), limit), -1, dtype=np.int64)
+        top_scores = np.full((len(test_data_plain), limit), -np.inf, dtype=np.float32)
+        exact_rows = find_strings(kb_entity_string, test_data_plain) if use_exact_match else np.full(len(test_data_plain), -1)
+        matched = exact_rows != -1
+        top_idx[matched, 0] = exact_rows[matched]
+        top_scores[matched, 0] = MATCH_SCORE
+        pending = np.arange(len(test_data_plain))
+        self.full_search = (kb_encodings, kb_entity_string, similarity_calculator, trg_encoding_num, use_exact_match, topk)
+        for tier, rows in enumerate(self.tier_rows):
+            self.tier_queries[tier] += len(pending)
+            cur_idx, cur_scores = rank_kb(test_data_encodings[pending], [test_data_plain[i] for i in pending],
+                                          kb_encodings, kb_entity_string, similarity_calculator, trg_encoding_num,
+                                          False, kb_rows=rows, topk=topk)
+            # the exact match is already in the list with its score
+            duplicate = cur_idx == exact_rows[pending, None]
+            cur_idx[duplicate], cur_scores[duplicate] = -1, -np.inf
+            top_idx[pending], top_scores[pending] = merge_topk(top_idx[pending], top_scores[pending], cur_idx, cur_scores, 0, limit)
+            # confident queries exit, the others are ranked against the next tier as well
+            confident = top_scores[pending, 0] >= self.threshold
+            for i in pending[confident]:
+                self.exit_tier[test_data_plain[i]] = tier
+                if tier < len(self.tier_rows) - 1:
+                    self.early_exit[test_data_plain[i]] = (test_data_encodings[i], top_idx[i].copy())
+            pending = pending[~confident]
+            if len(pending) == 0:
+                break
+        for i in pending:
+            self.exit_tier[test_data_plain[i]] = len(self.tier_rows) - 1
+        return top_idx, top_scores
+
+    def print_stats(self, test_file: FileInfo):
+        '''
+        escalation rate of each tier, and the recall lost by early exit: queries that stopped before the tier of their gold entity,
+        whose gold is not in the returned list but is in the list of a search of the whole KB
+        '''
+        for tier, tot in enumerate(self.tier_queries):
+            print("[INFO] tier {}: {} entities, ranked {} queries ({:.4f})".format(tier, len(self.tier_rows[tier]), tot,
+                                                                                  tot / max(self.tier_queries[0], 1)))
+        kb_row = {kb_id: row for row, kb_id in enumerate(self.kb_ids)}
+        missed, tot = [], 0
+        with open(test_file.src_file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                tks = line.strip().split(" ||| ")
+                mention, gold_id = tks[test_file.src_str_idx], int(tks[test_file.src_id_idx])
+                exit_tier = self.exit_tier.get(mention)
+                gold_row = kb_row.get(gold_id)
+                if exit_tier is None or gold_row is None:
+                    continue
+                tot += 1
+                if mention in self.early_exit and self.row_tier[gold_row] > exit_tier:
+                    returned = self.early_exit[mention][1]
+                    if gold_id not in self.kb_ids[returned[returned >= 0]]:
+                        missed.append((mention, gold_id))
+        lost = 0
+        if len(missed) != 0:
+            # only the queries that missed their gold are searched again in the whole KB
+            kb_encodings, kb_entity_string, similarity_calculator, trg_encoding_num, use_exact_match, topk = self.full_search
+            full_idx, _ = rank_kb(np.stack([self.early_exit[x][0] for x, _ in missed]), [x for x, _ in missed],
+                                  kb_encodings, kb_entity_string, similarity_calculator, trg_encoding_num, use_exact_match, topk=topk)
+            lost = sum(int(gold_id in self.kb_ids[ranked[ranked >= 0]]) for ranked, (_, gold_id) in zip(full_idx, missed))
+        print("[INFO] {}/{} queries stopped before the tier of their gold entity and missed it, a full search finds it".format(lost, tot))
+        self.reset_stats()
+
+
+def init_tiers(args):
+    # no --tier_sizes, the whole KB is one tier
+    if not args.tier_sizes:
+        return None
+    kb_ids, _ = load_string_column(args.kb_file, args.kb_str_idx, args.kb_id_idx)
+    prior = load_prior(args.prior_file.split(","), kb_ids)
+    return PopularityTiers(kb_ids, prior, [int(x) for x in args.tier_sizes.split(",")], args.tier_threshold)
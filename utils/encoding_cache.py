@@ -0,0 +1,105 @@
+import os
+import glob
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def hash_file(fname, block_size=1 << 20):
+    h = hashlib.blake2b(digest_size=8)
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_sequence(seq) -> int:
+    # the key of a string is the idx sequence the encoder sees, i.e. after vocab mapping and n gram filtering
+    data = np.asarray(seq, dtype=np.int32).tobytes()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True)
+
+
+class EncodingCache:
+    '''
+    content addressed cache of string encodings, keyed by (checkpoint hash, side, idx sequence)
+    memory: LRU of at most max_size encodings
+    disk (optional): cache_dir/<checkpoint hash>_<side>/shard_<n>.{keys,vec}.npy, new encodings are appended as a new shard
+    get and put are locked, with --query_chunk_size and a cascade the encode and rank threads share the cache
+    '''
+    def __init__(self, checkpoint_hash, cache_dir="", max_size=100000):
+        self.checkpoint_hash = checkpoint_hash
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        # side -> [sorted keys, shard of each key, row of each key, list of mmap-ed shard vectors]
+        self.disk_index = {}
+        self.hit, self.miss = 0, 0
+
+    def side_dir(self, side):
+        return os.path.join(self.cache_dir, "{}_{}".format(self.checkpoint_hash, side))
+
+    def load_disk_index(self, side):
+        if side in self.disk_index:
+            return self.disk_index[side]
+        keys, shard_ids, rows, vectors = [], [], [], []
+        if self.cache_dir:
+            for shard_id, key_file in enumerate(sorted(glob.glob(os.path.join(self.side_dir(side), "shard_*.keys.npy")))):
+                cur_keys = np.load(key_file)
+                keys.append(cur_keys)
+                shard_ids.append(np.full(len(cur_keys), shard_id, dtype=np.int64))
+                rows.append(np.arange(len(cur_keys)))
+                vectors.append(np.load(key_file.replace(".keys.npy", ".vec.npy"), mmap_mode="r"))
+        if len(keys) != 0:
+            keys, shard_ids, rows = np.concatenate(keys), np.concatenate(shard_ids), np.concatenate(rows)
+            order = np.argsort(keys, kind="stable")
+            index = [keys[order], shard_ids[order], rows[order], vectors]
+        else:
+            index = [np.zeros(0, dtype=np.int64), None, None, vectors]
+        self.disk_index[side] = index
+        return index
+
+    def remember(self, key, vector):
+        # a copy, a row view would keep the whole encoded array alive
+        self.lru[key] = np.array(vector)
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    def get(self, side, keys) -> list:
+        '''
+        :return: the encoding of each key, None if it is not cached
+        '''
+        with self.lock:
+            sorted_keys, shard_ids, rows, vectors = self.load_disk_index(side)
+            found = [None for _ in keys]
+            pos = np.searchsorted(sorted_keys, keys) if len(sorted_keys) != 0 else None
+            for i, key in enumerate(keys):
+                lru_key = (side, key)
+                if lru_key in self.lru:
+                    self.lru.move_to_end(lru_key)
+                    found[i] = self.lru[lru_key]
+                elif pos is not None and pos[i] < len(sorted_keys) and sorted_keys[pos[i]] == key:
+                    found[i] = np.array(vectors[shard_ids[pos[i]]][rows[pos[i]]])
+                    self.remember(lru_key, found[i])
+            cur_hit = sum(x is not None for x in found)
+            self.hit += cur_hit
+            self.miss += len(keys) - cur_hit
+            return found
+
+    def put(self, side, keys, encodings: np.ndarray):
+        with self.lock:
+            # only the last max_size encodings would stay in memory
+            start = max(0, len(keys) - self.max_size)
+            for key, vector in zip(keys[start:], encodings[start:]):
+                self.remember((side, key), vector)
+            if self.cache_dir and len(keys) != 0:
+                os.makedirs(self.side_dir(side), exist_ok=True)
+                shard_id = len(glob.glob(os.path.join(self.side_dir(side), "shard_*.keys.npy")))
+                shard = os.path.join(self.side_dir(side), "shard_{:05d}".format(shard_id))
+                # vectors first, keys mark a complete shard
+                np.save(shard + ".vec.npy", np.asarray(encodings, dtype=np.float32))
+                np.save(shard + ".keys.npy", np.array(keys, dtype=np.int64))
+                self.disk_index.pop(side, None)
+                print("[INFO] save {} encodings to {}".format(len(keys), shard))
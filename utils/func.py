@@ -24,6 +24,10 @@ class FileInfo:
         self.src_file_name = None
         self.src_str_idx = None
         self.src_id_idx = None
+        # the src file is read chunk by chunk at test time instead of loaded at once
+        self.src_stream = False
+        # entity type column of the src file at test time, -1 if the type is unknown
+        self.src_type_idx = -1
         self.trg_file_name = None
         self.trg_str_idx = None
         self.trg_id_idx = None
@@ -40,10 +44,12 @@ class FileInfo:
         self.trg_id_idx = int(id_idx)
         self.trg_type_idx = int(type_idx)
 
-    def set_src(self, file_name, str_idx, id_idx):
+    def set_src(self, file_name, str_idx, id_idx, stream=False, type_idx=-1):
         self.src_file_name = file_name
         self.src_str_idx = int(str_idx)
         self.src_id_idx = int(id_idx)
+        self.src_stream = stream
+        self.src_type_idx = int(type_idx)
 
     def set_trg(self, file_name, str_idx, id_idx, type_idx):
         self.trg_file_name = file_name
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+from utils.string_store import AliasStore
+
+# a prefix matching more keys than this is ambiguous without looking at them
+MAX_PREFIX_KEYS = 32
+
+
+def normalize(s: str) -> str:
+    return " ".join(s.lower().split())
+
+
+class LexicalIndex:
+    '''
+    normalized KB titles and aliases, sorted in ONE fixed width bytes array (a flat trie)
+    keys[i] is a title or alias of KB row rows[i], the keys starting with a prefix are a contiguous range found by np.searchsorted
+    '''
+    def __init__(self, keys: np.ndarray, rows: np.ndarray):
+        self.keys = keys
+        self.rows = rows
+
+    @classmethod
+    def build(cls, kb_ids: np.ndarray, kb_entity_string, alias_store: AliasStore=None, prefix=None):
+        keys = [normalize(s) for s in kb_entity_string]
+        rows = list(range(len(keys)))
+        if alias_store is not None:
+            kb_row = {str(kb_id): row for row, kb_id in enumerate(kb_ids)}
+            for i, (wiki_id, title) in enumerate(zip(alias_store.ids, alias_store.titles)):
+                row = kb_row.get(wiki_id)
+                if row is None:
+                    continue
+                for alias in [title] + alias_store.get_alias(i):
+                    keys.append(normalize(alias))
+                    rows.append(row)
+        keys = np.array([x.encode("utf-8") for x in keys], dtype=bytes)
+        rows = np.array(rows, dtype=np.int64)
+        # the same key of the same row is kept once
+        order = np.lexsort((rows, keys))
+        keys, rows = keys[order], rows[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (rows[1:] != rows[:-1])
+        index = cls(keys[keep], rows[keep])
+        if prefix is not None:
+            index.save(prefix)
+        return index
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(np.load(prefix + ".keys.npy", mmap_mode="r"), np.load(prefix + ".rows.npy", mmap_mode="r"))
+
+    def save(self, prefix):
+        np.save(prefix + ".keys.npy", self.keys)
+        # rows are written last, they mark a complete index
+        np.save(prefix + ".rows.npy", self.rows)
+
+    def unique_row(self, st, ed):
+        # the KB row if all keys in [st, ed) belong to one entity, else -1
+        if ed <= st or ed - st > MAX_PREFIX_KEYS:
+            return -1
+        rows = self.rows[st:ed]
+        return int(rows[0]) if np.all(rows == rows[0]) else -1
+
+    def match(self, strings, min_prefix_len=0):
+        '''
+        :param min_prefix_len: a string of at least this length could also match the keys it is a prefix of, 0 to match whole keys only
+        :return: the KB row of each string, -1 if the string matches no entity or several entities, and whether it is a prefix match
+        '''
+        query = [normalize(s) for s in strings]
+        encoded = np.array([x.encode("utf-8") for x in query], dtype=bytes)
+        matched = np.full(len(query), -1, dtype=np.int64)
+        is_prefix = np.zeros(len(query), dtype=bool)
+        if len(query) == 0 or len(self.keys) == 0:
+            return matched, is_prefix
+        st = np.searchsorted(self.keys, encoded, side="left")
+        ed = np.searchsorted(self.keys, encoded, side="right")
+        # 0xff does not appear in utf-8, key + 0xff is after every key that starts with key
+        prefix_ed = np.searchsorted(self.keys, np.array([x + b"\xff" for x in encoded]), side="left") if min_prefix_len > 0 else ed
+        for i in range(len(query)):
+            if ed[i] > st[i]:
+                matched[i] = self.unique_row(st[i], ed[i])
+            elif min_prefix_len > 0 and len(query[i]) >= min_prefix_len:
+                matched[i] = self.unique_row(st[i], prefix_ed[i])
+                is_prefix[i] = matched[i] != -1
+        return matched, is_prefix
+
+
+def load_lexical_index(fname, str_idx, kb_ids, kb_entity_string, alias_file=None) -> LexicalIndex:
+    '''
+    the index of the KB file (column str_idx) and its alias file is built once and cached next to the KB file
+    '''
+    prefix = "{}.lex{}{}".format(fname, str_idx, ".alias" if alias_file is not None else "")
+    sources = [fname] + ([alias_file] if alias_file is not None else [])
+    if not os.path.exists(prefix + ".rows.npy") or \
+            any(os.path.getmtime(prefix + ".rows.npy") < os.path.getmtime(x) for x in sources):
+        alias_store = AliasStore.open(alias_file) if alias_file is not None else None
+        index = LexicalIndex.build(kb_ids, kb_entity_string, alias_store, prefix)
+        print("[INFO] build lexical index {}, {} keys".format(prefix, len(index.keys)))
+        return index
+    return LexicalIndex.load(prefix)
@@ -0,0 +1,19 @@
+START_SYMBOL = "<s>"
+END_SYMBOL = "</s>"
+
+def get_ngram(string, ngram_list=(2,3,4,5)):
+    all_ngrams = []
+    all_st_idx = []
+    all_ed_idx = []
+    char_list = [START_SYMBOL] + list(string) + [END_SYMBOL]
+    for n in ngram_list:
+        cur_ngram = zip(*[char_list[i:] for i in range(n)])
+        cur_ngram = ["".join(x) for x in cur_ngram]
+        all_ngrams += cur_ngram
+
+        idx_list = [i for i in range(len(char_list))]
+        cur_idx_ngram = zip(*[idx_list[i:] for i in range(n)])
+        st_ed = [[x[0], x[-1]] for x in cur_idx_ngram]
+        all_st_idx += [x[0] for x in st_ed]
+        all_ed_idx += [x[1] for x in st_ed]
+    return all_ngrams, all_st_idx, all_ed_idx
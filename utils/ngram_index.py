@@ -0,0 +1,98 @@
+import os
+import numpy as np
+from utils.ngram import get_ngram
+from utils.vocab import CompactMap
+
+
+class NgramIndex:
+    '''
+    inverted index from the character n-grams of get_ngram to the KB rows that contain them
+    rows containing n-gram i are postings[offsets[i]:offsets[i+1]], sorted
+    a row is scored by the sum of the idf of the n-grams it shares with the query
+    '''
+    def __init__(self, ngram_map: CompactMap, offsets: np.ndarray, postings: np.ndarray, kb_size):
+        self.ngram_map = ngram_map
+        self.offsets = offsets
+        self.postings = postings
+        self.kb_size = kb_size
+        df = np.diff(offsets)
+        self.idf = np.log(kb_size / np.maximum(df, 1)).astype(np.float32)
+
+    @classmethod
+    def build(cls, strings, prefix=None, chunk_size=100000):
+        ngram_ids = {}
+        all_ngrams, all_rows = [], []
+        kb_size = 0
+        # (n-gram, row) pairs are collected as arrays chunk by chunk, python lists of pairs would not fit in memory for a large KB
+        cur_ngrams, cur_rows = [], []
+        for row, s in enumerate(strings):
+            for ngram in set(get_ngram(s)[0]):
+                cur_ngrams.append(ngram_ids.setdefault(ngram, len(ngram_ids)))
+                cur_rows.append(row)
+            kb_size += 1
+            if kb_size % chunk_size == 0:
+                all_ngrams.append(np.array(cur_ngrams, dtype=np.int32))
+                all_rows.append(np.array(cur_rows, dtype=np.int32))
+                cur_ngrams, cur_rows = [], []
+        all_ngrams.append(np.array(cur_ngrams, dtype=np.int32))
+        all_rows.append(np.array(cur_rows, dtype=np.int32))
+        all_ngrams, all_rows = np.concatenate(all_ngrams), np.concatenate(all_rows)
+        # rows are added in order, a stable sort keeps each posting list sorted
+        order = np.argsort(all_ngrams, kind="stable")
+        postings = all_rows[order]
+        offsets = np.zeros(len(ngram_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(all_ngrams, minlength=len(ngram_ids)))
+        index = cls(CompactMap.from_dict(ngram_ids), offsets, postings, kb_size)
+        if prefix is not None:
+            index.save(prefix)
+        return index
+
+    @classmethod
+    def load(cls, prefix):
+        offsets = np.load(prefix + ".offsets.npy")
+        return cls(CompactMap.load(prefix + ".ngram"), offsets[:-1], np.load(prefix + ".postings.npy", mmap_mode="r"), int(offsets[-1]))
+
+    def save(self, prefix):
+        self.ngram_map.save(prefix + ".ngram")
+        np.save(prefix + ".postings.npy", self.postings)
+        # the KB size is stored after the offsets, this file is written last and marks a complete index
+        np.save(prefix + ".offsets.npy", np.append(self.offsets, self.kb_size))
+
+    def search(self, string, size, max_df=0.1, min_ngrams=3, kb_rows=None) -> np.ndarray:
+        '''
+        :param max_df: n-grams in more than this fraction of the KB are skipped, except the min_ngrams rarest ones of the query
+        :param kb_rows: only return these (sorted) rows, e.g. a type partition
+        :return: at most size rows sharing n-grams with string, sorted by score
+        '''
+        ngram_ids = self.ngram_map.lookup(list(set(get_ngram(string)[0])), default=-1)
+        ngram_ids = ngram_ids[ngram_ids != -1]
+        if len(ngram_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        df = self.offsets[ngram_ids + 1] - self.offsets[ngram_ids]
+        order = np.argsort(df, kind="stable")
+        keep = order[(np.arange(len(order)) < min_ngrams) | (df[order] <= max_df * self.kb_size)]
+        ngram_ids = ngram_ids[keep]
+        rows = np.concatenate([self.postings[self.offsets[i]:self.offsets[i + 1]] for i in ngram_ids])
+        weights = np.repeat(self.idf[ngram_ids], (self.offsets[ngram_ids + 1] - self.offsets[ngram_ids]))
+        # only rows that share an n-gram are touched, not the whole KB
+        rows, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse.reshape(-1), weights=weights)
+        if kb_rows is not None:
+            in_partition = np.isin(rows, kb_rows, assume_unique=True)
+            rows, scores = rows[in_partition], scores[in_partition]
+        if len(rows) > size:
+            top = np.argpartition(-scores, size - 1)[:size]
+            rows, scores = rows[top], scores[top]
+        return rows[np.argsort(-scores, kind="stable")].astype(np.int64)
+
+
+def load_ngram_index(fname, str_idx, strings) -> NgramIndex:
+    '''
+    :param strings: the strings of column str_idx of the KB file, the index is built once per KB file and cached next to it
+    '''
+    prefix = "{}.ngram{}".format(fname, str_idx)
+    if not os.path.exists(prefix + ".offsets.npy") or os.path.getmtime(prefix + ".offsets.npy") < os.path.getmtime(fname):
+        index = NgramIndex.build(strings, prefix)
+        print("[INFO] build n-gram index {}, {} n-grams, {} postings".format(prefix, len(index.ngram_map), len(index.postings)))
+        return index
+    return NgramIndex.load(prefix)
@@ -0,0 +1,85 @@
+import threading
+import queue
+
+END = object()
+# seconds between two checks of the stop event by a thread blocked on a queue
+POLL_INTERVAL = 0.1
+
+
+class StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+def put(q, item, stop):
+    # False if the pipeline is stopped before there is room in q
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(q, stop):
+    # END if the pipeline is stopped before an item arrives
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return END
+
+
+def run_source(source, out_q, stop):
+    try:
+        for item in source:
+            if not put(out_q, item, stop):
+                return
+        put(out_q, END, stop)
+    except Exception as e:
+        put(out_q, StageError(e), stop)
+
+
+def run_stage(fn, in_q, out_q, stop):
+    while True:
+        item = get(in_q, stop)
+        if item is END or isinstance(item, StageError):
+            put(out_q, item, stop)
+            return
+        try:
+            if not put(out_q, fn(item), stop):
+                return
+        except Exception as e:
+            put(out_q, StageError(e), stop)
+            return
+
+
+def run_pipeline(source, stages, queue_size=2):
+    '''
+    run the source iterator and each stage (item -> item) in its own thread, connected by bounded queues
+    at most queue_size items wait between two stages, so memory is bounded whatever the size of the source
+    if a stage fails or the generator is not consumed to the end, the threads are stopped and joined
+    :return: a generator of the output of the last stage, in the order of the source
+    '''
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=run_source, args=(source, queues[0], stop), daemon=True)]
+    for i, fn in enumerate(stages):
+        threads.append(threading.Thread(target=run_stage, args=(fn, queues[i], queues[i + 1], stop), daemon=True))
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is END:
+                break
+            if isinstance(item, StageError):
+                raise item.error
+            yield item
+    finally:
+        # a stage that is running finishes its current item first
+        stop.set()
+        for t in threads:
+            t.join()
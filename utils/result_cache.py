@@ -0,0 +1,58 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_signature(fname):
+    # a file is considered changed if its path, size or modification time changes
+    if fname is None or not os.path.exists(fname):
+        return (fname, None, None)
+    stat = os.stat(fname)
+    return (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+
+
+class QueryResultCache:
+    '''
+    LRU cache of mention string -> ranked result ({"base": (topk idx, topk scores), "pivot": ...})
+    results are only valid for one context (checkpoint, KB, alias, pivot files and test settings),
+    files are checked at every set_context call and the cache is emptied when the context changes
+    the cache is shared by the encode and rank threads of a streamed test file (eval_query_stream), access is locked
+    '''
+    def __init__(self, max_size=10000, files=(), settings=()):
+        self.max_size = max_size
+        self.files = list(files)
+        self.settings = tuple(settings)
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.context = None
+        self.hit, self.miss = 0, 0
+
+    def set_context(self, extra_files=()):
+        context = tuple(file_signature(f) for f in self.files + list(extra_files)) + self.settings
+        with self.lock:
+            if context != self.context:
+                if len(self.lru) != 0:
+                    print("[INFO] checkpoint or KB changed, clear {} cached results".format(len(self.lru)))
+                self.lru.clear()
+                self.context = context
+
+    def get_many(self, queries) -> dict:
+        found = {}
+        with self.lock:
+            for q in queries:
+                if q in self.lru:
+                    self.lru.move_to_end(q)
+                    found[q] = self.lru[q]
+            self.hit += len(found)
+            self.miss += len(queries) - len(found)
+        return found
+
+    def put_many(self, results: dict):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            for q, result in results.items():
+                self.lru[q] = result
+                self.lru.move_to_end(q)
+                if len(self.lru) > self.max_size:
+                    self.lru.popitem(last=False)
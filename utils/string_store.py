@@ -0,0 +1,245 @@
+import os
+import hashlib
+import numpy as np
+
+BLOB_SUFFIX = ".blob.npy"
+OFFSET_SUFFIX = ".offsets.npy"
+HASH_SUFFIX = ".hash.npy"
+HASH_ORDER_SUFFIX = ".hash_order.npy"
+
+
+def hash_string(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def is_fresh(prefix, source_file):
+    # the store is rebuilt when the file it is built from changes
+    return os.path.exists(prefix + OFFSET_SUFFIX) and \
+           os.path.getmtime(prefix + OFFSET_SUFFIX) >= os.path.getmtime(source_file)
+
+
+class StringTable:
+    '''
+    list of strings stored as ONE utf-8 blob (uint8) and offsets (int64, len + 1), both opened with mmap
+    strings are decoded only when they are accessed
+    the optional index (hash of each string, sorted) supports exact match of a batch of strings
+    '''
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, hashes: np.ndarray = None, hash_order: np.ndarray = None):
+        self.blob = blob
+        self.offsets = offsets
+        self.hashes = hashes
+        self.hash_order = hash_order
+
+    @classmethod
+    def build(cls, strings, prefix=None, index=True):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        hashes, hash_order = None, None
+        if index:
+            row_hashes = np.array([hash_string(s) for s in strings], dtype=np.int64)
+            # stable, rows with the same string keep their order
+            hash_order = np.argsort(row_hashes, kind="stable")
+            hashes = row_hashes[hash_order]
+        table = cls(blob, offsets, hashes, hash_order)
+        if prefix is not None:
+            table.save(prefix)
+        return table
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        mmap_mode = "r" if mmap else None
+        blob = np.load(prefix + BLOB_SUFFIX, mmap_mode=mmap_mode)
+        offsets = np.load(prefix + OFFSET_SUFFIX, mmap_mode=mmap_mode)
+        if os.path.exists(prefix + HASH_SUFFIX):
+            hashes = np.load(prefix + HASH_SUFFIX, mmap_mode=mmap_mode)
+            hash_order = np.load(prefix + HASH_ORDER_SUFFIX, mmap_mode=mmap_mode)
+        else:
+            hashes, hash_order = None, None
+        return cls(blob, offsets, hashes, hash_order)
+
+    def save(self, prefix):
+        np.save(prefix + BLOB_SUFFIX, self.blob)
+        if self.hashes is not None:
+            np.save(prefix + HASH_SUFFIX, self.hashes)
+            np.save(prefix + HASH_ORDER_SUFFIX, self.hash_order)
+        # offsets are written last, their mtime marks a complete store
+        np.save(prefix + OFFSET_SUFFIX, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, strings, last=False, rows=None) -> np.ndarray:
+        '''
+        :param rows: if not None, only these (sorted) rows are searched, e.g. a type partition of the KB
+        :return: the row of each string (the first one if it appears more than once, the last one if last=True), -1 if not found
+        '''
+        assert self.hashes is not None, "the string table is built without index"
+        query = np.array([hash_string(s) for s in strings], dtype=np.int64)
+        st = np.searchsorted(self.hashes, query, side="left")
+        ed = np.searchsorted(self.hashes, query, side="right")
+        found = np.full(len(strings), -1, dtype=np.int64)
+        for i, (s, cur_st, cur_ed) in enumerate(zip(strings, st, ed)):
+            candidates = range(cur_ed - 1, cur_st - 1, -1) if last else range(cur_st, cur_ed)
+            for j in candidates:
+                if rows is not None and not in_sorted(rows, self.hash_order[j]):
+                    continue
+                # hash collision is possible, compare the string
+                if self[self.hash_order[j]] == s:
+                    found[i] = self.hash_order[j]
+                    break
+        return found
+
+    def __contains__(self, s):
+        return self.find([s])[0] != -1
+
+    def index(self, s):
+        row = self.find([s])[0]
+        if row == -1:
+            raise ValueError("{} is not in the table".format(s))
+        return int(row)
+
+
+class ConcatStrings:
+    # several string lists/tables viewed as one list, e.g. KB titles followed by pivot strings
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(x) for x in parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        part = np.searchsorted(self.offsets, i, side="right") - 1
+        return self.parts[part][i - self.offsets[part]]
+
+    def find(self, strings, rows=None) -> np.ndarray:
+        found = np.full(len(strings), -1, dtype=np.int64)
+        for offset, part in zip(self.offsets, self.parts):
+            part_rows = None if rows is None else rows[(rows >= offset) & (rows < offset + len(part))] - offset
+            part_found = find_strings(part, strings, part_rows)
+            update = (found == -1) & (part_found != -1)
+            found[update] = part_found[update] + offset
+        return found
+
+
+def in_sorted(rows, row):
+    pos = np.searchsorted(rows, row)
+    return pos < len(rows) and rows[pos] == row
+
+
+def find_strings(table, strings, rows=None) -> np.ndarray:
+    # exact match of strings in table, first occurrence as list.index, -1 if not found
+    # rows: only these (sorted) rows of table are searched, the first occurrence among them
+    if hasattr(table, "find"):
+        return table.find(strings) if rows is None else table.find(strings, rows=rows)
+    first_idx = {}
+    for i, s in (enumerate(table) if rows is None else ((int(i), table[i]) for i in rows)):
+        first_idx.setdefault(s, i)
+    return np.array([first_idx.get(s, -1) for s in strings], dtype=np.int64)
+
+
+def load_string_column(fname, str_idx, id_idx):
+    '''
+    ids (int) and strings of one column of a ||| separated file (e.g. KB titles)
+    the strings are cached next to the file as a StringTable and read lazily
+    '''
+    prefix = "{}.col{}".format(fname, str_idx)
+    id_file = "{}.id{}.npy".format(fname, id_idx)
+    if not is_fresh(prefix, fname) or not os.path.exists(id_file):
+        ids, strings = [], []
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                tks = line.strip().split(" ||| ")
+                ids.append(int(tks[id_idx]))
+                strings.append(tks[str_idx])
+        np.save(id_file, np.array(ids))
+        StringTable.build(strings, prefix)
+        print("[INFO] build string table {}, len: {:d}".format(prefix, len(strings)))
+    return np.load(id_file), StringTable.load(prefix)
+
+
+class AliasMapView:
+    # dict-like view (key -> list of aliases) over an AliasStore, used in place of title_alia_map / id_alia_map
+    def __init__(self, store, keys: StringTable, skip_key=None):
+        self.store = store
+        self.keys = keys
+        self.skip_key = skip_key
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, default=None):
+        if key == self.skip_key:
+            return default
+        # the last line wins, same as filling a dict line by line
+        row = self.keys.find([key], last=True)[0]
+        if row == -1:
+            return default
+        return self.store.get_alias(row)
+
+    def __getitem__(self, key):
+        alias = self.get(key)
+        if alias is None:
+            raise KeyError(key)
+        return alias
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class AliasStore:
+    '''
+    alias file (Wikidata_ID ||| English_Wikipedia_ID ||| title ||| aliases) in compact form
+    line i of the file owns aliases[alias_offsets[i]:alias_offsets[i+1]]
+    titles and wikipedia ids of each line are indexed for lookup
+    '''
+    def __init__(self, prefix):
+        self.aliases = StringTable.load(prefix + ".alias")
+        self.titles = StringTable.load(prefix + ".title")
+        self.ids = StringTable.load(prefix + ".id")
+        self.alias_offsets = np.load(prefix + ".alias_range.npy", mmap_mode="r")
+        self.title_map = AliasMapView(self, self.titles)
+        self.id_map = AliasMapView(self, self.ids, skip_key="NAN")
+
+    @classmethod
+    def build(cls, fname, prefix):
+        titles, ids, aliases, alias_offsets = [], [], [], [0]
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                tks = line.strip().split(" ||| ")
+                if len(tks) != 4:
+                    continue
+                aka = tks[3].split(" || ")
+                titles.append(tks[2])
+                ids.append(tks[1])
+                aliases += aka
+                alias_offsets.append(len(aliases))
+        StringTable.build(aliases, prefix + ".alias", index=False)
+        StringTable.build(titles, prefix + ".title")
+        np.save(prefix + ".alias_range.npy", np.array(alias_offsets, dtype=np.int64))
+        # ids are written last, they mark a complete store
+        StringTable.build(ids, prefix + ".id")
+        print("[INFO] build alias store {}, {} lines, {} aliases".format(prefix, len(titles), len(aliases)))
+
+    @classmethod
+    def open(cls, fname):
+        prefix = fname + ".store"
+        if not is_fresh(prefix + ".id", fname):
+            cls.build(fname, prefix)
+        return cls(prefix)
+
+    def get_alias(self, row) -> list:
+        return self.aliases[int(self.alias_offsets[row]):int(self.alias_offsets[row + 1])]
@@ -1,34 +1,93 @@
 import epitran
 import argparse
+import functools
+import itertools
+from multiprocessing import Pool
 
 # lang map is used to map two letters language code to the language label used by epitran
 map_file = "./lang_map.tsv"
-def to_ipa(fname, lang1, lang2):
+
+# columns to transliterate in each file layout: column index -> 1 (use lang1) or 2 (use lang2)
+# links: English_Wikipedia_ID ||| English_Wikipedia_title ||| Wikipedia_title_of_train/test_lang ||| Entity_type
+# kb: English_Wikipedia_ID ||| English_Wikipedia_title ||| Entity_type
+# alias: Wikidata_ID ||| English_Wikipedia_ID ||| English_Wikipedia_title ||| alias1 || alias2 ...
+LAYOUT_COLUMNS = {
+    "links": {1: 1, 2: 2},
+    "kb": {1: 1},
+    "alias": {2: 1, 3: 1},
+}
+# lines with less columns are skipped
+LAYOUT_MIN_COLUMNS = {"links": 3, "kb": 2, "alias": 4}
+
+# one epitran object per language in each worker process
+epi = {}
+
+def init_worker(lang_label1, lang_label2):
+    epi[1] = epitran.Epitran(lang_label1)
+    epi[2] = epitran.Epitran(lang_label2)
+    transliterate_word.cache_clear()
+
+# titles share most of their words, so the transliteration is memoized per word
+@functools.lru_cache(maxsize=1000000)
+def transliterate_word(lang, word):
+    return epi[lang].transliterate(word)
+
+def transliterate(lang, string):
+    return " ".join(transliterate_word(lang, w) for w in string.split(" "))
+
+def process_chunk(args):
+    lines, layout = args
+    columns = LAYOUT_COLUMNS[layout]
+    result = []
+    for line in lines:
+        tks = line.strip().split(" ||| ")
+        if len(tks) < LAYOUT_MIN_COLUMNS[layout]:
+            continue
+        for col, lang in columns.items():
+            if col < len(tks):
+                # the alias column is a " || " separated list
+                tks[col] = " || ".join(transliterate(lang, x) for x in tks[col].split(" || "))
+        result.append(" ||| ".join(tks) + "\n")
+    return result
+
+def read_chunks(f, chunk_size, layout):
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if len(lines) == 0:
+            break
+        yield lines, layout
+
+def to_ipa(fname, lang1, lang2, layout="links", workers=1, chunk_size=10000):
     epitran_map = {}
     with open(map_file, "r", encoding="utf-8") as f:
         for line in f:
             tks = line.strip().split("\t")
             epitran_map[tks[1]] = tks[0]
-    epi1 = epitran.Epitran(epitran_map[lang1])
-    epi2 = epitran.Epitran(epitran_map[lang2])
+    lang_labels = (epitran_map[lang1], epitran_map[lang2 if lang2 is not None else lang1])
     fsave = fname + ".ipa"
     with open(fname, "r", encoding="utf-8") as f, open(fsave, "w+", encoding="utf-8") as fout:
-        for line in f:
-            tks = line.strip().split(" ||| ")
-            if len(tks) < 3:
-                continue
-            _tks = [x for x in tks]
-            tks[1] = epi1.transliterate(tks[1])
-            tks[2] = epi2.transliterate(tks[2])
-            # tks = tks[:3] + _tks[2:3] + tks[3:]
-            fout.write(" ||| ".join(tks) + "\n")
+        chunks = read_chunks(f, chunk_size, layout)
+        if workers > 1:
+            # imap keeps the order of the chunks
+            with Pool(workers, initializer=init_worker, initargs=lang_labels) as pool:
+                for result in pool.imap(process_chunk, chunks):
+                    fout.writelines(result)
+        else:
+            init_worker(*lang_labels)
+            for chunk in chunks:
+                fout.writelines(process_chunk(chunk))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--lang1", help="two letter language code of the second column", default="en")
-    parser.add_argument("--lang2", help="two letter language code of the third column", required=True)
+    parser.add_argument("--lang1", help="two letter language code of the English columns", default="en")
+    parser.add_argument("--lang2", help="two letter language code of the third column of the links file")
     parser.add_argument("--fname", help="the file that need process, will generate fname.ipa", required=True)
+    parser.add_argument("--layout", help="format of the file", choices=("links", "kb", "alias"), default="links")
+    parser.add_argument("--workers", help="number of processes", type=int, default=1)
+    parser.add_argument("--chunk_size", help="number of lines sent to a process at a time", type=int, default=10000)
 
     args,  _ = parser.parse_known_args()
-    to_ipa(args.fname, args.lang1, args.lang2)
+    if args.layout == "links" and args.lang2 is None:
+        parser.error("--lang2 is required for the links layout")
+    to_ipa(args.fname, args.lang1, args.lang2, args.layout, args.workers, args.chunk_size)
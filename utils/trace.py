@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+
+print = functools.partial(print, flush=True)
+
+
+class NullSpan:
+    # the span of a disabled tracer, one shared instance that does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Tracer:
+    '''
+    accumulated count / total / max seconds of named spans, and the spans themselves as a Chrome trace
+    (chrome://tracing or ui.perfetto.dev) if trace_file is not empty. spans nest, the time of a span includes its children
+    '''
+    def __init__(self, trace_file="", max_events=1000000):
+        self.trace_file = trace_file
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        # name -> [count, total seconds, max seconds]
+        self.stats = {}
+        self.events = []
+        self.dropped = 0
+        self.origin = time.perf_counter()
+
+    def record(self, name, start, end):
+        duration = end - start
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+            if self.trace_file:
+                if len(self.events) < self.max_events:
+                    # complete events, timestamps in microseconds; threads (e.g. of utils/pipeline.py) are separate rows
+                    self.events.append({"name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                                        "pid": os.getpid(), "tid": threading.get_ident()})
+                else:
+                    self.dropped += 1
+
+    def summary(self):
+        wall = time.perf_counter() - self.origin
+        print("===============trace summary ({:.2f}s)===============".format(wall))
+        print("{:<24}{:>10}{:>12}{:>12}{:>12}{:>8}".format("span", "calls", "total s", "mean ms", "max ms", "%"))
+        for name, (count, total, longest) in sorted(self.stats.items(), key=lambda x: -x[1][1]):
+            print("{:<24}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>8.1f}".format(name, count, total, total / count * 1000, longest * 1000,
+                                                                        total / wall * 100))
+
+    def write(self):
+        with open(self.trace_file, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        print("[INFO] write {} spans to {}".format(len(self.events), self.trace_file))
+        if self.dropped != 0:
+            print("[WARNING] {} spans after the first {} are not in the trace file".format(self.dropped, self.max_events))
+
+    def finish(self):
+        self.summary()
+        if self.trace_file:
+            self.write()
+
+
+# None unless --trace, span() is then a global lookup that returns NULL_SPAN
+tracer = None
+
+
+def span(name):
+    '''
+    with span("encoding"): ... times the block under this name when tracing is enabled
+    '''
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name)
+
+
+def traced(name):
+    # decorator version of span, whether tracing is enabled is checked at each call
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with Span(tracer, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_trace(args):
+    # the summary is printed (and the trace file written) when the process exits
+    global tracer
+    if not args.trace:
+        return None
+    tracer = Tracer(args.trace_file, args.trace_max_events)
+    atexit.register(tracer.finish)
+    return tracer
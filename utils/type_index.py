@@ -0,0 +1,84 @@
+import os
+import numpy as np
+
+# entity type of lines without the type column
+NO_TYPE = ""
+
+
+def read_type_column(fname, type_idx) -> list:
+    types = []
+    with open(fname, "r", encoding="utf-8") as f:
+        for line in f:
+            tks = line.strip().split(" ||| ")
+            types.append(tks[type_idx] if type_idx < len(tks) else NO_TYPE)
+    return types
+
+
+class TypeIndex:
+    '''
+    KB rows partitioned by entity type (e.g. PER/LOC/ORG)
+    rows of type types[i] are rows[starts[i]:starts[i+1]], sorted
+    KB rows without a type are in every partition, queries of an unknown type search the whole KB
+    '''
+    def __init__(self, types: np.ndarray, rows: np.ndarray, starts: np.ndarray, kb_size):
+        self.types = [str(x) for x in types]
+        self.rows = rows
+        self.starts = starts
+        self.kb_size = kb_size
+        self.type_pos = {t: i for i, t in enumerate(self.types)}
+
+    @classmethod
+    def build(cls, kb_types: list, prefix=None):
+        kb_types = np.array(kb_types, dtype=str)
+        untyped = np.nonzero(kb_types == NO_TYPE)[0]
+        types = sorted(set(kb_types.tolist()) - {NO_TYPE})
+        rows, starts = [], [0]
+        for t in types:
+            cur_rows = np.union1d(np.nonzero(kb_types == t)[0], untyped)
+            rows.append(cur_rows)
+            starts.append(starts[-1] + len(cur_rows))
+        rows = np.concatenate(rows) if len(rows) != 0 else np.zeros(0, dtype=np.int64)
+        index = cls(np.array(types, dtype=str), rows.astype(np.int64), np.array(starts, dtype=np.int64), len(kb_types))
+        if prefix is not None:
+            index.save(prefix)
+        return index
+
+    @classmethod
+    def load(cls, prefix):
+        starts = np.load(prefix + ".starts.npy")
+        kb_size = int(starts[-1])
+        return cls(np.load(prefix + ".types.npy"), np.load(prefix + ".rows.npy", mmap_mode="r"), starts[:-1], kb_size)
+
+    def save(self, prefix):
+        np.save(prefix + ".types.npy", np.array(self.types, dtype=str))
+        np.save(prefix + ".rows.npy", self.rows)
+        # the KB size is stored after the starts, this file is written last and marks a complete index
+        np.save(prefix + ".starts.npy", np.append(self.starts, self.kb_size))
+
+    def partition(self, entity_type):
+        '''
+        :return: sorted KB rows of this type, None if the type is unknown (search the whole KB)
+        '''
+        pos = self.type_pos.get(entity_type)
+        if pos is None:
+            return None
+        return np.asarray(self.rows[self.starts[pos]:self.starts[pos + 1]])
+
+    def group_queries(self, query_types: list) -> list:
+        '''
+        :return: [(idx of queries, KB rows to search or None for the whole KB)], one entry per type in query_types
+        '''
+        groups = {}
+        for i, t in enumerate(query_types):
+            groups.setdefault(t if t in self.type_pos else None, []).append(i)
+        return [(np.array(idx), self.partition(t) if t is not None else None) for t, idx in groups.items()]
+
+
+def load_type_index(fname, type_idx) -> TypeIndex:
+    # the index is built once per KB file and cached next to it
+    prefix = "{}.type{}".format(fname, type_idx)
+    if not os.path.exists(prefix + ".starts.npy") or os.path.getmtime(prefix + ".starts.npy") < os.path.getmtime(fname):
+        index = TypeIndex.build(read_type_column(fname, type_idx), prefix)
+        print("[INFO] build type index {}, partitions: {}".format(prefix, {t: len(index.partition(t)) for t in index.types}))
+        return index
+    return TypeIndex.load(prefix)
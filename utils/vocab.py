@@ -0,0 +1,155 @@
+import os
+import pickle
+import numpy as np
+from utils.trace import traced
+
+KEY_SUFFIX = ".keys.npy"
+ID_SUFFIX = ".ids.npy"
+COUNT_SUFFIX = ".count.npy"
+
+
+class CompactMap:
+    '''
+    read-only string -> idx map used at test time instead of a pickled dict
+    keys: sorted utf-8 strings in ONE fixed width bytes array, ids: int32 array aligned with keys
+    both arrays are stored as .npy and opened with mmap, so loading is instant and the strings never become python objects
+    lookup() maps a whole list of strings with one np.searchsorted call
+    '''
+    def __init__(self, keys: np.ndarray, ids: np.ndarray, default=None):
+        self.keys = keys
+        self.ids = ids
+        self.default = default
+        # position of each id in keys, only built when ids are decoded back to strings
+        self.order = None
+
+    @classmethod
+    def from_dict(cls, m: dict, default=None):
+        items = sorted((k.encode("utf-8"), v) for k, v in m.items())
+        keys = np.array([k for k, _ in items], dtype=bytes)
+        ids = np.array([v for _, v in items], dtype=np.int32)
+        return cls(keys, ids, default)
+
+    @classmethod
+    def load(cls, prefix, default=None, mmap=True):
+        mmap_mode = "r" if mmap else None
+        keys = np.load(prefix + KEY_SUFFIX, mmap_mode=mmap_mode)
+        ids = np.load(prefix + ID_SUFFIX, mmap_mode=mmap_mode)
+        return cls(keys, ids, default)
+
+    def save(self, prefix):
+        np.save(prefix + KEY_SUFFIX, self.keys)
+        np.save(prefix + ID_SUFFIX, self.ids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, strings) -> (np.ndarray, np.ndarray):
+        '''
+        :return: position in self.keys for each string and whether the string is in the map
+        '''
+        query = np.array([s.encode("utf-8") for s in strings], dtype=bytes)
+        if len(query) == 0 or len(self.keys) == 0:
+            return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+        pos = np.searchsorted(self.keys, query)
+        pos[pos >= len(self.keys)] = 0
+        found = self.keys[pos] == query
+        return pos, found
+
+    def lookup(self, strings, default=None) -> np.ndarray:
+        default = self.default if default is None else default
+        pos, found = self.find(strings)
+        result = self.ids[pos].astype(np.int32)
+        if not np.all(found):
+            if default is None:
+                raise KeyError([s for s, f in zip(strings, found) if not f][0])
+            result[~found] = default
+        return result
+
+    def __getitem__(self, s):
+        return int(self.lookup([s])[0])
+
+    def get(self, s, default=None):
+        pos, found = self.find([s])
+        return int(self.ids[pos[0]]) if found[0] else default
+
+    def __contains__(self, s):
+        return bool(self.find([s])[1][0])
+
+    def decode(self, ids) -> list:
+        # idx -> string, replaces the i2c dicts
+        if self.order is None:
+            self.order = np.full(int(np.max(self.ids)) + 1 if len(self.ids) else 0, -1, dtype=np.int64)
+            self.order[self.ids] = np.arange(len(self.ids))
+        return [self.keys[self.order[i]].decode("utf-8") for i in ids]
+
+    def items(self):
+        for k, v in zip(self.keys, self.ids):
+            yield k.decode("utf-8"), int(v)
+
+
+class CompactCount:
+    '''
+    read-only idx -> frequency map, the frequency of idx i is stored at position i of a dense int64 array
+    idx that never appeared (frequency 0) return the default value
+    updates (e.g. counting test data) go to a small dict on top of the read-only array
+    '''
+    def __init__(self, counts: np.ndarray, default=float('-inf')):
+        self.counts = counts
+        self.default = default
+        self.update = {}
+
+    @classmethod
+    def from_dict(cls, m: dict, default=float('-inf')):
+        counts = np.zeros(max(m.keys()) + 1 if len(m) else 0, dtype=np.int64)
+        for k, v in m.items():
+            counts[k] = v
+        return cls(counts, default)
+
+    @classmethod
+    def load(cls, prefix, default=float('-inf'), mmap=True):
+        return cls(np.load(prefix + COUNT_SUFFIX, mmap_mode="r" if mmap else None), default)
+
+    def save(self, prefix):
+        np.save(prefix + COUNT_SUFFIX, self.counts)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    def __getitem__(self, idx):
+        if idx in self.update:
+            return self.update[idx]
+        if 0 <= idx < len(self.counts) and self.counts[idx] != 0:
+            return int(self.counts[idx])
+        return self.default
+
+    def __setitem__(self, idx, value):
+        self.update[idx] = value
+
+
+def compact_map_exists(prefix):
+    return os.path.exists(prefix + KEY_SUFFIX) or os.path.exists(prefix + COUNT_SUFFIX) \
+           or os.path.exists(prefix + ".pkl")
+
+
+def convert_pickle_map(prefix):
+    # convert maps saved by older versions (prefix.pkl) to the compact format
+    with open(prefix + ".pkl", "rb") as f:
+        m = pickle.load(f)
+    if len(m) != 0 and isinstance(next(iter(m.keys())), str):
+        CompactMap.from_dict(m).save(prefix)
+    else:
+        CompactCount.from_dict(m).save(prefix)
+    print("[INFO] convert {} to compact map".format(prefix + ".pkl"))
+
+
+@traced("vocab_lookup")
+def lookup_tokens(x2i_map, token_lists) -> list:
+    # map several token lists (e.g. all versions of one entity) with one lookup if the map supports it
+    if isinstance(x2i_map, CompactMap):
+        idx = x2i_map.lookup([x for tokens in token_lists for x in tokens]).tolist()
+        result, st = [], 0
+        for tokens in token_lists:
+            result.append(idx[st:st + len(tokens)])
+            st += len(tokens)
+        return result
+    return [[x2i_map[x] for x in tokens] for tokens in token_lists]